@@ -9,6 +9,10 @@
 import StringIO, os, os.path
 import logging
 import time
+try:
+    from hashlib import md5 # python 2.5 or greater
+except ImportError:
+    from md5 import new as md5
 
 from vesper.data import base, transactions
 from vesper.data.base import graph as graphmod # avoid aliasing some local vars
@@ -93,6 +97,8 @@ class BasicStore(DataStore):
     #by another embedded object remove the embedded object and recursively any 
     #other embedded embedded object.
     simpleEmbeddingSemantics = True
+    #the number of prepared queries kept, the least recently used are discarded
+    maxPreparedQueries = 1000
     
     def __init__(self, requestProcessor, model_factory=None,
                  schemaFactory=defaultSchemaClass,
@@ -111,12 +117,16 @@ class BasicStore(DataStore):
                  replication_hosts=None,
                  replication_channel=None,
                  send_stomp_ack=True,
+                 ast_cache_size=200,
                  **kw):
         '''
         model_factory is a base.Model class or factory function that takes
         two parameters:
           a location (usually a local file path) and iterator of Statements
           to initialize the model if it needs to be created
+
+        ast_cache_size is the number of parsed queries to cache (0 disables
+        the cache)
         '''
         self.requestProcessor = requestProcessor
         self.model_factory = model_factory
@@ -144,6 +154,10 @@ class BasicStore(DataStore):
                 
         self._txnparticipants = []
         self.model_options = model_options or {}
+        import vesper.query
+        self.astCache = vesper.query.ASTCache(ast_cache_size)
+        self._preparedQueries = vesper.query.PreparedQueryCache(
+                                                    self.maxPreparedQueries)
 
     def load(self):
         requestProcessor = self.requestProcessor
@@ -723,13 +737,39 @@ class BasicStore(DataStore):
                 
         cache = self.requestProcessor.txnSvc.state.queryCache
         results = vesper.query.getResults(query, self.model, bindvars, explain,
-          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, cache)
+          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, 
+          cache, self.astCache)
         self.log.debug('%s elapsed for query %s', results.elapsed, query)
         if not captureErrors and not explain and not debug:
             return results.results
         else:
             return results
 
+    def prepare(self, query):
+        '''
+        Parse the query and return a `vesper.query.PreparedQuery` that can be 
+        executed many times with different bindvars, either by calling its
+        `execute()` method or by passing it to `query()`. 
+        Raises `QueryException` if the query fails to parse.
+
+        The prepared query can also be retrieved by its `handle` using 
+        `getPreparedQuery()`.
+        '''
+        import vesper.query
+        if isinstance(query, unicode):
+            handle = md5(query.encode('utf8')).hexdigest()
+        else:
+            handle = md5(query).hexdigest()
+        def prepare():
+            prepared = vesper.query.PreparedQuery(query, self.astCache)
+            prepared.store = self
+            prepared.handle = handle
+            return prepared
+        return self._preparedQueries.getPreparedQuery(handle, prepare)
+
+    def getPreparedQuery(self, handle):
+        return self._preparedQueries.getPreparedQuery(handle)
+
     def merge(self,changeset): 
         if not self.join(self.requestProcessor.txnSvc, setCurrentTxn=False):
             #not in a transaction, so call this inside one
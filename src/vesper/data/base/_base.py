@@ -12,6 +12,8 @@ from vesper import utils
 from vesper.data.base.utils import *
 
 import os.path, sys, time
+import itertools, heapq
+import threading, Queue
 
 import logging 
 log = logging.getLogger("RxPath")
@@ -44,6 +46,8 @@ class Tupleset(object):
     Interface for representing a set of tuples
     '''
     columns = None
+    #the position of the column the tuples are sorted by (ascending), if known
+    ordering = None
 
     def findColumnPos(self, label, rowinfo=False, shallow=False, pos=(), count=1):
         if not self.columns:
@@ -111,10 +115,94 @@ class Tupleset(object):
     def append(self, row, *moreRows):
         raise TypeError('Tupleset is read only')
     
+class Statistics(object):
+    '''
+    Counts of the statements in a model, used by the query engine to 
+    estimate how many statements will match a filter. Models that keep 
+    statistics call `add()` and `remove()` as statements are added and 
+    removed.
+    '''
+    #set if the model counts encoded terms, called with (term, default)
+    encodeTerm = None
+
+    def __init__(self):
+        self.total = 0
+        self.subjects = {} #subject => count
+        self.predicates = {} #predicate => count
+        self.objects = {} #predicate => {object => count}
+
+    distinctSubjects = property(lambda self: len(self.subjects))
+
+    def distinctObjects(self, predicate):
+        return len(self.objects.get(predicate, ()))
+
+    def add(self, stmt):
+        s, p, o = stmt[:3]
+        self.total += 1
+        self.subjects[s] = self.subjects.get(s, 0) + 1
+        self.predicates[p] = self.predicates.get(p, 0) + 1
+        objects = self.objects.get(p)
+        if objects is None:
+            objects = self.objects[p] = {}
+        objects[o] = objects.get(o, 0) + 1
+
+    def remove(self, stmt):
+        s, p, o = stmt[:3]
+        def decrement(counts, key):
+            count = counts[key] - 1
+            if count:
+                counts[key] = count
+            else:
+                del counts[key]
+        self.total -= 1
+        decrement(self.subjects, s)
+        decrement(self.predicates, p)
+        decrement(self.objects[p], o)
+        if not self.objects[p]:
+            del self.objects[p]
+
+    def estimate(self, subject=None, predicate=None, object=None):
+        '''
+        Estimate the number of statements that match.
+        '''
+        if isinstance(subject, ResourceUri):
+            subject = subject.uri
+        if object is not None and not isinstance(object, (str, unicode)):
+            #the counts are keyed by the statement's object, so convert
+            #the value the same way it was when the statement was added
+            from vesper.pjson import getDataType
+            object = getDataType(object, None)[0]
+        if not self.total:
+            return 0.0
+        if self.encodeTerm:
+            #unknown terms are encoded as -1 so they won't match anything
+            terms = []
+            for term in (subject, predicate, object):
+                if term is not None:
+                    term = self.encodeTerm(term, -1)
+                terms.append(term)
+            subject, predicate, object = terms
+        if predicate is not None:
+            if object is not None:
+                count = self.objects.get(predicate, {}).get(object, 0)
+            else:
+                count = self.predicates.get(predicate, 0)
+        elif object is not None:
+            count = sum([objects.get(object, 0) 
+                                for objects in self.objects.itervalues()])
+        else:
+            count = self.total
+        if subject is not None:
+            #assume the subject's statements are distributed like the others
+            count = count * self.subjects.get(subject, 0) / float(self.total)
+        return float(count)
+
 class Model(Tupleset):
     canHandleStatementWithOrder = False
     updateAdvisory = False    
     bnodePrefix = BNODE_BASE
+    #a Statistics object if the model keeps them
+    statistics = None
     
     ### Transactional Interface ###
     autocommit = True
@@ -130,22 +218,30 @@ class Model(Tupleset):
           enumerate(('subject', 'predicate','object', 'objecttype','context', 'listpos')))
 
     def filter(self,conditions=None, hints=None):
-        from vesper import pjson
-        kw = {}
-        if conditions:
-            labels = ('subject', 'predicate','object', 'objecttype','context')
-            for key, value in conditions.iteritems():
-                if key == 0 and isinstance(value, ResourceUri):
-                    value = value.uri
-                kw[labels[key] ] = value
+        kw = conditionsToKeywords(conditions)
         kw['hints'] = hints
-        for stmt in self.getStatements(**kw):
-            objectType = stmt[3]
-            if objectType == OBJECT_TYPE_RESOURCE:
-                value = ResourceUri(stmt[2])
-            else:
-                value = pjson.toJsonValue(stmt[2], objectType)
-            yield (ResourceUri(stmt[0]), stmt[1], value, stmt[3], stmt[4], stmt.listpos)
+        for row in statementsToRows(self.iterStatements(**kw)):
+            yield row
+
+    #True if the model implements filterJoin()
+    canHandleJoins = False
+
+    def filterJoin(self, patterns):
+        '''
+        Fetch the statements for a group of filters that are joined on their
+        subject. `patterns` is a list of (conditions, predicates) pairs, 
+        where `conditions` is a position:value mapping like `filter()`'s and 
+        `predicates` is a list of (position, op, value) tuples where op is
+        'in' (and value a list), 'startswith' (and value a string) or one of 
+        '<', '<=', '>', '>=' and value is compared with the json value at 
+        that position.
+
+        Returns a list with a list of rows (like `filter()`'s) for each
+        pattern, only including rows whose subject is matched by every 
+        pattern. Rows that don't match a predicate may be included, 
+        the caller still needs to check the predicates.
+        '''
+        raise NotImplementedError
 
     def update(self, rows):
         for row in rows:
@@ -161,6 +257,13 @@ class Model(Tupleset):
         print >>out, indent, self.__class__.__name__,hex(id(self))
         
     ### Operations ###
+
+    def getStatistics(self):
+        '''
+        Returns a `Statistics` object or None if the model doesn't keep 
+        statistics.
+        '''
+        return self.statistics
                        
     def getStatements(self, subject = None, predicate = None, object=None,
                       objecttype=None,context=None, asQuad=True, hints=None):
@@ -170,9 +273,27 @@ class Model(Tupleset):
         If objectype is specified, it should be one of:
         OBJECT_TYPE_RESOURCE, OBJECT_TYPE_LITERAL, an ISO language code or an URL representing the datatype.
         If asQuad is True, will return duplicate statements if their context differs.
+
+        `hints['predicates']` can be a list of (position, op, value) tuples
+        like `filterJoin()`'s. The model can use them to skip statements
+        that can't match but doesn't have to, so the caller still needs to
+        check them.
         '''
         assert object is not None or objecttype
         raise NotImplementedError 
+
+    def iterStatements(self, subject = None, predicate = None, object=None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        '''
+        Same as `getStatements()` but returns an iterator over the matching
+        statements. If `ordered` is False the statements may be returned in
+        any order, which can let the store avoid sorting them first.
+        
+        This default implementation just calls `getStatements()`.
+        '''
+        return iter(self.getStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
         
     def addStatement(self, statement):
         '''add the specified statement to the model'''
@@ -202,6 +323,32 @@ class Model(Tupleset):
         triple = (stmt.subject, stmt.predicate, stmt.object, stmt.objectType)
         return self.reifiedIDs.get(triple)
 
+def conditionsToKeywords(conditions):
+    '''
+    Convert `filter()` conditions to `getStatements()` keywords.
+    '''
+    kw = {}
+    if conditions:
+        labels = ('subject', 'predicate','object', 'objecttype','context')
+        for key, value in conditions.iteritems():
+            if key == 0 and isinstance(value, ResourceUri):
+                value = value.uri
+            kw[labels[key] ] = value
+    return kw
+
+def statementsToRows(stmts):
+    '''
+    Convert statements to the rows returned by `Model.filter()`.
+    '''
+    from vesper import pjson
+    for stmt in stmts:
+        objectType = stmt[3]
+        if objectType == OBJECT_TYPE_RESOURCE:
+            value = ResourceUri(stmt[2])
+        else:
+            value = pjson.toJsonValue(stmt[2], objectType)
+        yield (ResourceUri(stmt[0]), stmt[1], value, stmt[3], stmt[4], stmt.listpos)
+
 class TxnState(object):
     BEGIN = 'BEGIN'
     READ = 'READ'
@@ -229,23 +376,57 @@ def getReifiedStatements(stmts):
 
 def removeDupStatementsFromSortedList(aList, asQuad=True, pred=None, 
                                                 limit=None, offset=None):
-    def removeDups(x, y):
-        if pred and not pred(y):
-            return x
-        if not x:
-            x.append(y)
-        if asQuad and x[-1] != y:
-            x.append(y)
-        elif not asQuad and x[-1][:4] != y[:4]: 
-            #exclude scope from comparison
-            x.append(y)
-        return x
-    aList = reduce(removeDups, aList, [])
-    if 'offset' is not None:
-        aList = aList[offset:]
-    if 'limit' is not None:
-        aList = aList[:limit]
-    return aList
+    '''
+    Return a list of the unique statements in the sorted list `aList` 
+    that satisfy `pred` (if specified), applying the `limit` and `offset`. 
+    Stops looking at statements once `offset+limit` statements have been found.
+    '''
+    if pred:
+        aList = itertools.ifilter(pred, aList)
+    stmts = iterUniqueStatements(aList, asQuad)
+    return list(sliceStatements(stmts, limit, offset))
+
+def iterUniqueStatements(stmts, asQuad=True, isSorted=True):
+    '''
+    Yield the statements, skipping duplicates. If `isSorted` is False the
+    statements that have been seen need to be kept in memory.
+    '''
+    if isSorted:
+        last = None
+        for stmt in stmts:
+            if last is None or (asQuad and last != stmt) or (
+                                    not asQuad and last[:4] != stmt[:4]):
+                last = stmt
+                yield stmt
+    else:
+        seen = set()
+        for stmt in stmts:
+            key = asQuad and stmt or stmt[:4]
+            if key not in seen:
+                seen.add(key)
+                yield stmt
+
+def findPredicate(hints, op, position=2):
+    '''
+    Return the value of the first predicate in `hints['predicates']` with
+    the given op on the given position (by default the object) or None.
+    '''
+    for predicate in (hints and hints.get('predicates') or ()):
+        if predicate[0] == position and predicate[1] == op:
+            return predicate[2]
+    return None
+
+def sliceStatements(stmts, limit=None, offset=None):
+    '''
+    Return an iterator over the statements that applies the limit and offset.
+    '''
+    if limit is None and not offset:
+        return iter(stmts)
+    offset = offset or 0
+    if limit is not None:
+        return itertools.islice(stmts, offset, offset+limit)
+    else:
+        return itertools.islice(stmts, offset, None)
 
 class MultiModel(Model):
     '''
@@ -261,6 +442,18 @@ class MultiModel(Model):
                  lambda self, set: setattr(self.models[0], 'autocommit', set))
     
     updateAdvisory = property(lambda self: self.models[0].updateAdvisory)
+
+    def _getOrdering(self):
+        #the models' statements are merged in order
+        orderings = set(m.ordering for m in self.models)
+        if len(orderings) == 1:
+            return orderings.pop()
+        return None
+    ordering = property(_getOrdering)
+
+    def getStatistics(self):
+        #the read-only models are assumed to be small
+        return self.models[0].getStatistics()
     
     def commit(self, **kw):
         self.models[0].commit(**kw)
@@ -268,48 +461,51 @@ class MultiModel(Model):
     def rollback(self):
         self.models[0].rollback()        
 
-    def _handleHints(self, hints, currentcount):
-        return {}
-        #XXX we can do this if know order isn't important       
-        if not hints:
-            return hints
+    def _subModelHints(self, hints):
+        '''
+        Any statement in the first offset+limit of the merged results has 
+        to be in the first offset+limit of the model it came from, so that
+        is all we need from each model. Predicates are passed on as is.
+        '''
+        subhints = {}
+        if hints.get('predicates'):
+            subhints['predicates'] = hints['predicates']
         limit = hints.get('limit')
         if limit is not None:
-            limit -= currentcount
-            if limit < 1:
-                return 'done'
-            hints['limit'] = limit
-
-        offset = hints.get('offset')
-        if offset is not None:
-            offset -= currentcount
-            hints['offset'] = offset
+            subhints['limit'] = limit + (hints.get('offset') or 0)
+        return subhints or None
     
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         ''' Return all the statements in the model that match the given arguments.
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.'''
-        statements = []
-        changed = 0
-        _hints = hints and hints.copy() or {}
-        for model in self.models:
-            _hints = self._handleHints(_hints, len(statements))
-            if _hints == 'done':
-                break
-            
-            moreStatements = model.getStatements(subject, predicate,object,
-                                              objecttype,context, asQuad, _hints)
-            if moreStatements:
-                changed += 1
-                statements.extend(moreStatements)
-
-        if changed > 1 or hints:        
-            statements.sort()
-            return removeDupStatementsFromSortedList(statements, asQuad, 
-                                                            **(hints or {}))
+        #subclasses (e.g. RDFSSchema) might implement iterStatements() with
+        #getStatements() so call ours directly
+        return list(MultiModel.iterStatements(self, subject, predicate, 
+                            object, objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        '''
+        The models' statements are merged as they are read, removing 
+        duplicates, and reading stops once `offset+limit` statements
+        have been found.
+        '''
+        hints = hints or {}
+        if len(self.models) == 1:
+            return self.models[0].iterStatements(subject, predicate, object, 
+                                    objecttype, context, asQuad, hints, ordered)
+        subhints = self._subModelHints(hints)
+        stmts = [model.iterStatements(subject, predicate, object, objecttype, 
+                            context, asQuad, subhints, ordered) 
+                                            for model in self.models]
+        if ordered:
+            stmts = iterUniqueStatements(heapq.merge(*stmts), asQuad)
         else:
-            return statements            
+            stmts = iterUniqueStatements(itertools.chain(*stmts), asQuad, False)
+        return sliceStatements(stmts, hints.get('limit'), hints.get('offset'))
                      
     def addStatement(self, statement ):
         '''add the specified statement to the model'''
@@ -319,14 +515,103 @@ class MultiModel(Model):
         '''removes the statement'''
         return self.models[0].removeStatement( statement)
 
+class _MirrorWriter(object):
+    '''
+    Applies batches of changes to a mirrored model in a background thread.
+    If a request fails the model is rolled back.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.latency = 0.0 #seconds taken by the last batch
+        self.totalLatency = 0.0
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None: #close() was called
+                break
+            func, arg = request
+            if func == self._apply:
+                self.latency = 0.0
+            start = time.time()
+            try:
+                func(arg)
+                result = None
+            except:
+                result = sys.exc_info()
+                try:
+                    self.model.rollback()
+                except:
+                    log.exception('rollback of mirror %r failed', self.model)
+            elapsed = time.time() - start
+            self.latency += elapsed
+            self.totalLatency += elapsed
+            self.results.put(result)
+
+    def _apply(self, changes):
+        for stmt, removed in changes:
+            if removed:
+                self.model.removeStatement(stmt)
+            else:
+                self.model.addStatement(stmt)
+
+    def _commit(self, commitKw):
+        self.model.commit(**commitKw)
+
+    def _rollback(self, arg):
+        self.model.rollback()
+
+    def send(self, changes):
+        self.requests.put( (self._apply, changes) )
+
+    def commit(self, commitKw):
+        self.requests.put( (self._commit, commitKw) )
+
+    def rollback(self):
+        self.requests.put( (self._rollback, None) )
+
+    def wait(self):
+        '''
+        Wait for the last request to finish, returns exc_info if it failed.
+        '''
+        return self.results.get()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
 class MirrorModel(Model):
     '''
     This mirrors updates to multiple models
     Updates are propagated to all models
     Reading is only done from the first model (it assumes all models are identical)
+
+    If `parallel` is True, changes are applied to the first model as they
+    are made but are batched for the other models and sent to each one's
+    own thread when the transaction commits (or right away if autocommit
+    is set). commit() waits for the mirrors to apply the batch, commits 
+    the first model and only then commits the mirrors. If any of them 
+    fails the models that haven't committed are rolled back and the error
+    is raised. In this mode addStatement() and removeStatement() only 
+    report the first model's result. `latencies` has the time each mirror
+    took for its last batch. Call close() to stop the mirrors' threads.
     '''
-    def __init__(self, *models):
+    parallel = False
+    _writers = ()
+    
+    def __init__(self, *models, **kw):
         self.models = models
+        if kw.get('parallel'):
+            self.parallel = True
+            self._writers = [_MirrorWriter(model) for model in models[1:]]
+            self._pending = []
+
+    latencies = property(lambda self: [w.latency for w in self._writers])
 
     #autocommit is false if any model has autocommit == false
     autocommit = property(
@@ -336,21 +621,105 @@ class MirrorModel(Model):
     
     #true if true for all models
     updateAdvisory = property(lambda self: all(m.updateAdvisory for m in self.models) )
+
+    ordering = property(lambda self: self.models[0].ordering)
+
+    def getStatistics(self):
+        return self.models[0].getStatistics()
     
     def commit(self, **kw):
+        if self.parallel:
+            self._sendPending(kw)
+            return
         for model in self.models:
             model.commit(**kw)
 
     def rollback(self):
+        if self.parallel:
+            self._pending = []
         for model in self.models:
             model.rollback()
+
+    def close(self):
+        '''
+        Stop the threads used to write to the mirrors.
+        '''
+        for writer in self._writers:
+            writer.close()
+        self._writers = ()
+
+    def _waitForWriters(self):
+        '''
+        Wait for each mirror to finish its request, returns the exc_info 
+        of the first one that failed.
+        '''
+        error = None
+        for writer in self._writers:
+            result = writer.wait()
+            if result and not error:
+                error = result
+        return error
+
+    def _sendPending(self, commitKw=None):
+        '''
+        Send the pending changes to the mirrors and, if `commitKw` isn't 
+        None, commit the first model and then the mirrors once they've all 
+        applied the changes.
+        '''
+        changes, self._pending = self._pending, []
+        for writer in self._writers:
+            writer.send(changes)
+        error = self._waitForWriters()
+        log.debug('mirror latencies for %d changes: %s', 
+                                                len(changes), self.latencies)
+        if commitKw is not None:
+            if error:
+                self.models[0].rollback()
+                for writer in self._writers:
+                    writer.rollback()
+                self._waitForWriters()
+            else:
+                try:
+                    self.models[0].commit(**commitKw)
+                except:
+                    for writer in self._writers:
+                        writer.rollback()
+                    self._waitForWriters()
+                    raise
+                for writer in self._writers:
+                    writer.commit(commitKw)
+                error = self._waitForWriters()
+        if error:
+            raise error[0], error[1], error[2]
+
+    def _change(self, statement, removed):
+        if removed:
+            retval = self.models[0].removeStatement(statement)
+        else:
+            retval = self.models[0].addStatement(statement)
+        self._pending.append( (statement, removed) )
+        if self.autocommit:
+            self._sendPending()
+        return retval
                             
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         return self.models[0].getStatements(subject, predicate, object,
                                             objecttype,context, asQuad)
                      
+    def addStatements(self, statements):
+        if not self.parallel:
+            return Model.addStatements(self, statements)
+        #send them to the mirrors as one batch even if autocommit is set
+        statements = list(statements)
+        self.models[0].addStatements(statements)
+        self._pending.extend([(stmt, False) for stmt in statements])
+        if self.autocommit:
+            self._sendPending()
+
     def addStatement(self, statement ):
+        if self.parallel:
+            return self._change(statement, False)
         retval = False
         for model in self.models:            
             if model.addStatement( statement ):
@@ -358,6 +727,8 @@ class MirrorModel(Model):
         return retval
         
     def removeStatement(self, statement ):
+        if self.parallel:
+            return self._change(statement, True)
         retval = False
         for model in self.models:
             if model.removeStatement( statement ):
@@ -401,58 +772,85 @@ class TransactionModel(object):
         def addStatement(self, stmt): ...
         
     TransactionalMyModel(TransactionModel, MyModel): pass
+
+    `queue` is the list of changes in the order they were made (cancelled 
+    changes are set to None). The added statements are also kept in an 
+    in-memory store and the removed ones in a set so reads can merge them
+    in without scanning the queue.
     '''
     queue = None 
     updateAdvisory = False
+    #filterJoin() wouldn't see the changes in the queue
+    canHandleJoins = False
     
     def __init__(self, *args, **kw):
         #don't create a transaction for the initial statements
         self.autocommit = True 
         super(TransactionModel, self).__init__(*args, **kw)
         self.autocommit = False
+        self._resetQueue()
+
+    def _resetQueue(self):
+        from vesper.data.store.basic import MemStore
+        self.queue = []
+        #maps each change to its positions in the queue
+        self._queuePositions = {}
+        self._added = MemStore()
+        self._removed = set()
+
+    def _hasChanges(self):
+        return bool(self._queuePositions)
 
     def commit(self, **kw):    
-        if not self.queue:
+        if not self._hasChanges():
             self.txnState = TxnState.BEGIN
+            self._resetQueue()
             return
+        self._writeQueue()
+        super(TransactionModel, self).commit(**kw)
+
+        self._resetQueue()
+
+    def _writeQueue(self):
+        '''
+        Apply the queued changes to the underlying model, in order.
+        '''
         for stmt in self.queue:
+            if stmt is None:
+                continue
             if stmt[0] is Removed:
                 super(TransactionModel, self).removeStatement( stmt[1] )
             else:
                 assert len(stmt) == 1
                 super(TransactionModel, self).addStatement( stmt[0] )
-        super(TransactionModel, self).commit(**kw)
-
-        self.queue = []
         
     def rollback(self):        
         if self.autocommit:
             super(TransactionModel, self).rollback()
         else:
             self.txnState = TxnState.BEGIN
-        self.queue = []
+        self._resetQueue()
 
-    def _match(self, stmt, subject = None, predicate = None, object = None,
-                                               objectType=None,context=None):
-        if subject and stmt.subject != subject:
-            return False
-        if predicate and stmt.predicate != predicate:
-            return False
-        if object is not None:
-            if objectType is None:
-                if isinstance(object, ResourceUri):
-                    object = object.uri
-                    objectType = OBJECT_TYPE_RESOURCE
-                elif stmt.objectType == OBJECT_TYPE_RESOURCE:
-                    return False
-            if stmt.object != object:
-                return False
-
-        if objectType is not None and stmt.objectType != objectType:
-            return False
-        if context is not None and stmt.scope != context:
+    def _queueChange(self, change, cancels):
+        '''
+        Append the change to the queue unless it cancels out an earlier 
+        change. Returns False if it cancelled a change.
+        '''
+        positions = self._queuePositions.get(cancels)
+        if positions:
+            self.queue[positions.pop()] = None
+            if not positions:
+                del self._queuePositions[cancels]
             return False
+        self._queuePositions.setdefault(change, []).append(len(self.queue))
+        self.queue.append(change)
         return True
+
+    def _removedKey(self, stmt):
+        #a Triple doesn't compare the scope
+        if isinstance(stmt, Triple):
+            return tuple(stmt[:4])
+        return stmt
         
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
@@ -460,38 +858,51 @@ class TransactionModel(object):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
-        statements = super(TransactionModel, self).getStatements(subject,
+        if not self._hasChanges(): 
+            return super(TransactionModel, self).getStatements(subject,
                                 predicate, object,objecttype,context, asQuad,hints)
-        if not self.queue: 
-            return statements
-
-        #avoid phantom reads, etc.
-        changed = False
-        for stmt in self.queue:
-            if stmt[0] is Removed:
-                stmt = stmt[1] 
-                if self._match(stmt, subject, predicate, object,
-                                               objecttype,context):
-                    try:                        
-                        i = 0
-                        while 1:
-                            i = statements.index(stmt, i)                            
-                            del statements[i]
-                            changed = True
-                            i+=1
-                    except ValueError:
-                        pass
-            else:
-                if self._match(stmt[0], subject, predicate, object,
-                                               objecttype,context):
-                    changed = True
-                    statements.append( stmt[0] )
-
-        if changed:        
-            statements.sort()
-            return removeDupStatementsFromSortedList(statements, asQuad, **(hints or {}))
+        return list(self._mergeChanges(subject, predicate, object, objecttype,
+                                                    context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        if not self._hasChanges():
+            return super(TransactionModel, self).iterStatements(subject, 
+                    predicate, object,objecttype, context, asQuad,hints,ordered)
+        return self._mergeChanges(subject, predicate, object, objecttype,
+                                            context, asQuad, hints, ordered)
+
+    def _mergeChanges(self, subject, predicate, object, objecttype, context,
+                                            asQuad, hints, ordered=True):
+        '''
+        Merge the added statements into the underlying model's statements 
+        and skip the removed ones. Both are already sorted so no sort is
+        needed.
+        '''
+        hints = hints or {}
+        iterStatements = super(TransactionModel, self).iterStatements
+        if getattr(iterStatements, 'im_func', None) is Model.iterStatements.im_func:
+            #the default implementation would call our getStatements()
+            stmts = iter(super(TransactionModel, self).getStatements(subject,
+                            predicate, object, objecttype, context, asQuad))
+            ordered = True
         else:
-            return statements
+            stmts = iterStatements(subject, predicate, object,objecttype,
+                                                context, asQuad,None,ordered)
+        removed = self._removed
+        if removed:
+            stmts = (stmt for stmt in stmts if stmt not in removed
+                                        and tuple(stmt[:4]) not in removed)
+        if self._added.size():
+            added = self._added.iterStatements(subject, predicate, object,
+                                            objecttype, context, asQuad)
+            if ordered:
+                stmts = iterUniqueStatements(heapq.merge(stmts, added), asQuad)
+            else:
+                stmts = iterUniqueStatements(itertools.chain(stmts, added),
+                                                            asQuad, False)
+        return sliceStatements(stmts, hints.get('limit'), hints.get('offset'))
 
     def addStatement(self, statement ):
         '''add the specified statement to the model'''        
@@ -501,13 +912,12 @@ class TransactionModel(object):
             self.txnState = TxnState.DIRTY
         
         if self.queue is None: 
-            self.queue = []        
-        try:
-            i = self.queue.index( (Removed, statement))
-            del self.queue[i]            
-        except ValueError:
-            #print 'addingtoqueue'
-            self.queue.append( (statement,) )            
+            self._resetQueue()
+        removal = (Removed, statement)
+        if self._queueChange( (statement,), removal ):
+            self._added.addStatement(statement)
+        elif removal not in self._queuePositions:
+            self._removed.discard(self._removedKey(statement))
         
     def removeStatement(self, statement ):
         '''removes the statement'''        
@@ -517,11 +927,11 @@ class TransactionModel(object):
             self.txnState = TxnState.DIRTY
         
         if self.queue is None: 
-            self.queue = []
-        try:
-            i = self.queue.index((statement,))
-            del self.queue[i]
-        except ValueError:
-            self.queue.append( (Removed, statement) )
+            self._resetQueue()
+        addition = (statement,)
+        if self._queueChange( (Removed, statement), addition ):
+            self._removed.add(self._removedKey(statement))
+        elif addition not in self._queuePositions:
+            self._added.removeStatement(statement)
 
 
@@ -129,6 +129,11 @@ class NamedGraphManager(base.Model):
    
     updateAdvisory = property(lambda self: self.managedModel.updateAdvisory
                                         and self.revisionModel.updateAdvisory)
+
+    ordering = property(lambda self: self.managedModel.ordering)
+
+    def getStatistics(self):
+        return self.managedModel.getStatistics()
     
     def __init__(self, primaryModel, revisionModel, modelUri, lastScope=None):
         '''
@@ -182,7 +187,8 @@ class NamedGraphManager(base.Model):
                 if not asQuad or hints:
                     stmts.sort()
                     stmts = base.removeDupStatementsFromSortedList(stmts, 
-                        asQuad, **hints)
+                        asQuad, limit=hints.get('limit'), 
+                        offset=hints.get('offset'))
             else:
                 stmts = self.managedModel.getStatements(subject, predicate, object,
                     objecttype, context, asQuad, hints)                
@@ -199,7 +205,7 @@ class NamedGraphManager(base.Model):
                     context = None
 
             return model.getStatements(subject, predicate, object,
-                objecttype, context, asQuad, **hints)
+                objecttype, context, asQuad, hints)
 
     def getCurrentContextUri(self):
         return getTxnContextUri(self.modelUri, self.currentVersion)
@@ -57,6 +57,8 @@ class RDFSSchema(BaseSchema, base.MultiModel):
     SUBCLASSOF = u'http://www.w3.org/2000/01/rdf-schema#subClassOf'
 
     inTransaction = False
+    #entailed statements aren't necessarily returned in order
+    ordering = None
     
     findCompatibleStatements = True
     
@@ -687,4 +689,14 @@ class RDFSSchema(BaseSchema, base.MultiModel):
         else:
             return statements            
 
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        if not self.findCompatibleStatements:
+            return super(RDFSSchema, self).iterStatements(subject,
+                    predicate,object,objecttype,context, asQuad, hints, ordered)
+        #entailed statements are only found by getStatements()
+        return base.Model.iterStatements(self, subject, predicate, object,
+                                    objecttype, context, asQuad, hints, ordered)
+
 defaultSchemaClass = BaseSchema #RDFSSchema
@@ -3,7 +3,11 @@
 '''
     Various utility functions and classes for vesper
 '''
-import re, random, urllib2
+import re, random, urllib2, itertools, codecs
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
 try:
     import cStringIO
     StringIO = cStringIO
@@ -203,12 +207,21 @@ def generateBnode(name=None, prefix=''):
     return BNODE_BASE + prefix + _sessionBNodeUUID +  name
         
 def NTriples2Statements(stream, defaultScope='', baseuri=None,
-    charencoding='utf8', incrementHook=None):
+    charencoding='utf8', incrementHook=None, parallel=False):
+    '''
+    If `parallel` is True (or the number of processes to use) large
+    files are parsed in chunks by a pool of processes
+    (see `parseTriplesParallel`).
+    '''
     makebNode = lambda bNode: BNODE_BASE + bNode
     stmtset = {}
-    for stmt in parseTriples(
-        stream,  makebNode, charencoding=charencoding, baseuri=baseuri,
-        yieldcomments=incrementHook):        
+    if parallel and not incrementHook:
+        stmts = parseTriplesParallel(stream.read(), baseuri, charencoding,
+                                                                    parallel)
+    else:
+        stmts = parseTriples(stream,  makebNode, charencoding=charencoding,
+                            baseuri=baseuri, yieldcomments=incrementHook)
+    for stmt in stmts:
         if stmt[0] is Removed:
             stmt, forContext = stmt[1], stmt[2]
             if incrementHook:
@@ -699,6 +712,66 @@ def parseTriples(lines, bNodeToURI = lambda x: x, charencoding='utf8',
             yield (subject, predicate, object, objectType, graph)
         graph = None
 
+#don't bother parallelizing smaller than this
+PARALLEL_PARSE_MIN_SIZE = 1024*1024
+_blankLineRe = re.compile(r'^[ \t\r\f\v]*$', re.M)
+
+def _makebNode(bNode):
+    return BNODE_BASE + bNode
+
+def _parseTriplesChunk(args):
+    chunk, baseuri, charencoding, assumeJson = args
+    lines = StringIO.StringIO(chunk)
+    if assumeJson:
+        lines = itertools.chain(['#!json'], lines)
+    return list(parseTriples(lines, _makebNode, charencoding, baseuri))
+
+def parseTriplesParallel(contents, baseuri=None, charencoding='utf8',
+                                                        processes=True):
+    '''
+    Parses the NTriples (or ntjson) string by splitting it into chunks of 
+    lines that are parsed by a pool of `processes` (or one per cpu if True).
+    Returns the same statements in the same order as `parseTriples`.
+    
+    Falls back to `parseTriples` if `contents` is small or has #!remove 
+    or #!graph directives since those depend on the preceding lines.
+    '''
+    if processes is True:
+        processes = multiprocessing and multiprocessing.cpu_count()
+    #parseTriples stops at the first blank line
+    match = _blankLineRe.search(contents)
+    if match:
+        contents = contents[:match.start()]
+    ##!json is only ok if it is on the first line
+    assumeJson = contents.startswith('#!json')
+    if (multiprocessing is None or processes < 2 or len(contents) < PARALLEL_PARSE_MIN_SIZE
+            or '#!remove' in contents or '#!graph' in contents
+            or contents.find('#!json', assumeJson and 1 or 0) > -1):
+        return parseTriples(StringIO.StringIO(contents), _makebNode, 
+                                                charencoding, baseuri)
+
+    chunkSize = len(contents) // (processes * 4) + 1
+    chunks = []
+    start = 0
+    while start < len(contents):
+        end = contents.find('\n', start + chunkSize)
+        if end == -1:
+            end = len(contents)
+        else:
+            end += 1
+        chunks.append( (contents[start:end], baseuri, charencoding, assumeJson) )
+        start = end
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_parseTriplesChunk, chunks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return itertools.chain.from_iterable(results)
+
 def _parseNTriplesLine(line, baseuri, bNodeToURI):
     subject, predicate, object = line.split(None,2)
     if subject.startswith('_:'):
@@ -750,104 +823,123 @@ def _parseNTriplesLine(line, baseuri, bNodeToURI):
 
     return subject, predicate, object, objectType
                    
-def writeTriples(stmts, stream, enc='utf8', writejson=False):
+_wspcRe = re.compile(r'\s')
+#python escape sequences that need fixing and characters that need escaping
+_escapingRe = re.compile(r'(\\\\)|(\\x[\da-f]{2})|(\\u[\da-f]{4})'
+                             r'|(\\U[\da-f]{8})|([\0-\31"])')
+#literals without any of these characters can be written as is
+_utf8UnsafeRe = re.compile(ur'[\\\x00-\x19"]')
+_asciiUnsafeRe = re.compile(ur'[^\x1a-\x21\x23-\x5b\x5d-\x7e]')
+_escapes = { '\n' : r'\n', '\r' : r'\r', '\t' : r'\t', '"' : r'\"' }
+
+def _fixEscaping(match):
+    #fix differences between python and ntriples escaping:
+    #* ascii range is escaped as \xXX instead of \u00XX,
+    #* hex digits are lowercase instead of upper
+    s = match.group(0)
+    if s[0] == '\\':
+        if s == r'\\':
+            return r'\\'
+        elif s[1] == 'x':
+            return r'\u00' + s[2:].upper()
+        else:
+            assert s[1] in ('U','u')
+            return '\\' + s[1] + s[2:].upper()
+    else:
+        escape = _escapes.get(s)
+        if escape is None:
+            escape = '\u00' + hex(ord(s))[2:].upper()
+        return escape
+
+def writeTriples(stmts, stream, enc='utf8', writejson=False, bufferSize=1000):
     r'''
     stmts is an iterable of statements (or the equivalent tuples)
 
     Note that the default encoding is 'utf8'; to conform with standard NTriples spec,
     use 'ascii' instead.
+
+    Output is buffered and written to the stream every `bufferSize` lines.
     '''
-    subject = 0
-    predicate = 1
-    object = 2
-    objectType = 3
-    scope = 4
-    
     if writejson:
         stream.write("#!json\n")
     
-    wspcProg = re.compile(r'\s')
+    wspcSearch = _wspcRe.search
+    if codecs.lookup(enc).name == 'utf-8':
+        unsafeSearch = _utf8UnsafeRe.search
+    else:
+        unsafeSearch = _asciiUnsafeRe.search
+    out = []
+    write = out.append
+    try:
+        for stmt in stmts:
+            if len(out) > bufferSize:
+                stream.write(''.join(out))
+                del out[:]
 
-    for stmt in stmts:       
-        if stmt[0] is Comment:
-            stream.write("#" + stmt[1].encode(enc, 'backslashreplace') + "\n")
-            continue
-        if stmt[0] is Removed:
-            stmt = stmt[1]
-            if getattr(stmt, 'removeForContext', False): #hack
-                stream.write("#!remove "+stmt[scope].encode(enc)+"\n")
-            else:
-                stream.write("#!remove\n")
- 
-        for i in range(5):
-            if i == object and stmt[objectType] != OBJECT_TYPE_RESOURCE:
+            subject = stmt[0]
+            if subject is Comment:
+                write("#" + stmt[1].encode(enc, 'backslashreplace') + "\n")
                 continue
-            if wspcProg.search(stmt[i]): 
-                raise RuntimeError("unable to write NTriples, statement "
-                    "contains an invalid URI: %s" % stmt[i])
-                      
-        if stmt[scope]: 
-            stream.write("#!graph "+stmt[scope].encode(enc)+"\n")
-        
-        if writejson:
-            stream.write(stmt2json(stmt)+'\n')
-            continue                   
-            
-        if stmt[subject].startswith(BNODE_BASE):
-            stream.write('_:' + stmt[subject][BNODE_BASE_LEN:].encode(enc) ) 
-        else:
-            subjectURI = stmt[subject]
-            stream.write("<" + subjectURI.encode(enc) + ">")
+            if subject is Removed:
+                stmt = stmt[1]
+                subject = stmt[0]
+                if getattr(stmt, 'removeForContext', False): #hack
+                    write("#!remove "+stmt[4].encode(enc)+"\n")
+                else:
+                    write("#!remove\n")
+
+            predicate, object, objectType, scope = stmt[1:5]
+            isResource = objectType == OBJECT_TYPE_RESOURCE
+            if (wspcSearch(subject) or wspcSearch(predicate)
+                    or (isResource and wspcSearch(object))
+                    or wspcSearch(objectType) or wspcSearch(scope)):
+                for i in range(5):
+                    if i == 2 and not isResource:
+                        continue
+                    if wspcSearch(stmt[i]): 
+                        raise RuntimeError("unable to write NTriples, statement "
+                            "contains an invalid URI: %s" % stmt[i])
+
+            if scope: 
+                write("#!graph "+scope.encode(enc)+"\n")
             
-        if stmt[predicate].startswith(BNODE_BASE):
-            stream.write( '_:' + stmt[predicate][BNODE_BASE_LEN:].encode(enc) ) 
-        else:            
-            stream.write(" <" + stmt[predicate].encode(enc) + ">")
-        if stmt[objectType] == OBJECT_TYPE_RESOURCE:
-            if stmt[object].startswith(BNODE_BASE):
-                stream.write(' _:' + stmt[object][BNODE_BASE_LEN:].encode(enc)  + " .\n") 
+            if writejson:
+                write(stmt2json(stmt)+'\n')
+                continue                   
+                
+            if subject.startswith(BNODE_BASE):
+                write('_:' + subject[BNODE_BASE_LEN:].encode(enc) ) 
             else:
-                stream.write(" <" + stmt[object].encode(enc)  + "> .\n")
-        else:
-            objval = stmt[object]
-            if isinstance(objval, str):
-                objval = objval.decode('utf8')
-            escaped = objval.replace('\\', r'\\').encode(enc, 'backslashreplace')
-            #fix differences between python and ntriples escaping:
-            #* ascii range is escaped as \xXX instead of \u00XX,
-            #* hex digits are lowercase instead of upper
-            def fixEscaping(match):
-                s = match.group(0)
-                if s[0] == '\\':
-                    if s == r'\\':
-                        return r'\\'
-                    elif s[1] == 'x':
-                        return r'\u00' + s[2:].upper()
-                    else:
-                        assert s[1] in ('U','u')
-                        return '\\' + s[1] + s[2:].upper()
-                elif s[0] == '\n':
-                    return r'\n'
-                elif s[0] == '\r':
-                    return r'\r'
-                elif s[0] == '\t':
-                    return r'\t'
-                elif s[0] == '"':
-                    return r'\"'
+                write("<" + subject.encode(enc) + ">")
+                
+            if predicate.startswith(BNODE_BASE):
+                write( '_:' + predicate[BNODE_BASE_LEN:].encode(enc) ) 
+            else:            
+                write(" <" + predicate.encode(enc) + ">")
+            if isResource:
+                if object.startswith(BNODE_BASE):
+                    write(' _:' + object[BNODE_BASE_LEN:].encode(enc)  + " .\n") 
                 else:
-                    return '\u00' + hex(ord(s[0]))[2:].upper()
-                                
-            escaped = re.sub(r'(\\\\)|(\\x[\da-f]{2})|(\\u[\da-f]{4})'
-                             r'|(\\U[\da-f]{8})|([\0-\31"])', fixEscaping, escaped)
-           
-            if stmt[objectType] == OBJECT_TYPE_LITERAL:
-                stream.write(' "' + escaped + '" .\n')
-            elif stmt[objectType].find(':') == -1: #must be a lang code
-                stream.write(' "' + escaped + '"@' + stmt[objectType].encode(enc))
-                stream.write(" .\n")
-            else: #objectType must be a RDF datatype
-                stream.write(' "' + escaped + '"^^' + stmt[objectType].encode(enc))
-                stream.write(" .\n")
+                    write(" <" + object.encode(enc)  + "> .\n")
+            else:
+                if isinstance(object, str):
+                    object = object.decode('utf8')
+                if unsafeSearch(object):
+                    escaped = object.replace('\\', r'\\').encode(enc, 'backslashreplace')
+                    escaped = _escapingRe.sub(_fixEscaping, escaped)
+                else: #nothing to escape
+                    escaped = object.encode(enc)
+
+                if objectType == OBJECT_TYPE_LITERAL:
+                    write(' "' + escaped + '" .\n')
+                elif objectType.find(':') == -1: #must be a lang code
+                    write(' "' + escaped + '"@' + objectType.encode(enc) + " .\n")
+                else: #objectType must be a RDF datatype
+                    write(' "' + escaped + '"^^' + objectType.encode(enc) + " .\n")
+    finally:
+        #write out what we have even if there was an error
+        if out:
+            stream.write(''.join(out))
 
 def peekpair(seq):
     '''
@@ -8,6 +8,7 @@ _proto_map = { # XXX don't hardcode this
     'tyrant':'vesper.data.store.tyrant.TransactionTyrantStore',
     'file':'vesper.data.store.basic.FileStore',
     'mem':'vesper.data.store.basic.MemStore',
+    'encodedmem':'vesper.data.store.basic.EncodedMemStore',
     'bdb':'vesper.data.store.bdb.TransactionBdbStore',
     'sqlite':'vesper.data.store.sqlite.TransactionSqliteStore'
 }
@@ -1,21 +1,35 @@
 #:copyright: Copyright 2009-2010 by the Vesper team, see AUTHORS.
 #:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
 from vesper.data.base import * # XXX
+import itertools, gc
+import struct, array
+import threading, shutil
+from operator import itemgetter
 
 class MemStore(Model):
     '''
     simple in-memory module
     '''
     updateAdvisory = True
+    #statements are returned sorted so rows are ordered by subject
+    ordering = 0
+    #the value stored in the objecttype slot of a row for resources
+    _resourceType = OBJECT_TYPE_RESOURCE
     
-    def __init__(self,defaultStatements=None, **kw):
+    def __init__(self,defaultStatements=None, statistics=False, **kw):
+        if statistics:
+            self.statistics = Statistics()
         self.by_s = {}
         self.by_p = {}
         self.by_o = {}
+        #composite indexes keyed by (subject, predicate), (predicate, object)
+        #and (object, subject)
+        self.by_sp = {}
+        self.by_po = {}
+        self.by_os = {}
         self.by_c = {}
         if defaultStatements:
-            for stmt in defaultStatements:
-                MemStore.addStatement(self, stmt)
+            self.bulkLoad(defaultStatements)
 
     def size(self):
         return len(self.by_s)
@@ -27,110 +41,354 @@ class MemStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''        
+        return list(MemStore.iterStatements(self, subject, predicate, object, 
+                                        objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        '''
+        If `ordered` is False the statements are read directly from the 
+        indexes so the store shouldn't be modified while iterating.
+        '''
+        hints = hints or {}
+        if isinstance(object, ResourceUri):
+            object = object.uri
+            objecttype = OBJECT_TYPE_RESOURCE
+        stmts = None
+        values = object is None and findPredicate(hints, 'in')
+        if values:
+            stmts = self._iterRowsIn(subject, predicate, values, 
+                                                    objecttype, context)
+        if stmts is None:
+            args = self._encodeArgs(subject, predicate, object, objecttype, 
+                                                                    context)
+            if args is None:
+                return iter(())
+            stmts = self._iterRows(*args)
+        if self._decode:
+            stmts = itertools.imap(self._decode, stmts)
+        if ordered:
+            stmts = sorted(stmts)
+        if not asQuad:
+            stmts = iterUniqueStatements(stmts, asQuad, ordered)
+        #rows are unique so we don't need to remove duplicate quads
+        return sliceStatements(stmts, hints.get('limit'), hints.get('offset'))
+
+    def _iterRowsIn(self, subject, predicate, values, objecttype, context):
+        '''
+        Look up the rows for each of the object values of an 'in' predicate.
+        Returns None if a value's statements can't be looked up by the object.
+        '''
+        objects = []
+        for value in values:
+            if isinstance(value, ResourceUri):
+                objects.append( (value.uri, objecttype or OBJECT_TYPE_RESOURCE) )
+            elif isinstance(value, (str, unicode)):
+                objects.append( (value, objecttype) )
+            else:
+                #other json values (including unhashable ones like lists 
+                #and dicts) are compared by value, not text
+                return None
+        lookups = []
+        for args in set(objects):
+            args = self._encodeArgs(subject, predicate, args[0], args[1], 
+                                                                    context)
+            if args is not None:
+                lookups.append(args)
+        return itertools.chain(*[self._iterRows(*args) for args in lookups])
+
+    def _encodeArgs(self, *args):
+        '''
+        Convert the given values to the values stored in the index's rows. 
+        Returns None if no row could match.
+        '''
+        return args
+
+    #function that converts a row to a Statement, if needed
+    _decode = None
+
+    def _findRows(self, subject, predicate, object, objecttype, context):
+        '''
+        Return an unsorted list of the rows in the indexes that match the 
+        given (already encoded) values, None is treated as a wildcard.
+        '''
+        return list(self._iterRows(subject, predicate, object, objecttype, context))
+
+    def _iterRows(self, subject, predicate, object, objecttype, context):
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
         fot = objecttype is not None
         fc = context is not None
-        hints = hints or {}
-        limit=hints.get('limit')
-        offset=hints.get('offset')
-        checkLiteral = False
-        if fo:
-            if isinstance(object, ResourceUri):
-                object = object.uri
-                fot = True
-                objecttype = OBJECT_TYPE_RESOURCE
-            elif not fot:
-                checkLiteral = True
-
-        if not fc:
-            if fs:                
-                stmts = self.by_s.get(subject,[])            
-            elif fo:
-                stmts = self.by_o.get(object, [])
-            elif fp:
-                stmts = self.by_p.get(predicate, [])
+        checkLiteral = fo and not fot
+        resourceType = self._resourceType
+
+        if fs and fp:
+            stmts = self.by_sp.get((subject, predicate), ())
+        elif fp and fo:
+            stmts = self.by_po.get((predicate, object), ())
+        elif fo and fs:
+            stmts = self.by_os.get((object, subject), ())
+        elif fs:
+            stmts = self.by_s.get(subject, ())
+        elif fo:
+            stmts = self.by_o.get(object, ())
+        elif fp:
+            stmts = self.by_p.get(predicate, ())
+        elif not fc:
+            #get all
+            stmts = itertools.chain.from_iterable(self.by_s.itervalues())
+            if fot:
+                return (s for s in stmts if s[3] == objecttype)
             else:
-                #get all
-                stmts = utils.flattenSeq(self.by_s.itervalues(), 1)
-                if fot:
-                    stmts = [s for s in stmts if s.objectType == objecttype]
-                else:
-                    stmts = list(stmts)
-                stmts.sort()
-                return removeDupStatementsFromSortedList(stmts,asQuad,
-                                                    limit=limit,offset=offset)
-        else:            
+                return stmts
+        else:
+            stmts = None
+
+        if fc:
             by_cAnds = self.by_c.get(context)
             if not by_cAnds:
-                return []
-            if fs:                
-                stmts = by_cAnds.get(subject,[])
-            else:
-                stmts = utils.flattenSeq(by_cAnds.itervalues(), 1)
+                return iter(())
+            if fs:
+                cstmts = by_cAnds.get(subject, ())
+                if len(cstmts) < len(stmts):
+                    stmts = cstmts
+            elif stmts is None or len(stmts) >= len(by_cAnds):
+                #the context has at least one statement per subject so
+                #only scan it if the index's bucket is bigger than that
+                stmts = itertools.chain.from_iterable(by_cAnds.itervalues())
                 
-        stmts = [s for s in stmts 
-                    if (not fs or s.subject == subject)
-                    and (not fp or s.predicate == predicate)
-                    and (not fo or s.object == object)
-                    and (not fot or s.objectType == objecttype)
-                    and (not checkLiteral or s.objectType != OBJECT_TYPE_RESOURCE)
-                    and (not fc or s.scope == context)]
-        stmts.sort()
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
+        return (s for s in stmts 
+                    if (not fs or s[0] == subject)
+                    and (not fp or s[1] == predicate)
+                    and (not fo or s[2] == object)
+                    and (not fot or s[3] == objecttype)
+                    and (not checkLiteral or s[3] != resourceType)
+                    and (not fc or s[4] == context))
                      
     def addStatement(self, stmt ):
         '''add the specified statement to the model'''            
-        if not isinstance(stmt, BaseStatement):
-            stmt = Statement(*stmt)
+        if not isinstance(stmt, Statement) or isinstance(stmt, Triple):
+            #index buckets are hashed so make sure the statement's hash 
+            #and equality include all its slots
+            stmt = Statement(*stmt[:5])
         assert isinstance(stmt.object, (str, unicode)), 'bad object %r, objectType %s' % (stmt.object, stmt.objectType)
-        if stmt in self.by_c.get(stmt[4], {}).get(stmt[0], []):
+        return self._addRow(stmt)
+
+    def bulkLoad(self, stmts):
+        '''
+        Add the statements directly to the indexes, bypassing `addStatement()`.
+        This is much faster than adding statements one at a time
+        (e.g. when loading a file) but it isn't transactional: subclasses'
+        `addStatement()` isn't called.
+        Returns the number of statements added.
+        '''
+        return self._addRows(self._toRows(stmts))
+
+    def _toRows(self, stmts):
+        for stmt in stmts:
+            if not isinstance(stmt, Statement) or isinstance(stmt, Triple):
+                stmt = Statement(*stmt[:5])
+            assert isinstance(stmt[2], (str, unicode)), 'bad object %r, objectType %s' % (stmt[2], stmt[3])
+            yield stmt
+
+    def _addRows(self, rows):
+        by_c = self.by_c
+        indexes = ((self.by_s, itemgetter(0)), (self.by_p, itemgetter(1)), 
+            (self.by_o, itemgetter(2)), (self.by_sp, itemgetter(0, 1)), 
+            (self.by_po, itemgetter(1, 2)), (self.by_os, itemgetter(2, 0)))
+        added = 0
+        statistics = self.statistics
+        #creating lots of index buckets triggers needless garbage collections
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            for row in rows:
+                by_cAnds = by_c.get(row[4])
+                if by_cAnds is None:
+                    by_cAnds = by_c[row[4]] = {}
+                bucket = by_cAnds.get(row[0])
+                if bucket is None:
+                    by_cAnds[row[0]] = {row : None}
+                elif row in bucket:
+                    continue #duplicate
+                else:
+                    bucket[row] = None
+                added += 1
+                if statistics is not None:
+                    statistics.add(row)
+                for index, key in indexes:
+                    k = key(row)
+                    bucket = index.get(k)
+                    if bucket is None:
+                        index[k] = {row : None}
+                    else:
+                        bucket[row] = None
+        finally:
+            if gcEnabled:
+                gc.enable()
+        return added
+
+    def _addRow(self, stmt):
+        #each index bucket is a dict used as a set (the values are None)
+        by_cAnds = self.by_c.setdefault(stmt[4], {})
+        bucket = by_cAnds.get(stmt[0])
+        if bucket is None:
+            bucket = by_cAnds[stmt[0]] = {}
+        elif stmt in bucket:
             return False#statement already in
-        self.by_s.setdefault(stmt[0], []).append(stmt)
-        self.by_p.setdefault(stmt[1], []).append(stmt)
-        self.by_o.setdefault(stmt[2], []).append(stmt)
-        self.by_c.setdefault(stmt[4], {}).setdefault(stmt[0], []).append(stmt)
+        bucket[stmt] = None
+        self.by_s.setdefault(stmt[0], {})[stmt] = None
+        self.by_p.setdefault(stmt[1], {})[stmt] = None
+        self.by_o.setdefault(stmt[2], {})[stmt] = None
+        self.by_sp.setdefault((stmt[0], stmt[1]), {})[stmt] = None
+        self.by_po.setdefault((stmt[1], stmt[2]), {})[stmt] = None
+        self.by_os.setdefault((stmt[2], stmt[0]), {})[stmt] = None
+        if self.statistics is not None:
+            self.statistics.add(stmt)
         return True
         
     def removeStatement(self, stmt ):
         '''removes the statement'''
-        stmts = self.by_s.get(stmt[0])
-        if not stmts:
-            return False
-        try:
-            stmts.remove(stmt)
-        except ValueError:
-            return False  
-        self.by_p[stmt[1]].remove(stmt)
-        self.by_o[stmt[2]].remove(stmt)
-        try:
-            self.by_c[stmt[4]][stmt[0]].remove(stmt)
-        except (ValueError,KeyError):
-            #this can happen since scope isn't part of the stmt's key
-            for subjectDict in self.by_c.values():
-                stmts = subjectDict.get(stmt[0],[])
-                try:
-                    stmts.remove(stmt)
-                except ValueError:
-                    pass
-                else:
-                    return True
+        return self._removeRow(stmt)
+
+    def _removeRow(self, stmt):
+        by_cAnds = self.by_c.get(stmt[4])
+        if not by_cAnds or stmt not in by_cAnds.get(stmt[0], ()):
+            #this can happen if stmt's equality doesn't include the scope
+            #(e.g. a Triple) so look for the stored row that equals it
+            for row in self.by_sp.get((stmt[0], stmt[1]), ()):
+                if row == stmt:
+                    stmt = row
+                    by_cAnds = self.by_c[stmt[4]]
+                    break
+            else:
+                return False
+
+        def discard(index, key):
+            bucket = index[key]
+            del bucket[stmt]
+            if not bucket:
+                del index[key]
+
+        discard(by_cAnds, stmt[0])
+        if not by_cAnds:
+            del self.by_c[stmt[4]]
+        discard(self.by_s, stmt[0])
+        discard(self.by_p, stmt[1])
+        discard(self.by_o, stmt[2])
+        discard(self.by_sp, (stmt[0], stmt[1]))
+        discard(self.by_po, (stmt[1], stmt[2]))
+        discard(self.by_os, (stmt[2], stmt[0]))
+        if self.statistics is not None:
+            self.statistics.remove(stmt)
         return True
 
 class TransactionMemStore(TransactionModel, MemStore): pass
+
+class EncodedMemStore(MemStore):
+    '''
+    A MemStore that dictionary-encodes its statements: each URI or literal
+    is interned once as an integer id and the indexes hold tuples of these ids.
+    Statements are only decoded when they are returned by `getStatements()`. 
+    Use this when the store holds many statements that repeat the same 
+    predicates, types and values.
+    
+    Note that terms are never removed from the term dictionary.
+    '''
+    
+    def __init__(self, defaultStatements=None, **kw):
+        self.termIds = {} #term => id
+        self.terms = [] #id => term
+        self._resourceType = self._intern(OBJECT_TYPE_RESOURCE)
+        MemStore.__init__(self, defaultStatements, **kw)
+        if self.statistics is not None:
+            #the statistics count the ids
+            self.statistics.encodeTerm = self.termIds.get
+
+    def _intern(self, term):
+        termId = self.termIds.get(term)
+        if termId is None:
+            termId = self.termIds[term] = len(self.terms)
+            self.terms.append(term)
+        return termId
+
+    def _encode(self, stmt):
+        '''
+        Return the statement as a tuple of ids or None if any of its terms 
+        isn't in the term dictionary
+        '''
+        termIds = self.termIds
+        row = tuple(termIds.get(term) for term in stmt[:5])
+        if None in row:
+            return None
+        return row
+
+    def _decode(self, row):
+        terms = self.terms
+        return tuple.__new__(Statement, [terms[i] for i in row])
+
+    def _encodeArgs(self, *args):
+        termIds = self.termIds
+        encoded = []
+        for term in args:
+            if term is not None:
+                term = termIds.get(term)
+                if term is None: #not in the store so nothing can match
+                    return None
+            encoded.append(term)
+        return encoded
+
+    def addStatement(self, stmt):
+        '''add the specified statement to the model'''
+        if not isinstance(stmt, BaseStatement):
+            stmt = Statement(*stmt)
+        assert isinstance(stmt.object, (str, unicode)), 'bad object %r, objectType %s' % (stmt.object, stmt.objectType)
+        intern = self._intern
+        return self._addRow(tuple(intern(term) for term in stmt))
+
+    def _toRows(self, stmts):
+        intern = self._intern
+        for stmt in MemStore._toRows(self, stmts):
+            yield tuple([intern(term) for term in stmt])
+
+    def removeStatement(self, stmt):
+        '''removes the statement'''
+        row = self._encode(stmt)
+        if row is None:
+            return False
+        return self._removeRow(row)
+
+class TransactionEncodedMemStore(TransactionModel, EncodedMemStore): pass
     
 class FileStore(MemStore):
     '''
     Reads the file into memory and write out 
     '''    
     autocommit = False
+    delta = False
+    deltaFoldSize = None
+    deltaFoldRatio = 0.1
+    #stat of the delta file when we last read or wrote it
+    deltaMtime = 0
+    deltaSize = 0
     
     def __init__(self, source, defaultStatements=(), context='',
            incrementHook=None, serializeOptions=None, parseOptions=None, 
-           checkForExternalChanges=True, **kw):
+           checkForExternalChanges=True, snapshot=False, delta=False,
+           deltaFoldSize=None, deltaFoldRatio=None, **kw):
+        '''
+        If `snapshot` is True a binary snapshot of the store is saved
+        next to the file (at `path`.snapshot) and loaded instead of parsing 
+        the file if the file hasn't changed since the snapshot was saved. 
+
+        If `delta` is True commit appends just the changes to a NTriples 
+        sidecar file (at `path`.delta) instead of rewriting the whole file.
+        The sidecar is replayed on load and folded back into the file 
+        (by rewriting it) when it grows larger than `deltaFoldSize` bytes or
+        `deltaFoldRatio` times the size of the file.
+        '''
         self.initialContext = context
         self.defaultStatements = defaultStatements
         self.checkForExternalChanges = checkForExternalChanges
@@ -150,11 +408,20 @@ class FileStore(MemStore):
             parseOptions['saveOrder'] = preserveOrder
             pjsonOptions['saveOrder'] = preserveOrder
         self.serializeOptions = serializeOptions
+        #snapshots don't record the order of statements or call incrementHook
+        self.snapshot = snapshot and not kw.get('preserveOrder') and not incrementHook
+        #the delta isn't ordered either
+        self.delta = delta and not kw.get('preserveOrder')
+        if deltaFoldSize is not None:
+            self.deltaFoldSize = deltaFoldSize
+        if deltaFoldRatio is not None:
+            self.deltaFoldRatio = deltaFoldRatio
+        self._deltaChanges = []
         
         if not source:
             raise RuntimeError('failed to create FileStore: missing path')
         
-        stmts, format, fsize, mtime = loadFileStore(source, context, 
+        stmts, format, fsize, mtime = self._load(source, context, 
                                         incrementHook, parseOptions)
         if stmts is None:
             stmts = defaultStatements
@@ -178,11 +445,29 @@ class FileStore(MemStore):
             self.fileSize = 0
         
         self.txnState = TxnState.BEGIN
-        MemStore.__init__(self, stmts)    
+        MemStore.__init__(self, stmts, statistics=kw.get('statistics'))
+        self._replayDelta()
 
     def canWriteFormat(self, format):
         return canWriteFormat(format)
 
+    def _load(self, path, context, incrementHook=None, parseOptions=None):
+        #the snapshot doesn't record the format so only use it if it is 
+        #determined by the file extension
+        format = guessFileType(path)
+        if self.snapshot and format:
+            stmts = loadSnapshot(path + '.snapshot', path, context)
+            if stmts is not None:
+                stat = os.stat(path)
+                return stmts, format, stat.st_size, stat.st_mtime
+
+        stmts, format, fsize, mtime = loadFileStore(path, context, 
+                                                incrementHook, parseOptions)
+        if self.snapshot and format and stmts is not None:
+            stmts = list(stmts)
+            saveSnapshot(path + '.snapshot', stmts, fsize, mtime, context)
+        return stmts, format, fsize, mtime
+
     def _checkTxnState(self):
         if self.txnState == TxnState.BEGIN:
             if self.checkForExternalChanges and self.wasModifiedSinceLastWrite():
@@ -195,17 +480,33 @@ class FileStore(MemStore):
         return super(FileStore, self).getStatements(subject, predicate, object, 
                                         objecttype,context, asQuad, hints)
 
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        self._checkTxnState()
+        return super(FileStore, self).iterStatements(subject, predicate, object, 
+                                        objecttype,context, asQuad, hints, ordered)
+
     def addStatement(self, stmt):
         self._checkTxnState()
         self.txnState = TxnState.DIRTY
-        return super(FileStore, self).addStatement(stmt)
+        added = super(FileStore, self).addStatement(stmt)
+        if added and self.delta:
+            self._deltaChanges.append(stmt)
+        return added
 
     def removeStatement(self, stmt):
         self._checkTxnState()
         self.txnState = TxnState.DIRTY
-        return super(FileStore, self).removeStatement(stmt)
+        removed = super(FileStore, self).removeStatement(stmt)
+        if removed and self.delta:
+            self._deltaChanges.append( (Removed, stmt) )
+        return removed
         
     def wasModifiedSinceLastWrite(self):
+        if self.delta and self.path:
+            if self._statDelta() != (self.deltaMtime, self.deltaSize):
+                return True
         try:
             stat = os.stat(self.path)
         except (OSError, IOError):
@@ -220,6 +521,17 @@ class FileStore(MemStore):
         if self.checkForExternalChanges and self.wasModifiedSinceLastWrite():
             raise RuntimeError('error saving to "%s", file was '
                         'modified by another process' % self.path)
+        
+        #only append to the delta if the file it applies to exists
+        if self.delta and self.mtime and os.path.exists(self.path):
+            self._appendDelta()
+            if not self._needsFold():
+                self.txnState = TxnState.BEGIN
+                return
+        self._writeFile()
+        self._removeDelta()
+
+    def _writeFile(self):
         from vesper.data.transactions import TxnFileFactory
         try:
             #use TxnFileFactory so serializations errors don't corrupt file
@@ -240,6 +552,114 @@ class FileStore(MemStore):
             stat = os.stat(self.path)
             self.mtime = stat.st_mtime
             self.fileSize = stat.st_size
+            if self.snapshot:
+                saveSnapshot(self.path + '.snapshot', stmts, self.fileSize,
+                                            self.mtime, self.initialContext)
+
+    def _statDelta(self):
+        try:
+            stat = os.stat(self.path + '.delta')
+        except (OSError, IOError):
+            return 0, 0
+        return stat.st_mtime, stat.st_size
+
+    def _deltaHeader(self):
+        #identifies the version of the file the delta applies to
+        return '#delta %r %d\n' % (self.mtime, self.fileSize)
+
+    def _appendDelta(self):
+        deltaPath = self.path + '.delta'
+        if os.path.exists(deltaPath):
+            outputfile = file(deltaPath, "ab")
+            originalsize = os.path.getsize(deltaPath)
+        else:
+            outputfile = file(deltaPath, "wb")
+            outputfile.write(self._deltaHeader())
+            originalsize = 0
+        try:
+            outputfile.write("#begin\n")
+            writeTriples(self._deltaChanges, outputfile)
+            outputfile.write("#end " + time.asctime() + "\n")
+            outputfile.flush()
+        except:
+            outputfile.truncate(originalsize)
+            outputfile.close()
+            if not originalsize:
+                os.remove(deltaPath)
+            raise
+        else:
+            outputfile.close()
+        self._deltaChanges = []
+        self.deltaMtime, self.deltaSize = self._statDelta()
+
+    def _needsFold(self):
+        if self.deltaFoldSize is not None and self.deltaSize > self.deltaFoldSize:
+            return True
+        #don't bother folding small deltas
+        if (self.deltaFoldRatio is not None 
+                and self.deltaSize > max(self.fileSize, 65536) * self.deltaFoldRatio):
+            return True
+        return False
+
+    def _removeDelta(self):
+        self._deltaChanges = []
+        if self.delta and os.path.exists(self.path + '.delta'):
+            os.remove(self.path + '.delta')
+        self.deltaMtime, self.deltaSize = 0, 0
+
+    def _replayDelta(self):
+        '''
+        Apply the changes recorded in the delta file, if there is one that
+        matches the current version of the file.
+        '''
+        self._deltaChanges = []
+        if not self.delta or not self.path:
+            return
+        deltaPath = self.path + '.delta'
+        try:
+            deltafile = file(deltaPath, 'rb')
+        except (OSError, IOError):
+            self.deltaMtime, self.deltaSize = 0, 0
+            return
+        try:
+            if deltafile.readline() != self._deltaHeader():
+                #the file was rewritten since the delta was written
+                log.warning('ignoring stale delta file "%s"', deltaPath)
+                deltafile.close()
+                os.remove(deltaPath)
+                self.deltaMtime, self.deltaSize = 0, 0
+                return
+            makebNode = lambda bNode: BNODE_BASE + bNode
+            defaultScope = self.initialContext
+            pending = []
+            try:
+                for stmt in parseTriples(deltafile, makebNode, 
+                                                    yieldcomments=True):
+                    if stmt[0] is Comment:
+                        if stmt[1].startswith('end'):
+                            #only apply completely written transactions
+                            for change in pending:
+                                if change[0] is Removed:
+                                    MemStore.removeStatement(self, change[1])
+                                else:
+                                    MemStore.addStatement(self, change)
+                        pending = []
+                        continue
+                    if stmt[0] is Removed:
+                        s = stmt[1]
+                        pending.append( (Removed, Statement(s[0], s[1], s[2], 
+                                            s[3], s[4] or defaultScope)) )
+                    else:
+                        pending.append(Statement(stmt[0], stmt[1], stmt[2],
+                                            stmt[3], stmt[4] or defaultScope))
+            except:
+                #the last transaction may have been only partially written
+                log.warning('error reading delta file "%s"', deltaPath, 
+                                                            exc_info=True)
+            stat = os.fstat(deltafile.fileno())
+            self.deltaMtime, self.deltaSize = stat.st_mtime, stat.st_size
+        finally:
+            deltafile.close()
 
     def rollback(self):        
         if self.txnState == TxnState.DIRTY:
@@ -249,13 +669,15 @@ class FileStore(MemStore):
     def reload(self):
         '''reload from file'''
         if self.path:
-            stmts, format, self.fileSize, self.mtime = loadFileStore(self.path,
+            stmts, format, self.fileSize, self.mtime = self._load(self.path,
                                                             self.initialContext)
             if stmts is None:
                 stmts = self.defaultStatements
         else:
             stmts = self.defaultStatements
-        MemStore.__init__(self, stmts)
+        MemStore.__init__(self, stmts, 
+                    statistics=self.statistics is not None)
+        self._replayDelta()
         
 class TransactionFileStore(TransactionModel, FileStore): pass
         
@@ -264,9 +686,33 @@ class IncrementalNTriplesFileStoreBase(FileStore):
     Incremental save changes to an NTriples "transaction log"
     Use in a class hierarchy for Model where self has a path attribute
     and TransactionModel preceeds this in the MRO.
+    
+    The log can be compacted by rewriting it as a checkpoint of the current 
+    statements. This is done automatically after a commit if `compactSize` 
+    (the number of bytes logged since the last checkpoint) or `compactRatio` 
+    (the size of the file relative to the last checkpoint) is exceeded. 
+    These can be set as keyword arguments. Unless `compactInBackground` is 
+    False the checkpoint is written by a separate thread.
     '''    
     loadNtriplesIncrementally = True
     changelist = None
+    compactSize = None
+    compactRatio = None
+    compactInBackground = True
+    #size of the checkpoint at the beginning of the file, None if unknown
+    checkpointSize = None 
+    _compactor = None
+
+    def __init__(self, source, *args, **kw):
+        for name in ('compactSize', 'compactRatio', 'compactInBackground'):
+            if name in kw:
+                setattr(self, name, kw.pop(name))
+        #synchronizes writing to the file with the compaction thread
+        self._fileLock = threading.Lock()
+        #the log is already incremental
+        kw['delta'] = False
+        super(IncrementalNTriplesFileStoreBase, self).__init__(source, *args, **kw)
+        self.checkpointSize = readCheckpointSize(self.path)
 
     def canWriteFormat(self, format):
         #only these formats support incremental output
@@ -277,56 +723,143 @@ class IncrementalNTriplesFileStoreBase(FileStore):
         if changelist is None:
             changelist = self.changelist = []
         return changelist
-        
+
+    def _logChange(self, change):
+        changelist = self._getChangeList()
+        if changelist is not None:
+            changelist.append(change)
+
     def addStatement(self, statement):
         '''add the specified statement to the model''' 
         added = super(IncrementalNTriplesFileStoreBase, self).addStatement(statement)
-        changelist = self._getChangeList()
         #added is None if updateAdvisory == False
-        if (added is None or added) and changelist is not None:
-            changelist.append( (statement,) )
+        if added is None or added:
+            self._logChange( (statement,) )
         return added
 
     def removeStatement(self, statement ):
         '''add the specified statement to the model'''               
         removed = super(IncrementalNTriplesFileStoreBase, self).removeStatement(statement)
         #removed is None if updateAdvisory == False
-        changelist = self._getChangeList()
-        if (removed is None or removed) and changelist is not None:
-            changelist.append( (Removed, statement) )
+        if removed is None or removed:
+            self._logChange( (Removed, statement) )
         return removed
 
     def commit(self, **kw): 
         if os.path.exists(self.path):
-            originalsize = os.path.getsize(self.path)
-            outputfile = file(self.path, "a+")
-            changelist = self._getChangeList()
-            def unmapQueue():
-                for stmt in changelist:
-                    if stmt[0] is Removed:
-                        yield Removed, stmt[1]
-                    else:
-                        yield stmt[0]
-                        
-            comment = kw.get('source','') or ''
-            if isinstance(comment, (list, tuple)):                
-                comment = comment and comment[0] or ''
-            if getattr(comment, 'getAttributeNS', None):
-                comment = comment.getAttributeNS(RDF_MS_BASE, 'about')
+            self._fileLock.acquire()
             try:
-                outputfile.write("#begin " + comment + "\n")            
-                writeTriples( unmapQueue(), outputfile)            
-                outputfile.write("#end " + time.asctime() + ' ' + comment + "\n")
-            except:
-                outputfile.truncate(originalsize)
-                outputfile.close()
-                raise
-            else:
-                outputfile.close()
+                self._appendChanges(**kw)
+                fileSize = os.path.getsize(self.path)
+            finally:
+                self._fileLock.release()
+            if self._needsCompaction(fileSize):
+                self.compact(self.compactInBackground)
         else: #first time
             super(IncrementalNTriplesFileStoreBase, self).commit()
         self.changelist = []
 
+    def _appendChanges(self, **kw):
+        originalsize = os.path.getsize(self.path)
+        outputfile = file(self.path, "a+")
+        changelist = self._getChangeList()
+        def unmapQueue():
+            for stmt in changelist:
+                if stmt is None:
+                    continue #a change that was cancelled out
+                if stmt[0] is Removed:
+                    yield Removed, stmt[1]
+                else:
+                    yield stmt[0]
+                    
+        comment = kw.get('source','') or ''
+        if isinstance(comment, (list, tuple)):                
+            comment = comment and comment[0] or ''
+        if getattr(comment, 'getAttributeNS', None):
+            comment = comment.getAttributeNS(RDF_MS_BASE, 'about')
+        try:
+            outputfile.write("#begin " + comment + "\n")            
+            writeTriples( unmapQueue(), outputfile)            
+            outputfile.write("#end " + time.asctime() + ' ' + comment + "\n")
+        except:
+            outputfile.truncate(originalsize)
+            outputfile.close()
+            raise
+        else:
+            outputfile.close()
+
+    def _needsCompaction(self, fileSize):
+        checkpointSize = self.checkpointSize or 0
+        if (self.compactSize is not None 
+                and fileSize - checkpointSize > self.compactSize):
+            return True
+        #don't bother compacting small files
+        if (self.compactRatio is not None 
+                and fileSize > max(checkpointSize, 4096) * self.compactRatio):
+            return True
+        return False
+
+    def compact(self, background=False):
+        '''
+        Replace the log with a checkpoint of the currently committed statements.
+        If `background` is True, the checkpoint is written in a separate 
+        thread; changes committed while it is being written are copied over
+        when it is done.
+        '''
+        if self._compactor and self._compactor.isAlive():
+            return #already compacting
+        #don't include uncommitted changes (e.g. if TransactionModel is used)
+        stmts = MemStore.getStatements(self)
+        logSize = os.path.getsize(self.path)
+        if background:
+            def run():
+                try:
+                    self._writeCheckpoint(stmts, logSize)
+                except:
+                    log.exception('compacting %s failed' % self.path)
+            self._compactor = threading.Thread(target=run)
+            self._compactor.start()
+        else:
+            self._writeCheckpoint(stmts, logSize)
+
+    def _writeCheckpoint(self, stmts, logSize):
+        from vesper.data.transactions import TxnFileFactory
+        tff = TxnFileFactory(self.path)
+        outputfile = None
+        try:
+            outputfile = tff.create('b')
+            header = '#checkpoint %020d\n'
+            outputfile.write(header % 0)
+            writeTriples(stmts, outputfile)
+            checkpointSize = outputfile.tell()
+            #now that we know its size, update the header
+            outputfile.seek(0)
+            outputfile.write(header % checkpointSize)
+            outputfile.seek(checkpointSize)
+            self._fileLock.acquire()
+            try:
+                #copy over any changes committed after the checkpoint was taken
+                logfile = open(self.path, 'rb')
+                logfile.seek(logSize)
+                shutil.copyfileobj(logfile, outputfile)
+                logfile.close()
+                outputfile.close()
+                tff.commitTransaction(None)
+                stat = os.stat(self.path)
+                self.mtime = stat.st_mtime
+                self.fileSize = stat.st_size
+                self.checkpointSize = checkpointSize
+            finally:
+                self._fileLock.release()
+        except:
+            if outputfile:
+                outputfile.close()
+            tff.abortTransaction(None)
+            tff.finishTransaction(None, False)
+            raise
+        else:
+            tff.finishTransaction(None, True)
+
     def rollback(self):        
         self.changelist = []
         super(IncrementalNTriplesFileStoreBase, self).rollback()
@@ -336,6 +869,30 @@ class IncrementalNTriplesFileStore(TransactionModel, IncrementalNTriplesFileStor
     def _getChangeList(self):
         return self.queue
 
+    def _logChange(self, change):
+        #the transaction queue already records the change
+        pass
+
+def readCheckpointSize(path):
+    '''
+    Return the size of the checkpoint at the beginning of the given log 
+    or None if it doesn't start with a checkpoint.
+    '''
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    if line.startswith('#checkpoint '):
+        try:
+            return int(line.split()[1])
+        except (IndexError, ValueError):
+            pass
+    return None
+
 def guessFileType(path):
   extmap = { '.nt' : 'ntriples',
     '.nj' : 'ntjson', 
@@ -374,3 +931,123 @@ def loadFileStore(path, context='', incrementHook=None, parseOptions=None):
     
     return stmts, format, fsize, mtime
 
+
+#snapshot header: magic, byteorder, size of a term id, size of a term offset,
+#file's mtime and size, then the lengths of the context, term offsets, 
+#term data and quads sections
+_snapshotHeader = struct.Struct('=8scBBdqQQQQ')
+_SNAPSHOT_MAGIC = 'vspsnap1'
+
+def saveSnapshot(snapshotPath, stmts, fileSize, mtime, context=''):
+    '''
+    Write a binary snapshot of the statements: a table of the unique terms 
+    followed by a sorted array of quads of term ids.
+    `fileSize` and `mtime` are the stat of the file the statements were 
+    loaded from; `loadSnapshot()` uses these to check if the snapshot is stale.
+    '''
+    termIds = {}
+    terms = []
+    quads = array.array('i')
+    rows = []
+    for stmt in stmts:
+        row = []
+        for term in stmt[:5]:
+            #str and unicode terms that are equal are the same term
+            termId = termIds.get(term)
+            if termId is None:
+                termId = termIds[term] = len(terms)
+                terms.append(term)
+            row.append(termId)
+        rows.append(row)
+    rows.sort()
+    for row in rows:
+        quads.extend(row)
+
+    offsets = array.array('I', [0])
+    data = []
+    offset = 0
+    for term in terms:
+        if isinstance(term, unicode):
+            term = 'u' + term.encode('utf8')
+        else:
+            term = 's' + term
+        data.append(term)
+        offset += len(term)
+        offsets.append(offset)
+    data = ''.join(data)
+    if isinstance(context, unicode):
+        context = context.encode('utf8')
+    offsets = offsets.tostring()
+    quads = quads.tostring()
+
+    from vesper.data.transactions import TxnFileFactory
+    tff = TxnFileFactory(snapshotPath)
+    try:
+        outputfile = tff.create('b')
+        outputfile.write(_snapshotHeader.pack(_SNAPSHOT_MAGIC, 
+            sys.byteorder[0], array.array('i').itemsize, 
+            array.array('I').itemsize, mtime, fileSize, len(context), 
+            len(offsets), len(data), len(quads)))
+        outputfile.write(context)
+        outputfile.write(offsets)
+        outputfile.write(data)
+        outputfile.write(quads)
+        outputfile.close()
+    except:
+        tff.abortTransaction(None)
+        tff.finishTransaction(None, False)
+        raise
+    else:
+        tff.commitTransaction(None)
+        tff.finishTransaction(None, True)
+
+def loadSnapshot(snapshotPath, path, context=''):
+    '''
+    Returns the list of statements saved in the snapshot or None if 
+    the snapshot doesn't exist, is unreadable or doesn't match the
+    current stat of `path` and the given context.
+    '''
+    try:
+        stat = os.stat(path)
+        f = open(snapshotPath, 'rb')
+    except (OSError, IOError):
+        return None
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size < _snapshotHeader.size:
+            return None
+        (magic, byteorder, idsize, offsetsize, mtime, fileSize, 
+            contextLen, offsetsLen, dataLen, quadsLen
+                        ) = _snapshotHeader.unpack(f.read(_snapshotHeader.size))
+        if (magic != _SNAPSHOT_MAGIC or byteorder != sys.byteorder[0]
+                or idsize != array.array('i').itemsize 
+                or offsetsize != array.array('I').itemsize
+                or mtime != stat.st_mtime or fileSize != stat.st_size):
+            return None
+        if isinstance(context, unicode):
+            context = context.encode('utf8')
+        if f.read(contextLen) != context:
+            return None
+        if (_snapshotHeader.size + contextLen + offsetsLen + dataLen 
+                                                    + quadsLen != size):
+            return None #truncated
+
+        offsets = array.array('I')
+        offsets.fromstring(f.read(offsetsLen))
+        data = f.read(dataLen)
+        quads = array.array('i')
+        quads.fromstring(f.read(quadsLen))
+    finally:
+        f.close()
+
+    terms = []
+    for start, end in itertools.izip(offsets, itertools.islice(offsets, 1, None)):
+        if data[start] == 'u':
+            terms.append(data[start+1:end].decode('utf8'))
+        else:
+            terms.append(data[start+1:end])
+    newStatement = tuple.__new__
+    quads = iter(quads)
+    return [newStatement(Statement, (terms[s], terms[p], terms[o], terms[t], 
+                                                                terms[c]))
+            for s, p, o, t, c in itertools.izip(quads, quads, quads, quads, quads)]
@@ -26,22 +26,11 @@ except AttributeError:
     else:
         bsddb.db.DB_GET_BOTH_RANGE = 10
 
-log = logging.getLogger("bdb")
+#snapshot isolation needs Berkeley DB 4.5 or later
+_DB_MULTIVERSION = getattr(bsddb.db, 'DB_MULTIVERSION', 0)
+_DB_TXN_SNAPSHOT = _DB_MULTIVERSION and getattr(bsddb.db, 'DB_TXN_SNAPSHOT', 0)
 
-class _ListInfo(object):
-    prop = ''
-    
-    def __init__(self):
-        self.positions = {}
-        
-    def setPosition(self, obj, objtype, pos):
-        self.positions.setdefault( (obj, objtype), []).append(pos)
-        
-    def __str__(self):
-        #a list where each item is an index into 
-        items = self.positions.items()
-        items.sort()
-        return self.prop+',' + ','.join(self.positions) 
+log = logging.getLogger("bdb")
 
 def _to_safe_str(s):
     "Convert any unicode strings to utf-8 encoded 'str' types"
@@ -65,7 +54,7 @@ def _btopen(env, file, flag='c', mode=0666,
             btflags=0, cachesize=None, maxkeypage=None, minkeypage=None,
             pgsize=None, lorder=None):
 
-    flags = bsddb.db.DB_CREATE # bsddb._checkflag(flag, file)
+    flags = bsddb.db.DB_CREATE | bsddb.db.DB_AUTO_COMMIT | _DB_MULTIVERSION
     d = bsddb.db.DB(env)
     if pgsize is not None: d.set_pagesize(pgsize)
     if lorder is not None: d.set_lorder(lorder)
@@ -85,6 +74,12 @@ class BdbStore(Model):
     
     s => p o t c 
 
+    and, if the `objectIndex` and `contextIndex` options are set:
+
+    o => s p t c
+
+    c => s p o t
+
     where
         
     s subject
@@ -94,13 +89,22 @@ class BdbStore(Model):
     c context (scope)
     
     keys are stored so that lexigraphic sort work properly
+
+    Changes are made inside Berkeley DB transactions and reads use snapshot
+    isolation (if available) so they don't block writers. If `writeNoSync` 
+    is set the log isn't flushed to disk on commit, which is faster but
+    the last transactions can be lost if the system crashes.
     '''
     #add list info to each object 
     
     debug=0
     updateAdvisory = True
+    oDb = None
+    cDb = None
+    _txn = None
      
-    def __init__(self, source, defaultStatements=None, **kw):
+    def __init__(self, source, defaultStatements=None, objectIndex=False,
+                        contextIndex=False, writeNoSync=False, **kw):
         if source is not None:
             source = os.path.abspath(source) # bdb likes absolute paths for everything
             log.debug("opening db at:" + source)
@@ -111,10 +115,12 @@ class BdbStore(Model):
             
             pPath = os.path.join(source, 'pred_db')
             sPath = os.path.join(source, 'subj_db')
+            oPath = os.path.join(source, 'obj_db')
+            cPath = os.path.join(source, 'context_db')
             newdb = not os.path.exists(pPath)
         else:
             newdb = True
-            pPath = sPath = None
+            pPath = sPath = oPath = cPath = None
             
         log.debug("pPath:" + pPath)
         log.debug("sPath:" + sPath)
@@ -123,21 +129,140 @@ class BdbStore(Model):
         db = bsddb.db
         self.env = bsddb.db.DBEnv()
         self.env.set_lk_detect(db.DB_LOCK_DEFAULT)
-        self.env.open(source, db.DB_CREATE | db.DB_INIT_LOCK | db.DB_INIT_MPOOL | db.DB_INIT_TXN)
+        if writeNoSync:
+            self.env.set_flags(db.DB_TXN_WRITE_NOSYNC, 1)
+        self.env.open(source, db.DB_CREATE | db.DB_INIT_LOCK | db.DB_INIT_MPOOL 
+                                            | db.DB_INIT_LOG | db.DB_INIT_TXN)
+        #the cursors open in the current transaction
+        self._txnCursors = {}
 
         self.pDb = _btopen(self.env, pPath, btflags=bsddb.db.DB_DUPSORT) # DB_DUPSORT is faster than DB_DUP        
         self.pDb.db.set_get_returns_none(2)
         self.sDb = _btopen(self.env, sPath, btflags=bsddb.db.DB_DUPSORT)         
         self.sDb.db.set_get_returns_none(2)
+
+        if objectIndex:
+            newindex = newdb or not os.path.exists(oPath)
+            self.oDb = _btopen(self.env, oPath, btflags=bsddb.db.DB_DUPSORT)
+            self.oDb.db.set_get_returns_none(2)
+            if newindex:
+                self._buildIndex(self.oDb.db, self._objectIndexEntry)
+        if contextIndex:
+            newindex = newdb or not os.path.exists(cPath)
+            self.cDb = _btopen(self.env, cPath, btflags=bsddb.db.DB_DUPSORT)
+            self.cDb.db.set_get_returns_none(2)
+            if newindex:
+                self._buildIndex(self.cDb.db, self._contextIndexEntry)
         
         if newdb and defaultStatements:            
             self.addStatements(defaultStatements)
             
     def close(self):
         log.debug("closing db")
+        if self._txn is not None:
+            self._endTxn(False)
         self.pDb.close()
         self.sDb.close()
+        if self.oDb:
+            self.oDb.close()
+        if self.cDb:
+            self.cDb.close()
         self.env.close()
+
+    def _predicateIndexEntry(self, stmt):
+        #p o t => c s
+        return (_encodeValues(stmt[1], stmt[2], stmt[3]), 
+                        _encodeValues(stmt[4], stmt[0]))
+
+    def _subjectIndexEntry(self, stmt):
+        #s => p o t c
+        return (_to_safe_str(stmt[0]), 
+                        _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]))
+
+    def _objectIndexEntry(self, stmt):
+        #o => s p t c
+        return (_to_safe_str(stmt[2]), 
+                        _encodeValues(stmt[0], stmt[1], stmt[3], stmt[4]))
+
+    def _contextIndexEntry(self, stmt):
+        #c => s p o t
+        return (_to_safe_str(stmt[4]), 
+                        _encodeValues(stmt[0], stmt[1], stmt[2], stmt[3]))
+
+    def _indexes(self):
+        '''
+        Return a list of (db, makeEntry) for each index, the predicate 
+        index first.
+        '''
+        indexes = [(self.pDb.db, self._predicateIndexEntry), 
+                   (self.sDb.db, self._subjectIndexEntry)]
+        if self.oDb:
+            indexes.append( (self.oDb.db, self._objectIndexEntry) )
+        if self.cDb:
+            indexes.append( (self.cDb.db, self._contextIndexEntry) )
+        return indexes
+
+    def _buildIndex(self, db, makeEntry):
+        '''
+        Add the existing statements to a newly created index.
+        '''
+        entries = [makeEntry(stmt) for stmt in 
+                            self._iterRows(None, None, None, None, None)]
+        entries.sort()
+        txn = self.env.txn_begin()
+        try:
+            for key, value in entries:
+                db.put(key, value, txn=txn, flags=bsddb.db.DB_NODUPDATA)
+        except:
+            txn.abort()
+            raise
+        txn.commit()
+
+    def _cursor(self, db):
+        '''
+        Return a cursor that reads inside the current transaction if there
+        is one, otherwise from a snapshot.
+        '''
+        if self._txn is not None:
+            cursor = db.cursor(self._txn)
+            #cursors need to be closed before the transaction ends
+            self._txnCursors[id(cursor)] = cursor
+            return cursor
+        return db.cursor(None, _DB_TXN_SNAPSHOT)
+
+    def _closeCursor(self, cursor):
+        self._txnCursors.pop(id(cursor), None)
+        try:
+            cursor.close()
+        except bsddb.db.DBError:
+            pass #already closed when its transaction ended
+
+    def _endTxn(self, commit):
+        txn = self._txn
+        self._txn = None
+        for cursor in self._txnCursors.values():
+            self._closeCursor(cursor)
+        if commit:
+            txn.commit()
+        else:
+            txn.abort()
+
+    def _write(self, func, arg):
+        '''
+        Call `func` inside a transaction, committing it afterwards if 
+        `autocommit` is set.
+        '''
+        if self._txn is None:
+            self._txn = self.env.txn_begin()
+        try:
+            result = func(arg)
+        except:
+            if self.autocommit:
+                self._endTxn(False)
+            raise
+        if self.autocommit:
+            self._endTxn(True)
+        return result
         
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
@@ -146,9 +271,72 @@ class BdbStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
+        return list(BdbStore.iterStatements(self, subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        '''
+        Statements are read from a cursor as the iterator is consumed.
+        Lookups that use the subject, object or context index are already in
+        order, otherwise the matching statements have to be sorted first if 
+        `ordered` is True.
+        If only the predicate is specified, a 'startswith' predicate in
+        `hints` is used to read just the range of the predicate index with
+        that prefix.
+        '''
+        hints = hints or {}
+        prefix = None
+        if subject is None and predicate is not None and object is None:
+            prefix = findPredicate(hints, 'startswith')
+        if prefix:
+            stmts = self._iterPrefixRows(predicate, prefix, objecttype, context)
+        else:
+            stmts = self._iterRows(subject, predicate, object, objecttype, 
+                                                                    context)
+        if (ordered and subject is None and predicate is not None 
+                and not (object is not None and self.oDb)):
+            #the predicate index isn't sorted by subject
+            stmts = sorted(stmts)
+        #quads are unique so duplicates are only possible if asQuad is False
+        if not asQuad:
+            stmts = iterUniqueStatements(stmts, asQuad, ordered)
+        return sliceStatements(stmts, hints.get('limit'), hints.get('offset'))
+
+    def _iterPrefixRows(self, predicate, prefix, objecttype, context):
+        '''
+        Yield the statements with the given predicate whose object starts 
+        with `prefix`.
+        '''
+        #p o t => c s
+        #keys are sorted so the matching objects are a contiguous range
+        start = _encodeValues(predicate, prefix)
+        pcursor = self._cursor(self.pDb.db)
+        try:
+            rec = pcursor.set_range(start)
+            while rec:
+                key, value = rec
+                if not key.startswith(start):
+                    break
+                p, o, t = key.split('\0')
+                c, s = value.split('\0')
+                if ((objecttype is None or t == objecttype)
+                        and (context is None or c == context)):
+                    yield Statement(s, p, o, t, c)
+                rec = pcursor.next()
+        finally:
+            self._closeCursor(pcursor)
+
+    def _iterRows(self, subject, predicate, object, objecttype, context):
+        '''
+        Yield the statements that match, in the order of the index used.
+        '''
         #if subject is specified, use subject index, 
         #  with/get_both if predicate is specified 
+        #if object, use the object index if we have one
         #if predicate, use property index
+        #if context, use the context index if we have one
         #if only object or scope is specified, get all and search manually
         #else: get all: use subject index, regenerate json_seq stmts
         #do a manual scan if subject list bnode
@@ -157,9 +345,6 @@ class BdbStore(Model):
         fo = object is not None
         fot = objecttype is not None
         fc = context is not None
-        hints = hints or {}
-        limit=hints.get('limit')
-        offset=hints.get('offset')
 
         if fo:
             if isinstance(object, ResourceUri):
@@ -169,139 +354,223 @@ class BdbStore(Model):
             elif not fot:
                 objecttype = OBJECT_TYPE_LITERAL
 
-        stmts = []
         if fs: 
             subject = _to_safe_str(subject)
             #if subject is specified, use subject index            
-            scursor = self.sDb.db.cursor()
-            if fp:
-                val = _to_safe_str(predicate)
-                if fo:
-                    val += '\0'+ _to_safe_str(object)
-                    if fot: 
-                        val += '\0'+ _to_safe_str(objecttype)
-                        if fc:
-                            val += '\0'+_to_safe_str(context)
-                #duplicates are sorted so we can position the cursor at the
-                #first value we're interested
-                rec = scursor.get(subject, val, bsddb.db.DB_GET_BOTH_RANGE)
-            else:
-                rec = scursor.set(subject)
-            while rec:
-                #s => p o t c 
-                s, value = rec
-                assert s == subject
-                p, o, t, c = value.split('\0')                
+            scursor = self._cursor(self.sDb.db)
+            try:
                 if fp:
-                    #since dups are sorted we can break
-                    if p != predicate:
-                        break
+                    val = _to_safe_str(predicate)
                     if fo:
-                        if o != object:
+                        val += '\0'+ _to_safe_str(object)
+                        if fot: 
+                            val += '\0'+ _to_safe_str(objecttype)
+                            if fc:
+                                val += '\0'+_to_safe_str(context)
+                    #duplicates are sorted so we can position the cursor at the
+                    #first value we're interested
+                    rec = scursor.get(subject, val, bsddb.db.DB_GET_BOTH_RANGE)
+                else:
+                    rec = scursor.set(subject)
+                while rec:
+                    #s => p o t c 
+                    s, value = rec
+                    assert s == subject
+                    p, o, t, c = value.split('\0')                
+                    if fp:
+                        #since dups are sorted we can break
+                        if p != predicate:
                             break
-                        if fot:
-                            if t != objecttype:
+                        if fo:
+                            if o != object:
                                 break
-                            if fc:
-                                if c != context:
-                                    break      
+                            if fot:
+                                if t != objecttype:
+                                    break
+                                if fc:
+                                    if c != context:
+                                        break      
                 
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):            
-                    stmts.append( Statement(s, p, o, t, c) )            
-                rec = scursor.next_dup()
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):            
+                        yield Statement(s, p, o, t, c)            
+                    rec = scursor.next_dup()
+            finally:
+                self._closeCursor(scursor)
                 
+        elif fo and self.oDb:
+            #o => s p t c
+            #dups are sorted by s p t c, the same order as the statements
+            ocursor = self._cursor(self.oDb.db)
+            try:
+                key = _to_safe_str(object)
+                rec = ocursor.set(key)
+                while rec:
+                    o, value = rec
+                    s, p, t, c = value.split('\0')
+                    if ((not fp or p == predicate) 
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):
+                        yield Statement(s, p, o, t, c)
+                    rec = ocursor.next_dup()
+            finally:
+                self._closeCursor(ocursor)
+
         elif fp:
-            pcursor = self.pDb.db.cursor()            
-            key = _to_safe_str(predicate)
-            val = None
-            if fo:
-                key += '\0'+_to_safe_str(object)
-                if fot: 
-                    key += '\0'+_to_safe_str(objecttype)
-                    if fc:
-                        val = _to_safe_str(context)
-                        rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
-            if val is None:
-                rec = pcursor.set_range(key)                
+            pcursor = self._cursor(self.pDb.db)
+            try:
+                key = _to_safe_str(predicate)
+                val = None
+                if fo:
+                    key += '\0'+_to_safe_str(object)
+                    if fot: 
+                        key += '\0'+_to_safe_str(objecttype)
+                        if fc:
+                            val = _to_safe_str(context)
+                            rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
+                if val is None:
+                    rec = pcursor.set_range(key)                
                         
-            while rec:                
-                key, value = rec
-                p, o, t = key.split('\0')                
-                if p != predicate or (fo and o != object) or (fot and t != objecttype):
-                    break  #we're finished with the range of the key we're interested in               
-                c, s = value.split('\0')                            
-                if not fc or c == context:                     
-                    stmts.append( Statement(s, p, o, t, c) )                
-                rec = pcursor.next()
+                while rec:                
+                    key, value = rec
+                    p, o, t = key.split('\0')                
+                    if p != predicate or (fo and o != object) or (fot and t != objecttype):
+                        break  #we're finished with the range of the key we're interested in               
+                    c, s = value.split('\0')                            
+                    if not fc or c == context:                     
+                        yield Statement(s, p, o, t, c)                
+                    rec = pcursor.next()
+            finally:
+                self._closeCursor(pcursor)
                             
+        elif fc and self.cDb:
+            #c => s p o t
+            ccursor = self._cursor(self.cDb.db)
+            try:
+                key = _to_safe_str(context)
+                rec = ccursor.set(key)
+                while rec:
+                    c, value = rec
+                    s, p, o, t = value.split('\0')
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)):
+                        yield Statement(s, p, o, t, c)
+                    rec = ccursor.next_dup()
+            finally:
+                self._closeCursor(ccursor)
+
         else:            
             #get all            
-            scursor = self.sDb.db.cursor()
-            rec = scursor.first()
-            while rec:
-                s, value = rec
-                p, o, t, c = value.split('\0')
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):
-                    stmts.append( Statement(s, p, o, t, c) )
-                rec = scursor.next()
-
-        stmts.sort()        
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
+            scursor = self._cursor(self.sDb.db)
+            try:
+                rec = scursor.first()
+                while rec:
+                    s, value = rec
+                    p, o, t, c = value.split('\0')
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):
+                        yield Statement(s, p, o, t, c)
+                    rec = scursor.next()
+            finally:
+                self._closeCursor(scursor)
 
     def addStatements(self, stmts):
-        lists = {}
-        for stmt in stmts:
-            if stmt[0].startswith('bnode:jlist:') or stmt[0].startswith('_:l'):
-                if stmt[1].startswith('rdf:_'):
-                    pos = stmt.predicate[:1]
-                    lists.setdefault(stmt[0], _ListInfo() ).setPosition(stmt[2], stmt[3], pos)
-                #elif stmt[1] == JSON_SEQ_PROP:
-                #    lists.setdefault(stmt[0], _ListInfo()).prop = stmt[2]
-            #elif stmt[1] == JSON_LIST_PROP:
-            #    continue #exclude
-            else:
-                self.addStatement(stmt)
-        #positions are indexed for each value
-        for key, listinfo in lists.items():
-            listinfo.positions.sort(key=int)
-            ls = Statement(subject, '!list', '%s,%s' % (key, listinfo))
-            #only add to subject index
+        '''
+        Add the statements in one transaction. The entries for each index
+        are sorted first so the B-trees are written to in key order.
+        '''
+        stmts = list(stmts)
+        if stmts:
+            self._write(self._putStatements, stmts)
                 
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
-        #print 'add', stmt
-        try:
-            #p o t => c s        
-            self.pDb.db.put(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0]), flags=bsddb.db.DB_NODUPDATA)
-            
-            #s => p o t c
-            self.sDb.db.put(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]), flags=bsddb.db.DB_NODUPDATA)
-            
-            return True
-        except bsddb.db.DBKeyExistError:
-            return False
+        return self._write(self._putStatements, [stmt]) > 0
+
+    def _putStatements(self, stmts):
+        '''
+        Returns the number of statements that were added.
+        '''
+        indexes = self._indexes()
+        #add to the predicate index first to find out which statements 
+        #are new, DB_NODUPDATA fails if the statement is already there
+        db, makeEntry = indexes[0]
+        entries = [makeEntry(stmt) + (stmt,) for stmt in stmts]
+        entries.sort()
+        added = []
+        for key, value, stmt in entries:
+            try:
+                db.put(key, value, txn=self._txn, flags=bsddb.db.DB_NODUPDATA)
+            except bsddb.db.DBKeyExistError:
+                continue
+            added.append(stmt)
+        
+        for db, makeEntry in indexes[1:]:
+            entries = [makeEntry(stmt) for stmt in added]
+            entries.sort()
+            for key, value in entries:
+                try:
+                    db.put(key, value, txn=self._txn, 
+                                        flags=bsddb.db.DB_NODUPDATA)
+                except bsddb.db.DBKeyExistError:
+                    pass
+        return len(added)
         
     def removeStatement(self, stmt):
         '''removes the statement'''
-        #p o t => c s
-        pcursor = self.pDb.db.cursor()
-        if pcursor.set_both(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0])):
-            pcursor.delete()
+        return self._write(self._deleteStatement, stmt)
 
-        #s => p o t c
-        scursor = self.sDb.db.cursor()
-        if scursor.set_both(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]) ):
-            scursor.delete()
-            return True
-        return False
+    def _deleteStatement(self, stmt):
+        found = False
+        for db, makeEntry in self._indexes():
+            cursor = self._cursor(db)
+            try:
+                if cursor.set_both(*makeEntry(stmt)):
+                    cursor.delete()
+                    found = True
+            finally:
+                self._closeCursor(cursor)
+        return found
+
+    def commit(self, **kw):
+        if self._txn is not None:
+            self._endTxn(True)
+
+    def rollback(self):
+        if self._txn is not None:
+            self._endTxn(False)
 
 class TransactionBdbStore(TransactionModel, BdbStore):
     '''
-    Provides in-memory transactions to BdbStore
+    Provides in-memory transactions to BdbStore. The queued changes are 
+    written in one Berkeley DB transaction when committed.
     '''
+
+    def _writeQueue(self):
+        '''
+        Each run of queued additions is passed to _putStatements() in one 
+        call so its entries are sorted and written as a batch.
+        '''
+        added = []
+        for stmt in self.queue:
+            if stmt is None:
+                continue
+            if stmt[0] is Removed:
+                if added:
+                    self._write(self._putStatements, added)
+                    added = []
+                self._write(self._deleteStatement, stmt[1])
+            else:
+                added.append(stmt[0])
+        if added:
+            self._write(self._putStatements, added)
+
+    def commit(self, **kw):
+        try:
+            super(TransactionBdbStore, self).commit(**kw)
+        except:
+            #don't leave some of the changes written
+            BdbStore.rollback(self)
+            raise
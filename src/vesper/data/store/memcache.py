@@ -6,28 +6,68 @@ from vesper.backports import *
 from vesper.data.base import * # XXX
     
 class _DictHack(object):
-    def __init__(self, mc, prefix):
+    '''
+    Each key's value is a log of json encoded statements separated by "||",
+    removed statements are appended with a "del:" prefix. When a key's log
+    has more than `compactThreshold` deletions it is rewritten with just 
+    the remaining statements.
+    '''
+    def __init__(self, mc, prefix, compactThreshold=20):
         self.mc = mc
         self.prefix = prefix
+        self.compactThreshold = compactThreshold
         
     def get(self, key):
-        key = str(key)
-        val = self.mc.get(self.prefix+str(key))
-        if val:
-            delcount = 0
-            stmts = []
-            for s in val.split('||'):
-                if s.startswith('del:'):
-                    #print 'stmt', s
-                    s = json.loads(s[4:])
-                    stmts.remove(Statement(*s) )
-                    delcount += 1 #XXX compact list if count exceed some value
-                else:
-                    #print 'stmt', s
-                    s = json.loads(s)
-                    stmts.append(Statement(*s))
-            return stmts
-        return []
+        return self.getMulti([key])[str(key)]
+
+    def getMulti(self, keys):
+        '''
+        Fetch the statements for all the keys with one round-trip.
+        Returns a dict mapping each key to its list of statements.
+        '''
+        keys = [str(key) for key in keys]
+        values = self.mc.get_multi(keys, key_prefix=self.prefix)
+        results = {}
+        for key in keys:
+            val = values.get(key)
+            if val:
+                stmts, delcount = self._decode(val)
+                if delcount > self.compactThreshold:
+                    self._compact(key)
+                results[key] = stmts
+            else:
+                results[key] = []
+        return results
+
+    def _decode(self, val):
+        delcount = 0
+        stmts = []
+        for s in val.split('||'):
+            if not s:
+                continue
+            if s.startswith('del:'):
+                s = Statement(*json.loads(s[4:]))
+                if s in stmts:
+                    stmts.remove(s)
+                delcount += 1
+            else:
+                stmts.append(Statement(*json.loads(s)))
+        return stmts, delcount
+
+    def _compact(self, key):
+        '''
+        Rewrite the key's value without the removed statements. Uses 
+        check-and-set so a concurrent append isn't lost, if the value 
+        changed we just leave it to be compacted later. The value is 
+        re-read with gets() because cas() needs the cas id it records.
+        '''
+        key = self.prefix+key
+        val = self.mc.gets(key)
+        if not val:
+            return False
+        stmts, delcount = self._decode(val)
+        value = '||'.join([str(json.dumps(list(stmt))) for stmt in stmts])
+        return self.mc.cas(key, value)
         
     def set(self, key, value):
         key = self.prefix+str(key)
@@ -45,16 +85,25 @@ class _DictHack(object):
 class MemCacheStore(Model):
     '''
     simple in-memory module
+
+    `client` can be used instead of connecting to `connect`, it needs to
+    implement the python-memcached `Client` methods used here.
     '''
     debug=0
+    #the number of keys fetched with each get_multi() during a full scan
+    getMultiBatchSize = 500
     
-    def __init__(self,connect='127.0.0.1:11211', defaultStatements=None, prefix='', **kw):
-        import memcache
-        self.mc = mc = memcache.Client([connect], debug=0)
+    def __init__(self,connect='127.0.0.1:11211', defaultStatements=None, 
+                    prefix='', client=None, compactThreshold=20, **kw):
+        if client is None:
+            import memcache
+            #cache_cas is needed for gets() and cas()
+            client = memcache.Client([connect], debug=0, cache_cas=True)
+        self.mc = mc = client
         self.prefix = prefix 
-        self.by_s = _DictHack(mc, prefix+'!s')
-        self.by_p = _DictHack(mc, prefix+'!p')
-        self.by_o = _DictHack(mc, prefix+'!o')
+        self.by_s = _DictHack(mc, prefix+'!s', compactThreshold)
+        self.by_p = _DictHack(mc, prefix+'!p', compactThreshold)
+        self.by_o = _DictHack(mc, prefix+'!o', compactThreshold)
         if defaultStatements:            
             self.addStatements(defaultStatements)     
 
@@ -86,11 +135,15 @@ class MemCacheStore(Model):
             if not resources:
                 return []
             stmts = []
-            for subject in resources.split('||'):
-                for stmt in self.by_s.get(subject):
-                    if not fot or stmt.objectType == objecttype:
-                        if not fc or stmt.scope == context:
-                            stmts.append(stmt)
+            subjects = list(set(resources.split('||')))
+            for i in xrange(0, len(subjects), self.getMultiBatchSize):
+                batch = self.by_s.getMulti(
+                                subjects[i:i+self.getMultiBatchSize])
+                for subjectStmts in batch.itervalues():
+                    for stmt in subjectStmts:
+                        if not fot or stmt.objectType == objecttype:
+                            if not fc or stmt.scope == context:
+                                stmts.append(stmt)
             stmts.sort()
             return removeDupStatementsFromSortedList(stmts,asQuad,
                                                 limit=limit,offset=offset)                
@@ -4,86 +4,413 @@ __all__ = ['SqliteStore', 'TransactionSqliteStore']
 
 import os, os.path
 import logging
+import re
 
 import sqlite3
 
 from vesper.backports import *
 from vesper.data.base import * # XXX
+from vesper import pjson
+
+log = logging.getLogger("sqlite")
+
+_nonAsciiRe = re.compile('[\x80-\xff]')
+
+def _decodeText(s):
+    '''
+    text_factory for the connection: returns ascii as a str
+    otherwise decodes the utf8 to unicode.
+    '''
+    if _nonAsciiRe.search(s):
+        return s.decode('utf8')
+    return s
+
+def _normalizeTerm(term):
+    #make the term compare equal to what _decodeText returns
+    if isinstance(term, str) and _nonAsciiRe.search(term):
+        return term.decode('utf8')
+    return term
+
+if sqlite3.sqlite_version_info >= (3, 8, 2):
+    _withoutRowid = ' WITHOUT ROWID'
+else:
+    _withoutRowid = ''
+
+_schema = ['''CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE)''',
+'''CREATE TABLE IF NOT EXISTS statements (
+    s INTEGER NOT NULL, p INTEGER NOT NULL, o INTEGER NOT NULL,
+    t INTEGER NOT NULL, c INTEGER NOT NULL,
+    PRIMARY KEY (s, p, o, t, c))''' + _withoutRowid,
+'CREATE INDEX IF NOT EXISTS statements_p ON statements (p, o, t, c, s)',
+'CREATE INDEX IF NOT EXISTS statements_o ON statements (o, s, p, t, c)',
+'CREATE INDEX IF NOT EXISTS statements_c ON statements (c, s, p, o, t)',
+]
+
+_columns = ('s', 'p', 'o', 't', 'c')
+
+_joinTerms = ('statements st '
+            'JOIN terms s ON s.id=st.s JOIN terms p ON p.id=st.p '
+            'JOIN terms o ON o.id=st.o JOIN terms t ON t.id=st.t '
+            'JOIN terms c ON c.id=st.c')
+
+#these objectTypes are converted to numbers by pjson
+_numericTypes = [pjson.XSD + name for name in 
+                        ('integer', 'double', 'decimal', 'int', 'float')]
+
+#number of parameters to use in a "IN (?,?...)" clause
+_MAX_PARAMS = 500
 
 class SqliteStore(Model):
     '''
     datastore using SQLite DB using Python's sqlite3 module
-    
-    create table statements (
-      text subject (index)
-      text predicate (index)
-      text object value
-      text objecttype
-      text context
-    )
 
+    Each unique term is stored once in the terms table:
+
+    terms (id integer primary key, term text unique)
+
+    and the statements table stores quads of term ids, with
+    covering indexes for each position:
+
+    statements (s, p, o, t, c) primary key s p o t c
+      index p o t c s
+      index o s p t c
+      index c s p o t
+
+    Statements are sorted, and limit and offset applied, by SQLite.
+    Changes are committed as they are made unless the store is a
+    `TransactionSqliteStore`.
     '''
-     
-    def __init__(self, db_path=None, defaultStatements=None, **kw):
-        if db_path is None:
-            self.conn = sqlite3.connect(":memory:")
-            self.cursor = self.conn.cursor()
+    updateAdvisory = True
+
+    def __init__(self, source=None, defaultStatements=None, **kw):
+        if source is None:
+            source = ":memory:"
+            newdb = True
         else:
-            if not os.path.exists(db_path):
-                self.conn = sqlite3.connect(db_path)
-                self.cursor = self.conn.cursor()
-                if defaultStatements:            
-                    self.addStatements(defaultStatements)
-            
+            newdb = not os.path.exists(source)
+        log.debug("opening db at: %s new: %s", source, newdb)
+        self.conn = sqlite3.connect(source, check_same_thread=False)
+        self.conn.text_factory = _decodeText
+        if self.autocommit:
+            self.conn.isolation_level = None
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for sql in _schema:
+            self.conn.execute(sql)
+        self.conn.commit()
+        #term => term id
+        self._termIds = {}
+
+        if newdb and defaultStatements:
+            self.addStatements(defaultStatements)
+            self.conn.commit()
+
     def close(self):
-        # are we committed?
+        log.debug("closing db")
         self.conn.close()
-        
+
+    def _getTermId(self, term, create=False):
+        termId = self._termIds.get(term)
+        if termId is None:
+            row = self.conn.execute('SELECT id FROM terms WHERE term=?',
+                                                        (term,)).fetchone()
+            if row:
+                termId = row[0]
+            elif create:
+                termId = self.conn.execute('INSERT INTO terms (term) VALUES (?)',
+                                                        (term,)).lastrowid
+            else:
+                return None
+            self._termIds[term] = termId
+        return termId
+
+    def _getTermIds(self, terms):
+        '''
+        Add any of the given terms that aren't already in the terms table.
+        '''
+        termIds = self._termIds
+        missing = set()
+        for term in terms:
+            if term not in termIds:
+                missing.add(_normalizeTerm(term))
+        if not missing:
+            return
+        self.conn.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)',
+                                                ((term,) for term in missing))
+        missing = list(missing)
+        for i in xrange(0, len(missing), _MAX_PARAMS):
+            chunk = missing[i:i+_MAX_PARAMS]
+            termIds.update( (term, termId) for termId, term in self.conn.execute(
+                    'SELECT id, term FROM terms WHERE term IN (%s)' %
+                                                ','.join('?' * len(chunk)), chunk) )
+        for term in terms:
+            if term not in termIds:
+                termIds[term] = termIds[_normalizeTerm(term)]
+
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
-        ''' 
+        '''
         Return all the statements in the model that match the given arguments.
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
-        fs = subject is not None
-        fp = predicate is not None
-        fo = object is not None
-        fot = objecttype is not None
-        fc = context is not None
+        return list(SqliteStore.iterStatements(self, subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None,
+                      ordered=True):
+        '''
+        Statements are read from a cursor as the iterator is consumed.
+        '''
         hints = hints or {}
-        limit=hints.get('limit')
-        offset=hints.get('offset')
+        where = self._findWhere(subject, predicate, object, objecttype, context)
+        if where is None: #nothing can match
+            return iter(())
+        where, params = where
+        for pred in hints.get('predicates') or ():
+            predicateWhere = self._findPredicateWhere(*pred)
+            if predicateWhere is not None:
+                where = where + predicateWhere[0]
+                params = params + predicateWhere[1]
+
+        #if asQuad is False only return the first context for each triple
+        sql = ('SELECT s.term, p.term, o.term, t.term, %s FROM ' 
+                + _joinTerms) % (asQuad and 'c.term' or 'MIN(c.term)')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if not asQuad:
+            sql += ' GROUP BY st.s, st.p, st.o, st.t'
+        if ordered:
+            sql += asQuad and ' ORDER BY 1, 2, 3, 4, 5' or ' ORDER BY 1, 2, 3, 4'
+        limit = hints.get('limit')
+        offset = hints.get('offset')
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params.append(limit is None and -1 or limit)
+            params.append(offset or 0)
+
+        cursor = self.conn.execute(sql, params)
+        return (tuple.__new__(Statement, row) for row in cursor)
 
-        if fo:
+    def _findWhere(self, subject = None, predicate = None, object = None,
+                      objecttype=None, context=None):
+        '''
+        Returns the where clause and its parameters for the statements that
+        match, or None if no statement could match.
+        '''
+        checkLiteral = False
+        if object is not None:
             if isinstance(object, ResourceUri):
                 object = object.uri
-                fot = True
                 objecttype = OBJECT_TYPE_RESOURCE
-            elif not fot:
-                objecttype = OBJECT_TYPE_LITERAL
+            elif objecttype is None:
+                checkLiteral = True
+
+        where = []
+        params = []
+        for column, term in zip(_columns,
+                        (subject, predicate, object, objecttype, context)):
+            if term is not None:
+                termId = self._getTermId(term)
+                if termId is None: #not in the store so nothing can match
+                    return None
+                where.append('st.%s=?' % column)
+                params.append(termId)
+        if checkLiteral:
+            resourceId = self._getTermId(OBJECT_TYPE_RESOURCE)
+            if resourceId is not None:
+                where.append('st.t!=?')
+                params.append(resourceId)
+        return where, params
 
-        stmts = []
-        stmts.sort()        
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
+    def _findPredicateWhere(self, position, op, value):
+        '''
+        Translate a filterJoin() predicate to SQL that matches at least the
+        statements the predicate matches. Returns None if it can't.
+        '''
+        if position != 2: 
+            return None
+        if op == 'in':
+            terms = []
+            for v in value:
+                if isinstance(v, ResourceUri):
+                    v = v.uri
+                elif not isinstance(v, (str, unicode)):
+                    #other json values are compared by value, not text
+                    return None
+                terms.append(v)
+            termIds = filter(None, [self._getTermId(term) for term in terms])
+            if not termIds:
+                return ['0'], []
+            return ['st.o IN (%s)' % ','.join('?' * len(termIds))], termIds
+        if op == 'startswith':
+            #only literals are strings (comparing the start of the text 
+            #avoids LIKE's case-insensitivity and wildcards)
+            if not isinstance(value, (str, unicode)) or _nonAsciiRe.search(value):
+                return None
+            literalId = self._getTermId(OBJECT_TYPE_LITERAL)
+            if literalId is None:
+                return None
+            return ['(st.t!=? OR substr(o.term, 1, ?) = ?)'], [
+                                            literalId, len(value), value]
+        if isinstance(value, (str, unicode)):
+            #only literals are compared as strings and the json value of 
+            #a literal is its text, which sqlite compares the same as python
+            #(unless the value is non-ascii)
+            if _nonAsciiRe.search(value):
+                return None
+            literalId = self._getTermId(OBJECT_TYPE_LITERAL)
+            if literalId is None:
+                return None
+            return ['(st.t!=? OR o.term %s ?)' % op], [literalId, value]
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            #only numeric types are compared as numbers, every other type
+            #compares as greater or less than a number so can't be excluded
+            typeIds = filter(None, [self._getTermId(t) for t in _numericTypes])
+            if not typeIds:
+                return None
+            #casting to REAL can round so don't use a strict comparison
+            return ['(st.t NOT IN (%s) OR CAST(o.term AS REAL) %s ?)' % (
+                ','.join('?' * len(typeIds)), op[0] + '='
+                )], typeIds + [float(value)]
+        return None
+
+    canHandleJoins = True
+
+    def filterJoin(self, patterns):
+        '''
+        Finds the statements for all the patterns with one query. 
+        The conditions and the predicates that can be translated to SQL
+        are used to find the subjects that match every pattern.
+        '''
+        wheres = []
+        params = []
+        for conditions, predicates in patterns:
+            where = self._findWhere(**conditionsToKeywords(conditions))
+            if where is None: #the pattern can't match anything
+                return [[] for pattern in patterns]
+            where, whereParams = where
+            for predicate in predicates:
+                predicateWhere = self._findPredicateWhere(*predicate)
+                if predicateWhere is not None:
+                    where = where + predicateWhere[0]
+                    whereParams = whereParams + predicateWhere[1]
+            wheres.append(where and ' WHERE ' + ' AND '.join(where) or '')
+            params.append(whereParams)
+        
+        subjectsSql = ' INTERSECT '.join(['SELECT st.s FROM statements st '
+                        'JOIN terms o ON o.id=st.o' + where for where in wheres])
+        subjectsParams = sum(params, [])
+        sql = []
+        sqlParams = []
+        for i, where in enumerate(wheres):
+            sql.append(('SELECT %d, s.term, p.term, o.term, t.term, c.term FROM '
+                    + _joinTerms + (where and where + ' AND ' or ' WHERE ')
+                    + 'st.s IN (' + subjectsSql + ')') % i)
+            sqlParams.extend(params[i] + subjectsParams)
+        sql = ' UNION ALL '.join(sql) + ' ORDER BY 1, 2, 3, 4, 5, 6'
+
+        results = [[] for pattern in patterns]
+        for row in self.conn.execute(sql, sqlParams):
+            results[row[0]].append(tuple.__new__(Statement, row[1:]))
+        return [list(statementsToRows(stmts)) for stmts in results]
+
+    def _beginBatch(self):
+        '''
+        Make sure the changes that follow are made in a transaction. 
+        Returns True if the caller needs to commit it with `_endBatch()`.
+        '''
+        if self.conn.isolation_level is None:
+            #the connection doesn't begin transactions itself
+            self.conn.execute('BEGIN')
+            return True
+        #sqlite3 has begun (or will begin) a transaction itself but it 
+        #only needs to be committed now if the store is autocommitting
+        return self.autocommit
+
+    def _endBatch(self, commit):
+        if self.conn.isolation_level is None:
+            self.conn.execute(commit and 'COMMIT' or 'ROLLBACK')
+        elif commit:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        if not commit:
+            #terms added during the transaction are gone too
+            self._termIds.clear()
 
     def addStatements(self, stmts):
-        return True
+        '''
+        Add the statements in one batch.
+        '''
+        stmts = list(stmts)
+        if not stmts:
+            return
+        endTxn = self._beginBatch()
+        try:
+            self._getTermIds(set(term for stmt in stmts for term in stmt[:5]))
+            termIds = self._termIds
+            self.conn.executemany('INSERT OR IGNORE INTO statements '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [tuple(termIds[term] for term in stmt[:5]) for stmt in stmts])
+        except:
+            if endTxn:
+                self._endBatch(False)
+            else:
+                self._termIds.clear()
+            raise
+        if endTxn:
+            self._endBatch(True)
 
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
-        return True
-        
+        endTxn = self._beginBatch()
+        try:
+            row = tuple(self._getTermId(term, True) for term in stmt[:5])
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO statements VALUES (?, ?, ?, ?, ?)', row)
+        except:
+            if endTxn:
+                self._endBatch(False)
+            raise
+        if endTxn:
+            self._endBatch(True)
+        return cursor.rowcount > 0
+
     def removeStatement(self, stmt):
         '''removes the statement'''
-        #p o t => c s
-        #s => p o t c
-        return True
+        row = []
+        for term in stmt[:5]:
+            termId = self._getTermId(term)
+            if termId is None:
+                return False
+            row.append(termId)
+        endTxn = self._beginBatch()
+        try:
+            cursor = self.conn.execute('DELETE FROM statements WHERE '
+                                's=? AND p=? AND o=? AND t=? AND c=?', row)
+        except:
+            if endTxn:
+                self._endBatch(False)
+            raise
+        if endTxn:
+            self._endBatch(True)
+        return cursor.rowcount > 0
 
-class TransactionSqliteStore(TransactionModel, SqliteStore):
+class TransactionSqliteStore(SqliteStore):
     '''
-    Provides in-memory transactions to BdbStore
-
+    Changes are made in a SQLite transaction that isn't visible to other
+    connections until `commit()` is called.
     '''
+    autocommit = False
+
+    def commit(self, **kw):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+        #terms added during the transaction are gone too
+        self._termIds.clear()
@@ -50,7 +50,8 @@ from vesper.data.base import Tupleset, ColumnInfo, EMPTY_NAMESPACE, ResourceUri
 from vesper import utils, pjson
 import StringIO
 import vesper.utils._utils
-import time
+from vesper.utils import MRUCache
+import time, threading, pprint
 
 SUBJECT = 0
 PROPERTY = 1
@@ -79,7 +80,7 @@ def runQuery(query, model):
 
 def getResults(query, model, bindvars=None, explain=None, debug=False,
     forUpdate=False, captureErrors=False, contextShapes=None, useSerializer=True,
-    printast=False, queryCache=None):
+    printast=False, queryCache=None, astCache=None):
     '''
     Returns a dict with the following keys:
         
@@ -88,7 +89,7 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     
     :Parameters:
      query
-       the query
+       the query (a string or a `PreparedQuery`)
      model
        the store upon which to execute the query
     bindvars
@@ -111,6 +112,8 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
        If value is a boolean, indicates whether pjson serialization is used or 
        not (default: True). If value is a dict it is passed as keyword arguments
        to the `pjson.Serializer` constructor.
+    astCache
+       An `ASTCache` used to avoid re-parsing the query.
     '''
     #XXX? add option to include `resources` in the result,
     # a list describing the resources (used for track changes)
@@ -118,7 +121,15 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     response = utils.attrdict()
     errors = []
     
-    (ast, parseErrors) = buildAST(query)
+    if isinstance(query, PreparedQuery):
+        prepared = query
+        (ast, parseErrors) = prepared.ast, prepared.errors
+    else:
+        prepared = None
+        if astCache is not None:
+            (ast, parseErrors) = astCache.getAST(query)
+        else:
+            (ast, parseErrors) = buildAST(query)
     errors.extend(parseErrors)
     
     response['results'] = []
@@ -131,6 +142,8 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     
     if ast != None:        
         try:
+            if prepared:
+                prepared.checkBindvars(bindvars)
             results = list(evalAST(ast, model, bindvars, explain, debug, 
                     forUpdate, contextShapes, useSerializer, queryCache))
             #XXX: if forUpdate add a pjson header including namemap
@@ -170,6 +183,97 @@ def buildAST(query, namemap=None):
     from vesper.query import parse, engine
     return parse.parse(query, engine.SimpleQueryEngine.queryFunctions, False, namemap)
 
+def _astCacheKey(query, namemap=None):
+    if namemap:
+        #pformat sorts dict keys
+        return (query, pprint.pformat(namemap))
+    return (query, None)
+
+class ASTCache(MRUCache.MRUCache):
+    '''
+    A MRU cache of parsed queries keyed by the query text and namemap. 
+    The cached ASTs are shared, this is safe because evaluating an AST 
+    doesn't modify it.
+    '''
+    def __init__(self, capacity=200):
+        MRUCache.MRUCache.__init__(self, capacity, buildAST, _astCacheKey)
+        self.lock = threading.Lock()
+
+    def getAST(self, query, namemap=None):
+        "Like `buildAST()`, returns (ast, [error messages])"
+        self.lock.acquire()
+        try:
+            return self.getValue(query, namemap)
+        finally:
+            self.lock.release()
+
+def _prepareQuery(handle, prepare):
+    return prepare and prepare()
+
+def _isPreparedQuery(handle, prepared, *args):
+    if prepared is None:
+        return MRUCache.NotCacheable
+    return prepared
+
+class PreparedQueryCache(MRUCache.MRUCache):
+    '''
+    A MRU cache of `PreparedQuery` objects keyed by their handle. When it's 
+    full the least recently used ones are discarded and their clients will 
+    need to prepare them again.
+    '''
+    def __init__(self, capacity=1000):
+        MRUCache.MRUCache.__init__(self, capacity, _prepareQuery, 
+            lambda handle, prepare: handle, 
+            isValueCacheableCalc=_isPreparedQuery)
+        self.lock = threading.Lock()
+
+    def getPreparedQuery(self, handle, prepare=None):
+        '''
+        Return the prepared query with the given handle. If it isn't cached
+        `prepare()` is called to create it, or None is returned if `prepare`
+        isn't given.
+        '''
+        self.lock.acquire()
+        try:
+            return self.getValue(handle, prepare)
+        finally:
+            self.lock.release()
+
+class PreparedQuery(object):
+    '''
+    A query that is parsed once and can be executed many times with 
+    different bind variables. Usually created by `DataStore.prepare()`.
+    Pass it to `getResults()` (or `DataStore.query()`) in place of the 
+    query string.
+    '''
+    store = None
+    handle = None
+
+    def __init__(self, query, astCache=None):
+        from vesper.query import jqlAST
+        self.query = query
+        if astCache is not None:
+            (ast, errors) = astCache.getAST(query)
+        else:
+            (ast, errors) = buildAST(query)
+        if ast is None:
+            raise QueryException('query failed to parse: ' + '; '.join(errors))
+        self.ast = ast
+        self.errors = errors
+        #the names of the bind variables the query expects
+        self.bindvars = frozenset([op.name for op in ast.depthfirst()
+                                    if isinstance(op, jqlAST.BindVar)])
+
+    def checkBindvars(self, bindvars):
+        missing = self.bindvars.difference(bindvars or ())
+        if missing:
+            raise QueryException('missing bindvars: ' + 
+                                        ', '.join(sorted(missing)))
+
+    def execute(self, bindvars=None, **kw):
+        "Execute the query on the DataStore that prepared it"
+        return self.store.query(self, bindvars, **kw)
+
 def _parsePjson(parseContext, v):
     #XXX handle pjson dicts
     if isinstance(v, (str, unicode)):
@@ -221,6 +325,8 @@ class QueryContext(object):
     finalizedAggs = False
     groupby = None
     complexPredicateHack = False
+    #rows for a filter that were already fetched (see engine._pushdownJoin)
+    prefetched = None
     
     def __init__(self, initModel, ast, explain=False, bindvars=None, debug=False,
             depth=0, forUpdate=False, shapes=None, serializer=None, cache=None):
@@ -15,7 +15,7 @@ from vesper.data import base
 from vesper.utils import flattenSeq, flatten, debugp
 from vesper import pjson
 from vesper.query import *
-from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, IterationJoin
+from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, IterationJoin, HashJoin, MergeJoin
 from vesper.backports import product
 
 #############################################################
@@ -187,27 +187,23 @@ def chooseColumns(groupby, columns, includekey=False):
         outputcolumns.append(groupbycol) #goes last
     return MutableTupleset(columns=outputcolumns)
 
-def groupbyOrdered(tupleset, groupby, debug=False):
+def groupbyOrdered(tupleset, groupby, debug=False, outerjoin=False, includekey=False):
     '''
     More efficient version of groupbyUnordered -- use if the tupleset is
-    ordered by column in the given pos
+    ordered by the (top-level) groupby column. The groups are yielded in key 
+    order as soon as they are complete instead of being held in memory.
     '''
-    previous = None
+    previous = vals = None
     for row in tupleset:
-        cols = []
-        keycell = None
-        for i, cell in enumerate(row):
-            if i == groupby:
-                keycell = cell
-            else:
-                cols.append(cell)
-        assert keycell is not None
-        if keycell != previous:
-            yield [previous, vals]
-            vals = MutableTupleset()
-            previous = keycell
-        vals.append(cols)
-    if previous is not None:
+        if debug: validateRowShape(tupleset.columns, row)
+        for key, outputrow in getColumns(groupby, row, outerjoin=outerjoin, includekey=includekey):
+            if vals is None or key != previous:
+                if vals is not None:
+                    yield [previous, vals]
+                vals = MutableTupleset()
+                previous = key
+            vals.append(outputrow)
+    if vals is not None:
         yield [previous, vals]
 
 #############################################################
@@ -268,6 +264,8 @@ class QueryFuncs(object):
         self.addFunc('trim', lambda a,chars=None: a.strip(chars), StringType, checkForNulls=1)
         self.addFunc('ltrim', lambda a,chars=None: a.lstrip(chars), StringType, checkForNulls=1)
         self.addFunc('rtrim', lambda a,chars=None: a.rstrip(chars), StringType, checkForNulls=1)
+        self.addFunc('startswith', lambda a, prefix: 
+            isinstance(a, basestring) and a.startswith(prefix), BooleanType)
 
 def followFunc(reverse, context, startid, propname=None, excludeInitial=False,
                                                         edgesOnly=False):
@@ -983,9 +981,7 @@ class SimpleQueryEngine(object):
                                                     debug=context.debug)
 
     def evalOrderBy(self, op, context):
-        #XXX only order by if orderby is different then current order of tupleset
         tupleset = context.currentTupleset
-        tupleset = MutableTupleset(tupleset.columns, tupleset, hint=tupleset, op='order by')
 
         assert all(isinstance(s.exp, jqlAST.Project) for s in op.args), 'only property name lists currently implemented'        
         #print 'c', tupleset.columns, [s.exp.name for s in op.args]
@@ -996,6 +992,16 @@ class SimpleQueryEngine(object):
                 return tupleset.findColumnPos(project.name) 
         positions = [getpos(s.exp) for s in op.args]
 
+        ordering = None
+        if len(positions) == 1 and op.args[0].asc and positions[0]:
+            if positions[0] == (tupleset.ordering,):
+                #already in the right order
+                return tupleset
+            if len(positions[0]) == 1:
+                ordering = positions[0][0]
+        tupleset = MutableTupleset(tupleset.columns, tupleset, hint=tupleset, op='order by')
+        tupleset.ordering = ordering
+
         reverse = all(not s.asc for s in op.args) #all desc
         if not reverse and not all(s.asc for s in op.args):
             #mixed asc and desc
@@ -1039,12 +1045,14 @@ class SimpleQueryEngine(object):
     def costGroupBy(self, op, context):
         return 1.0
 
-    def _groupby(self, tupleset, joincond, msg='group by ',debug=False):
+    def _groupby(self, tupleset, joincond, msg='group by ',debug=False, 
+                                                            reorder=False):
         '''
         group the given tupleset by the column specified by given join condition
         and return a tupleset whose first column is the group by key.
+        If `reorder` is True and the tupleset is ordered by the group by key
+        the groups are returned in key order (without building them all first).
         '''
-        #XXX use groupbyOrdered if we know tupleset is ordered by groupby key
         position = tupleset.findColumnPos(joincond.position)
         assert position is not None, 'cant find %r in %s %s' % (
                     joincond.position, tupleset, tupleset.columns)
@@ -1059,11 +1067,19 @@ class SimpleQueryEngine(object):
                                 chooseColumns(position,tupleset.columns, includekey) )
         ]
         outerjoin = joincond.join in ('r')
-        return SimpleTupleset(
-            lambda: groupbyUnordered(tupleset, position,
+        if reorder and (tupleset.ordering,) == position:
+            groupby = groupbyOrdered
+            msg = 'ordered ' + msg
+        else:
+            groupby = groupbyUnordered
+        grouped = SimpleTupleset(
+            lambda: groupby(tupleset, position,
                                     debug and columns, outerjoin, includekey),
             columns=columns,
             hint=tupleset, op=msg + repr((joincond.join, joincond.position)),  debug=debug)
+        if groupby is groupbyOrdered:
+            grouped.ordering = 0
+        return grouped
 
     def reorderWithListInfo(self, context, op, listval):
         if isinstance(op.name, int):
@@ -1152,9 +1168,11 @@ class SimpleQueryEngine(object):
             #put non-inner joins and filters with complex predicates last
             #XXX: we should do semantic ordering earlier so it shows up in the ast
             #and maybe mark each group so we can do this cost-based ordering per group
+            #nested joins can be joined on a label of the other arguments
+            #so they go after the filters whatever they cost
             (getattr(arg.leftPosition, 'startswith', lambda s:False)('#@'),
             getattr(arg.op, 'complexPredicates', False), arg.join != 'i',
-                                                arg.op.cost(self, context)) )
+            isinstance(arg.op, jqlAST.Join), arg.op.cost(self, context)) )
 
         tmpop = None
         if not args or args[0].join != 'i':
@@ -1173,11 +1191,12 @@ class SimpleQueryEngine(object):
         # use that as source of the filter
         # 2. estimate and compare cost of using the prior result so next filter
         # can use that as source (compare with cost of filtering with current source)
-        # 3.if we know results are ordered properly we can do a MergeJoin
-        #   (more efficient than IterationJoin):
-        #lslice = slice( joincond.position, joincond.position+1)
-        #rslice = slice( 0, 1) #curent tupleset
-        #current = MergeJoin(result, current, lslice,rslice)
+        prefetched = self._pushdownJoin(args, context)
+        hasStatistics = self._getStatistics(context) is not None
+        #the order of the join's rows only matters if the select won't sort
+        #them by the join key (the groups of the right-side tuplesets are 
+        #always looked up by key so their order never matters)
+        reorderFirst = self._isSortedByJoinKey(op)
         previous = None
         #print 'evaljoin', args
         while args:
@@ -1189,6 +1208,9 @@ class SimpleQueryEngine(object):
             if previous and isinstance(joincond.op, jqlAST.Filter) and joincond.op.complexPredicates:
                 fcontext = copy.copy(context)
                 fcontext.currentTupleset = previous
+            elif id(joincond) in prefetched:
+                fcontext = copy.copy(context)
+                fcontext.prefetched = prefetched[id(joincond)]
             else:
                 fcontext = context
 
@@ -1200,7 +1222,8 @@ class SimpleQueryEngine(object):
             if joincond.join == 'x':
                 current = result
             else:
-                current = self._groupby(result, joincond,debug=context.debug)
+                current = self._groupby(result, joincond,debug=context.debug,
+                            reorder=previous is not None or reorderFirst)
             
             if previous:
                 def mergeColumns(left, right):
@@ -1355,14 +1378,115 @@ class SimpleQueryEngine(object):
                         'l', previous, indexToLeft, nullrows, leftpos, previous),
                                     columns,joincond.name,debug=context.debug)
                 else:
-                    previous = IterationJoin(previous, current, bindjoinFunc(
-                     joincond, current, indexToLeft, nullrows, leftpos, previous),
+                    joinFunc = bindjoinFunc(joincond, current, indexToLeft, 
+                                            nullrows, leftpos, previous)
+                    if jointype == 'x': #no join key to hash
+                        previous = IterationJoin(previous, current, joinFunc,
                                     columns,joincond.name,debug=context.debug)
+                    elif (isinstance(leftpos, int) and current.ordering == 0
+                            and previous.ordering == leftpos):
+                        #both sides are sorted by the join key
+                        previous = MergeJoin(previous, current, joinFunc, 
+                            leftpos, columns, joincond.name,debug=context.debug)
+                    else:
+                        if isinstance(leftpos, int):
+                            leftKeys = lambda row, pos=leftpos: (row[pos],)
+                        else:
+                            leftKeys = lambda row, pos=leftpos: [c[0] 
+                                                for c in getColumn(pos, row)]
+                        #build the hash table on the side that's expected to
+                        #be smaller (we can only tell if the model has 
+                        #statistics, see costFilter())
+                        cost = joincond.op.cost(self, context)
+                        buildLeft = hasStatistics and previousCost < cost
+                        previous = HashJoin(previous, current, joinFunc, 
+                                    leftKeys, buildLeft, columns, 
+                                    joincond.name, debug=context.debug)
+                        if jointype == 'i':
+                            previousCost = min(previousCost, cost)
             else:
                 previous = current
+                previousCost = joincond.op.cost(self, context)
 
         return previous
 
+    def _isSortedByJoinKey(self, op):
+        '''
+        Returns True if the select that the join belongs to sorts its rows
+        by the join key first (so the join can produce them in any order).
+        '''
+        select = op.parent
+        if not isinstance(select, jqlAST.Select) or select.where is not op:
+            return False
+        if not select.orderby or select.groupby:
+            return False
+        exp = select.orderby.args[0].exp
+        return exp.isPosition() and exp.name == 0
+
+    def _pushdownJoin(self, args, context):
+        '''
+        If the model can evaluate joins (e.g. it is SQL-backed), fetch the
+        rows for all the filters that are inner joined on the subject with 
+        one call to the model, restricting them to the subjects that match 
+        each filter. Returns a dict mapping the id of those join conditions 
+        to their rows.
+        '''
+        model = context.initialModel
+        if (context.currentTupleset is not model 
+                or not getattr(model, 'canHandleJoins', False)):
+            return {}
+        group = []
+        patterns = []
+        for joincond in args:
+            op = joincond.op
+            if (joincond.join != 'i' or joincond.leftPosition != SUBJECT
+                    or not isinstance(op, jqlAST.Filter) 
+                    or (joincond.position, SUBJECT) not in op.labels
+                    or op.complexPredicates or op.isIndependent()
+                    or [a for a in op.args if a.saveValue]):
+                continue
+            simplefilter, complexargs = self._findSimplePredicates(op, context)
+            patterns.append( (simplefilter, 
+                    self._findPushdownPredicates(complexargs, context)) )
+            group.append(joincond)
+        if not group:
+            return {}
+        results = model.filterJoin(patterns)
+        return dict( (id(joincond), rows) for joincond, rows in zip(group, results) )
+
+    def _findPushdownPredicates(self, complexargs, context):
+        '''
+        Find the comparisons with constants in the filter's predicates that
+        the model can use to narrow down the statements it returns.
+        '''
+        #(op doesn't have complexPredicates so projections refer to its rows)
+        reverse = { '<' : '>', '<=' : '>=', '>' : '<', '>=' : '<=' }
+        def isObject(proj):
+            return (isinstance(proj, jqlAST.Project) and proj.isPosition() 
+                                                and proj.name == OBJECT)
+        predicates = []
+        for pred in complexargs:
+            if isinstance(pred, jqlAST.In):
+                if isObject(pred.args[0]) and [a for a in pred.args[1:]
+                                if isinstance(a, jqlAST.Constant)] == pred.args[1:]:
+                    values = [a.evaluate(self, context) for a in pred.args[1:]]
+                    predicates.append( (OBJECT, 'in', values) )
+            elif isinstance(pred, jqlAST.Cmp):
+                if isObject(pred.left) and isinstance(pred.right, jqlAST.Constant):
+                    predicates.append( (OBJECT, pred.op, 
+                                        pred.right.evaluate(self, context)) )
+                elif isObject(pred.right) and isinstance(pred.left, jqlAST.Constant):
+                    predicates.append( (OBJECT, reverse[pred.op], 
+                                        pred.left.evaluate(self, context)) )
+            elif (isinstance(pred, jqlAST.AnyFuncOp) 
+                    and pred.name == (EMPTY_NAMESPACE, 'startswith')
+                    and len(pred.args) == 2 and isObject(pred.args[0])
+                    and isinstance(pred.args[1], jqlAST.Constant)):
+                prefix = pred.args[1].evaluate(self, context)
+                if isinstance(prefix, basestring):
+                    predicates.append( (OBJECT, 'startswith', prefix) )
+        return predicates
+
     def _findSimplePredicates(self, op, context):
         simpleops = (jqlAST.Eq,) #only Eq supported for now
         complexargs = []
@@ -1418,17 +1542,47 @@ class SimpleQueryEngine(object):
             for label, pos in op.labels:
                 yield row[pos]
 
+        def mapOrdering(ordering):
+            #position of the sorted column after colmap is applied
+            for i, (label, pos) in enumerate(op.labels):
+                if pos == ordering:
+                    return i
+            return None
+
         tupleset = context.currentTupleset        
         
+        #let the model use the range, in and prefix tests to skip statements
+        #(they are still checked below since the model might not use them)
+        hints = None
+        if (context.prefetched is None and complexargs and not saveValue
+                and not op.complexPredicates 
+                and tupleset is context.initialModel):
+            predicates = self._findPushdownPredicates(complexargs, context)
+            if predicates:
+                hints = { 'predicates' : predicates }
+
+        if context.prefetched is not None:
+            #_pushdownJoin() already applied the simple predicates
+            tupleset = SimpleTupleset(
+                lambda rows=context.prefetched: iter(rows),
+                columns = complexargs and tupleset.columns or columns,
+                colmap = not complexargs and colmap or None,
+                hint=tupleset, op='selectWithValue1 (pushed down)', 
+                debug=context.debug)
         #first apply all the simple predicates that we assume are efficient
-        if simplefilter or not complexargs:
+        elif simplefilter or hints or not complexargs:
             #XXX: optimization: if cost is better filter on initialmodel
             #and then find intersection of result and currentTupleset
+            source = tupleset
             tupleset = SimpleTupleset(
-                lambda tupleset=tupleset: tupleset.filter(simplefilter),
+                lambda tupleset=tupleset: tupleset.filter(simplefilter, hints),
                 columns = complexargs and tupleset.columns or columns,
                 colmap = not complexargs and colmap or None,
                 hint=tupleset, op='selectWithValue1', debug=context.debug)
+            if complexargs:
+                tupleset.ordering = source.ordering
+            else:
+                tupleset.ordering = mapOrdering(source.ordering)
 
         if not complexargs:            
             return tupleset
@@ -1478,8 +1632,10 @@ class SimpleQueryEngine(object):
 
         opmsg = 'complexfilter:'+ str(complexargs)
         
-        return SimpleTupleset(filterRows, hint=tupleset,columns=columns,
+        filtered = SimpleTupleset(filterRows, hint=tupleset,columns=columns,
                 colmap=colmap, op=opmsg, debug=context.debug)
+        filtered.ordering = mapOrdering(tupleset.ordering)
+        return filtered
 
     def buildObject(self, context, v, handleNil):
         if handleNil and v == NilResource:
@@ -1591,8 +1747,11 @@ class SimpleQueryEngine(object):
             return val
 
     def costProject(self, op, context):
-        #if op.name == "*": 
-        return 1.0 #XXX
+        #the fraction of the statements with the projected property
+        stats = self._getStatistics(context)
+        if not stats or op.isPosition() or op.name == '*':
+            return 1.0
+        return stats.estimate(predicate=op.name) / stats.total
 
     def evalLabel(self, op, context):
         position = context.currentTupleset.findColumnPos(op.name)
@@ -1604,41 +1763,35 @@ class SimpleQueryEngine(object):
     def costLabel(self, op, context):
         return 1.0
 
-    def costFilter(self, op, context):
-        return 1.0 #XXX
-
-        #simple cheaper than complex
-        #dependent cheaper then
-        #subject cheaper object cheaper than predicate
-        SIMPLECOST = [1, 4, 2]
-        #we have to evaluate each row
-        COMPLEXCOST = []
-        #we have to evaluate each row
-        DEPENDANTCOST = []
-
-        cost = 0 #no-op
-        for i, pred in enumerate(op.args):
-            if not pred:
-                continue
-            assert pred.getType() == BooleanType
-            assert pred.left
-            #XXX dont yet support something like: where customcompare(prop1, prop2)
-            assert pred.right is None, 'multi-prop compares not yet implemented'
-
-            if pred.left.isIndependent():
-                if isinstance(pred, jqlAST.Eq): #simple
-                    positioncost = SIMPLECOST
-                else:
-                    positioncost = COMPLEXCOST
-            else:
-                positioncost = DEPENDANTCOST
-
-            cost += (pred.left.cost(self, context) * positioncost[i])
+    def _getStatistics(self, context):
+        getStatistics = getattr(context.initialModel, 'getStatistics', None)
+        stats = getStatistics and getStatistics()
+        if not stats or not stats.total:
+            return None
+        return stats
 
-        return cost
+    def costFilter(self, op, context):
+        #estimate the fraction of the model's statements that the filter's 
+        #simple predicates match. if the model doesn't keep statistics all 
+        #filters cost the same so the join order is left as is
+        stats = self._getStatistics(context)
+        if not stats:
+            return 1.0
+        simplefilter, complexargs = self._findSimplePredicates(op, context)
+        estimate = stats.estimate(simplefilter.get(SUBJECT), 
+                    simplefilter.get(PROPERTY), simplefilter.get(OBJECT))
+        return estimate / stats.total
 
     def costJoin(self, op, context):
-        return 2.0 #XXX
+        #an inner join can't match more than its most selective argument
+        stats = self._getStatistics(context)
+        if not stats:
+            return 2.0
+        costs = [arg.op.cost(self, context) for arg in op.args
+                                                    if arg.join == 'i']
+        if not costs:
+            return 1.0
+        return min(costs)
 
         args = list(flattenSeq(op.args))
         #like costAndOp:
@@ -1691,8 +1844,21 @@ class SimpleQueryEngine(object):
                 return rvalue in lvalue
         return lvalue == rvalue
 
-    def costEq(self, op, context): #XXX
+    def costEq(self, op, context):
         assert len(op.args) == 2, op
+        stats = self._getStatistics(context)
+        if stats:
+            #property = value: the fraction of statements that match
+            left, right = op.args
+            if not isinstance(left, jqlAST.Project):
+                left, right = right, left
+            if (isinstance(left, jqlAST.Project) and not left.isPosition() 
+                    and left.name != '*' 
+                    and isinstance(right, (jqlAST.Constant, jqlAST.BindVar))):
+                value = right.evaluate(self, context)
+                if not isinstance(value, (list, tuple, dict)):
+                    return stats.estimate(predicate=left.name, 
+                                                object=value) / stats.total
         return op.args[0].cost(self, context) + op.args[1].cost(self, context)
 
     def evalCmp(self, op, context):
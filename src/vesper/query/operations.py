@@ -241,9 +241,12 @@ class IterationJoin(Join):
     Corresponds to an join of two tuplesets
     Can be a inner join or right outer join, depending on joinFunc
     '''
+
+    def _joinTuples(self):
+        return joinTuples(self.left, self.right, self.joinFunc)
         
     def filter(self, conditions=None, hints=None):
-        for left, right in joinTuples(self.left, self.right, self.joinFunc):
+        for left, right in self._joinTuples():
             row = left + right
             if conditions:
                 for key, value in conditions.iteritems():
@@ -255,47 +258,111 @@ class IterationJoin(Join):
             else:
                 yield row
 
-class MergeJoin(Join):
+class _HashTable(object):
+    '''
+    The right side of a HashJoin: rows looked up by their first column.
+    '''
+    def __init__(self, index):
+        self.index = index
+
+    def filter(self, conditions=None, hints=None):
+        assert conditions and len(conditions) == 1 and 0 in conditions, (
+                                    'can only filter on the join key')
+        return iter(self.index.get(conditions[0], ()))
+
+class HashJoin(IterationJoin):
+    '''
+    Joins on the first column of the right tupleset by building a hash table
+    of the right rows once and then probing it for each left row, so the 
+    results are in the same order as with an IterationJoin. `joinFunc` is 
+    the same as IterationJoin's but the right table it is passed can only be 
+    filtered by its first column.
+
+    If `buildLeft` is True the left side is read first and only the right 
+    rows whose key matches a left row are kept in the hash table (use this 
+    when the left side is expected to be smaller). `leftKeys` is a function 
+    that returns the join keys of a left row.
+    '''
+    
+    def __init__(self, left, right, joinFunc, leftKeys=None, buildLeft=False,
+                                        columns=None, msg='', debug=False):
+        IterationJoin.__init__(self, left, right, joinFunc, columns, msg, debug)
+        self.leftKeys = leftKeys
+        self.buildLeft = buildLeft and leftKeys is not None
+        self.index = None
+        #rows are returned in the left table's order
+        self.ordering = left.ordering
+
+    def _joinTuples(self):
+        left = self.left
+        index = self.index
+        if index is None:
+            if self.buildLeft:
+                left = list(left)
+                keys = set()
+                for row in left:
+                    keys.update(self.leftKeys(row))
+            else:
+                keys = None
+            index = {}
+            for row in self.right:
+                key = row[0]
+                if keys is None or key in keys:
+                    rows = index.get(key)
+                    if rows is None:
+                        index[key] = [row]
+                    else:
+                        rows.append(row)
+            #reuse the hash table if we're filtered again
+            self.index = index
+        return joinTuples(left, _HashTable(index), self.joinFunc)
+
+    def getJoinType(self):
+        return 'hash join (build %s)' % (self.buildLeft and 'left' or 'right')
+
+class MergeJoin(IterationJoin):
     '''
     Assuming the left and right tables are ordered by the columns 
     used by the join condition, do synchronized walk through of each table.
+    The right table is joined on its first column and `lpos` is the position
+    of the join column in the left table. Like HashJoin, `joinFunc` is the 
+    same as IterationJoin's but the right table it is passed can only be 
+    filtered by its first column. Only the right rows for the current key 
+    are kept in memory.
     '''
         
-    def __init__(self, left, right, lpos, rpos, msg=''):
-        self.left = left
-        self.right = right
-        self.leftJoinSlice = lpos
-        self.rightJoinSlice = rpos
-        self.msg = msg
-        
-    def _filter(self, conditions=None):
-        li = iter(self.left)
+    def __init__(self, left, right, joinFunc, lpos, columns=None, msg='', 
+                                                                debug=False):
+        IterationJoin.__init__(self, left, right, joinFunc, columns, msg, debug)
+        self.leftJoinPos = lpos
+        self.ordering = left.ordering
+
+    def _joinTuples(self):
+        lpos = self.leftJoinPos
+        joinFunc = self.joinFunc
         ri = iter(self.right)
-        lpos = self.leftJoinSlice 
-        rpos=self.rightJoinSlice
-        
-        l = li.next(); r = ri.next()
-        while 1:        
-            while l[lpos] < r[rpos]:
-                l = li.next() 
-            while r[rpos] < l[lpos]:
-                r = ri.next()        
-            if l[lpos] == r[rpos]:
-                #inner join 
-                if conditions:
-                    row = l + r
-                    for key, value in conditions.iteritems():
-                        if row[key] != value:
-                            break
-                    else:
-                        yield l, r
-                else:
-                    yield l, r
-                l = li.next();
-    
-    def filter(self, conditions=None, hints=None):
-        for left, right in self._filter(conditions):
-            yield left+right
+        def nextRight():
+            for row in ri:
+                return row
+            return None
+        r = nextRight()
+        table = _HashTable({})
+        key = None
+        lastRowA = None
+        for rowA in self.left:
+            if not table.index or rowA[lpos] != key:
+                key = rowA[lpos]
+                rows = []
+                while r is not None and r[0] < key:
+                    r = nextRight()
+                while r is not None and r[0] == key:
+                    rows.append(r)
+                    r = nextRight()
+                table.index = { key : rows }
+            for resultRow in joinFunc(rowA, table, lastRowA):
+                if resultRow is not None:
+                    yield rowA, resultRow
+                lastRowA = rowA, resultRow
 
     def getJoinType(self):
         return 'ordered merge'
@@ -46,7 +46,7 @@ class JsonqlLexer(RegexLexer):
             #built-in functions
             (r'(sum|count|total|avg|min|max|number|string|bool|'
              r'if|follow|isbnode|isref|'
-             r'upper|lower|trim|ltrim|rtrim)\b', Name.Builtin),
+             r'upper|lower|trim|ltrim|rtrim|startswith)\b', Name.Builtin),
             #user-defined function:
             (r'[A-Za-z_$][\w_$]*(?=\()', Name.Function),
             (r'[0-9][0-9]*\.[0-9]+([eE][0-9]+)?[fd]?', Number.Float),
@@ -76,6 +76,31 @@ def datarequest(kw, retval):
                 response['error'] = dict(code=0, message='query failed', 
                                                     data = result.errors)
                 return response
+        elif action == 'prepare':
+            #returns { handle, bindvars }, pass the handle to 'execute'
+            if not isinstance(data, (str, unicode)):
+                data = data['query']
+            try:
+                prepared = dataStore.prepare(data)
+            except vesper.query.QueryException, qe:
+                response['error'] = dict(code=0, message='query failed', 
+                                                    data = [str(qe)])
+                return response
+            result = dict(handle=prepared.handle, 
+                                bindvars=sorted(prepared.bindvars))
+        elif action == 'execute':
+            #like 'query' but with the handle returned by 'prepare'
+            data = dict(data)
+            prepared = dataStore.getPreparedQuery(data.pop('handle', None))
+            if not prepared:
+                response['error'] = dict(code=0, message='unknown handle')
+                return response
+            data['captureErrors'] = True
+            result = prepared.execute(**data)
+            if result.errors:
+                response['error'] = dict(code=0, message='query failed', 
+                                                    data = result.errors)
+                return response
         elif action == 'remove':
             removeJson = dataStore.remove(data)
             result = dict(removed=removeJson)
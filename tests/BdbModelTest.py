@@ -9,6 +9,35 @@ import string, random, shutil, time
 
 import modelTest 
 from vesper.data.store.bdb import BdbStore, TransactionBdbStore
+from vesper.data.base import Statement
+
+def verifyIndexes(model):
+    '''
+    Check that the predicate, object and context indexes have exactly the 
+    entries for the statements in the subject database. Returns a list 
+    describing each missing or extra entry.
+    '''
+    stmts = list(model._iterRows(None, None, None, None, None))
+    problems = []
+    for db, makeEntry in model._indexes():
+        if db is model.sDb.db:
+            continue
+        expected = set(makeEntry(stmt) for stmt in stmts)
+        found = set()
+        cursor = db.cursor()
+        try:
+            rec = cursor.first()
+            while rec:
+                found.add(tuple(rec))
+                rec = cursor.next()
+        finally:
+            cursor.close()
+        name = makeEntry.__name__
+        problems.extend('%s missing %r' % (name, entry) 
+                                        for entry in expected - found)
+        problems.extend('%s extra %r' % (name, entry) 
+                                        for entry in found - expected)
+    return problems
 
 class BdbModelTestCase(modelTest.BasicModelTestCase):
     
@@ -30,5 +59,157 @@ class BdbModelTestCase(modelTest.BasicModelTestCase):
         #print 'tear down removing', self.tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def testAddStatements(self):
+        model = self.getModel()
+        stmts = [Statement('bnode:jlist:1', 'rdf:_2', 'b'), 
+                 Statement('bnode:jlist:1', 'rdf:_1', 'a'),
+                 Statement('s', 'p', 'bnode:jlist:1', 'R')]
+        model.addStatements(stmts + stmts[:1])
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        self.assertEqual(model.addStatement(stmts[0]), False)
+        self.assertEqual(model.removeStatement(stmts[0]), True)
+        self.assertEqual(model.removeStatement(stmts[0]), False)
+
+        model = self.getTransactionModel()
+        model.addStatements(stmts)
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        model.rollback()
+        self.assertEqual(model.getStatements(), sorted(stmts[1:]))
+
+    def testTransactions(self):
+        stmts = [Statement('s%d' % i, 'p', 'o%d' % i) for i in range(3)]
+        model = self.getTransactionModel()
+        model.addStatements(stmts[:2])
+        #nothing is written until commit
+        self.assertEqual(self.getModel().getStatements(), [])
+        model.commit()
+        self.assertEqual(self.getModel().getStatements(), stmts[:2])
+
+        #if writing the changes fails none of them are committed
+        model.removeStatement(stmts[0])
+        model.addStatement(stmts[2])
+        model.addStatement(Statement('s', 'p', 'bad\0'))
+        self.assertRaises(RuntimeError, model.commit)
+        self.assertEqual(model._txn, None)
+        self.assertEqual(model._txnCursors, {})
+        self.assertEqual(self.getModel().getStatements(), stmts[:2])
+        model.rollback()
+        self.assertEqual(model.getStatements(), stmts[:2])
+        model.addStatement(stmts[2])
+        model.commit()
+        self.assertEqual(self.getModel().getStatements(), stmts)
+
+        #the queued additions are written with one _putStatements() call
+        batches = []
+        putStatements = model._putStatements
+        def recordBatch(stmts):
+            batches.append(list(stmts))
+            return putStatements(stmts)
+        model._putStatements = recordBatch
+        more = [Statement('t%d' % i, 'p', 'o') for i in range(5)]
+        model.addStatements(more)
+        model.removeStatement(stmts[0])
+        model.commit()
+        self.assertEqual(batches, [more])
+        self.assertEqual(self.getModel().getStatements(), 
+                                                sorted(stmts[1:] + more))
+
+    def testCursorsClosed(self):
+        stmts = [Statement('s%d' % i, 'p', 'o%d' % i) for i in range(3)]
+        model = self.getModel()
+        model.addStatements(stmts)
+        model.autocommit = False
+        model.removeStatement(stmts[0])
+        self.assertEqual(list(model.iterStatements(predicate='p')), stmts[1:])
+        self.assertEqual(model._txnCursors, {})
+        #an abandoned iterator closes its cursor when it is garbage collected
+        stmtIter = model.iterStatements(subject='s1')
+        self.assertEqual(stmtIter.next(), stmts[1])
+        self.assertEqual(len(model._txnCursors), 1)
+        del stmtIter
+        self.assertEqual(model._txnCursors, {})
+        stmtIter = model.iterStatements()
+        stmtIter.next()
+        model.commit()
+        self.assertEqual(model._txnCursors, {})
+        self.assertEqual(self.getModel().getStatements(), stmts[1:])
+
+        #a failed delete closes its cursors so the transaction can end
+        model.autocommit = True
+        self.assertRaises(RuntimeError, model.removeStatement, 
+                                        Statement('s', 'p', 'bad\0'))
+        self.assertEqual(model._txn, None)
+        self.assertEqual(model._txnCursors, {})
+
+class IndexedBdbModelTestCase(BdbModelTestCase):
+
+    def getModel(self):
+        model = BdbStore(self.tmpfilename, objectIndex=True, contextIndex=True)
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        model = TransactionBdbStore(self.tmpfilename, objectIndex=True,
+                                                        contextIndex=True)
+        return self._getModel(model)
+
+    def testIndexes(self):
+        stmts = [Statement('s1', 'p', 'o', 'L', 'c1'), 
+                 Statement('s2', 'p2', 'o', 'R', 'c1'),
+                 Statement('s1', 'p2', 'o2', 'L', 'c2')]
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.close()
+        #the indexes are built when opening an existing store
+        model = self.getModel()
+        self.assertEqual(verifyIndexes(model), [])
+        self.assertEqual(model.getStatements(object='o'), stmts[:2])
+        self.assertEqual(model.getStatements(object='o', objecttype='R'), 
+                                                            stmts[1:2])
+        self.assertEqual(model.getStatements(context='c1'), stmts[:2])
+        self.assertEqual(model.getStatements(predicate='p2', context='c2'), 
+                                                            stmts[2:])
+        model.removeStatement(stmts[1])
+        self.assertEqual(model.getStatements(context='c1'), stmts[:1])
+        self.assertEqual(model.getStatements(object='o', objecttype='R'), [])
+        self.assertEqual(verifyIndexes(model), [])
+
+    def testIndexConsistency(self):
+        stmts = [Statement('s%d' % i, 'p%d' % (i % 3), 'o%d' % (i % 4), 'L', 
+                                            'c%d' % (i % 2)) for i in range(20)]
+        def check(model):
+            self.assertEqual(verifyIndexes(model), [])
+            allStmts = model.getStatements()
+            for i in range(4):
+                self.assertEqual(model.getStatements(object='o%d' % i), 
+                    [s for s in allStmts if s.object == 'o%d' % i])
+            for i in range(2):
+                self.assertEqual(model.getStatements(context='c%d' % i), 
+                    [s for s in allStmts if s.scope == 'c%d' % i])
+
+        model = self.getModel()
+        model.addStatements(stmts)
+        check(model)
+        for stmt in stmts[::3]:
+            self.assertEqual(model.removeStatement(stmt), True)
+        self.assertEqual(model.removeStatement(stmts[0]), False)
+        check(model)
+        #re-adding statements only adds the ones that were removed
+        self.assertEqual(model.addStatement(stmts[1]), False)
+        model.addStatements(stmts[:6] + [Statement('s0', 'p0', 'o1', 'R', 'c0')])
+        check(model)
+        model.close()
+
+        model = self.getTransactionModel()
+        model.addStatement(Statement('s1', 'p1', 'o3', 'L', 'c1'))
+        model.removeStatement(stmts[2])
+        model.rollback()
+        check(model)
+        model.addStatement(Statement('s1', 'p1', 'o3', 'L', 'c1'))
+        model.removeStatement(stmts[2])
+        model.commit()
+        check(model)
+        model.close()
+        check(self.getModel())
+
 if __name__ == '__main__':
     modelTest.main(BdbModelTestCase)
@@ -9,7 +9,7 @@ import string, random, shutil, time
 
 import modelTest 
 from vesper.data.base import Statement
-from vesper.data.store.basic import FileStore, TransactionFileStore, IncrementalNTriplesFileStore, IncrementalNTriplesFileStoreBase
+from vesper.data.store.basic import FileStore, TransactionFileStore, IncrementalNTriplesFileStore, IncrementalNTriplesFileStoreBase, loadSnapshot
 
 class FileModelTestCase(modelTest.BasicModelTestCase):
     
@@ -111,9 +111,148 @@ class FileModelTestCase(modelTest.BasicModelTestCase):
             self.assertFalse('expected exception during commit')
         self.assertEqual(open(model.path).read(), overwriteString)
         
+    def testLoad(self):
+        "load the file as the number of statements grows (-b to change)"
+        for count in (modelTest.BIG, modelTest.BIG * 10):
+            model = self.getModel()
+            for i in xrange(count):
+                subj = 's%d' % i
+                model.addStatements([Statement(subj, 'pred'+str(j), 'obj'+str(j)) 
+                                                            for j in xrange(7)])
+            model.commit()
+            model = self.getModel()
+            self.assertEqual(len(model.getStatements()), count * 7)
+            os.remove(self.tmpfilename)
+
 class MultipartJsonFileModelTestCase(FileModelTestCase):
     EXT = 'mjson' 
 
+class SnapshotFileModelTestCase(FileModelTestCase):
+
+    def getModel(self):
+        return FileStore(self.tmpfilename, snapshot=True)
+
+    def getTransactionModel(self):
+        return FileStore(self.tmpfilename, snapshot=True)
+
+    def testSnapshot(self):
+        stmts = [Statement('s', 'p', u'\u00e9t\u00e9'), 
+                 Statement('s', 'p2', 's2', 'R', 'c'),
+                 Statement('s2', 'p', '1', 'http://www.w3.org/2001/XMLSchema#integer')]
+        model = self.getModel()
+        model.addStatements(stmts)
+        model.commit()
+        snapshotPath = self.tmpfilename + '.snapshot'
+        self.assertTrue(os.path.exists(snapshotPath))
+
+        self.assertEqual(loadSnapshot(snapshotPath, self.tmpfilename), 
+                                                            sorted(stmts))
+        #context doesn't match
+        self.assertEqual(loadSnapshot(snapshotPath, self.tmpfilename, 'c'), None)
+        model = self.getModel()
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        
+        #a stale snapshot is ignored
+        model = FileStore(self.tmpfilename)
+        model.addStatement(Statement('s3', 'p', 'added'))
+        model.commit()
+        self.assertEqual(loadSnapshot(snapshotPath, self.tmpfilename), None)
+        model = self.getModel()
+        self.assertEqual(model.getStatements(subject='s3'), 
+                                        [Statement('s3', 'p', 'added')])
+        #and replaced
+        model = self.getModel()
+        self.assertEqual(len(model.getStatements()), 4)
+
+        #a truncated snapshot is ignored
+        f = open(snapshotPath, 'r+b')
+        f.truncate(os.path.getsize(snapshotPath) - 1)
+        f.close()
+        model = self.getModel()
+        self.assertEqual(len(model.getStatements()), 4)
+
+class DeltaFileModelTestCase(FileModelTestCase):
+
+    def getModel(self):
+        return FileStore(self.tmpfilename, delta=True)
+
+    def getTransactionModel(self):
+        return TransactionFileStore(self.tmpfilename, delta=True)
+
+    def testCommitFailure(self):
+        model = self.getTransactionModel()
+        statements = [Statement("one", "equals", " one ")]
+        model.addStatements(statements)
+        model.commit()
+        model.addStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        #writeTriples rejects resources with whitespace
+        model.addStatement(Statement('s2', 'p', 'bad uri', 'R'))
+        self.assertRaises(RuntimeError, model.commit)
+        #delta shouldn't have been corrupted
+        statements.append(Statement('s', 'p', 'o'))
+        self.assertEqual(set(self.getModel().getStatements()), set(statements))
+
+    def testDelta(self):
+        deltaPath = self.tmpfilename + '.delta'
+        model = self.getModel()
+        model.addStatement(Statement('s', 'p', 'o'))
+        model.commit() #file doesn't exist yet so it's written out
+        self.assertFalse(os.path.exists(deltaPath))
+        contents = open(self.tmpfilename).read()
+
+        model.addStatement(Statement('s2', 'p', u'\u00e9t\u00e9', 'L', 'c'))
+        model.addStatement(Statement('s3', 'p', 'o'))
+        model.commit()
+        model.removeStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        #only the delta changed
+        self.assertEqual(open(self.tmpfilename).read(), contents)
+        self.assertTrue(os.path.exists(deltaPath))
+        expected = [Statement('s2', 'p', u'\u00e9t\u00e9', 'L', 'c'),
+                    Statement('s3', 'p', 'o')]
+        self.assertEqual(model.getStatements(), expected)
+        self.assertEqual(self.getModel().getStatements(), expected)
+
+        #an incomplete transaction is ignored
+        f = open(deltaPath, 'a')
+        f.write('#begin\n<s4> <p> <o> .\n<s5> <p> "partial')
+        f.close()
+        self.assertEqual(self.getModel().getStatements(), expected)
+
+        #delta is folded into the file when it gets too big
+        model = FileStore(self.tmpfilename, delta=True, deltaFoldSize=0)
+        model.addStatement(Statement('s6', 'p', 'o'))
+        model.commit()
+        self.assertFalse(os.path.exists(deltaPath))
+        expected.append(Statement('s6', 'p', 'o'))
+        self.assertEqual(FileStore(self.tmpfilename).getStatements(), expected)
+
+        #a stale delta is ignored
+        model = self.getModel()
+        model.addStatement(Statement('s7', 'p', 'o'))
+        model.commit()
+        model = FileStore(self.tmpfilename)
+        model.addStatement(Statement('s8', 'p', 'o'))
+        model.commit()
+        model = self.getModel()
+        self.assertEqual(model.getStatements(subject='s7'), [])
+        self.assertFalse(os.path.exists(deltaPath))
+
+    def testDeltaExternalChange(self):
+        model = self.getModel()
+        model.addStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        other = self.getModel()
+        other.addStatement(Statement('s2', 'p', 'o'))
+        other.commit()
+        #model notices the delta changed and reloads
+        self.assertEqual(len(model.getStatements()), 2)
+        model.addStatement(Statement('s3', 'p', 'o'))
+        other.addStatement(Statement('s4', 'p', 'o'))
+        other.commit()
+        self.assertRaises(RuntimeError, model.commit)
+
 class SerializationOptions(unittest.TestCase):
     
     def testEmbeddedBnodeSerialization(self):
@@ -228,6 +367,55 @@ class IncrementalFileModelTestCase(FileModelTestCase):
         self.assertEqual(expectedFileContents, f.read().strip()) #strip trailing newline
         f.close()        
         
+    def testCompaction(self):
+        model = self.getModel()
+        model.compactInBackground = False
+        stmts = [Statement('s', 'p%d' % i, 'o') for i in range(5)]
+        model.addStatements(stmts)
+        model.commit() #create the file
+        model.removeStatement(stmts[0])
+        model.commit()
+        self.assertEqual(model.checkpointSize, None)
+        self.assertTrue('#!remove' in open(model.path).read())
+
+        model.compactSize = 0
+        model.removeStatement(stmts[1])
+        model.commit()
+        contents = open(model.path).read()
+        self.assertTrue(contents.startswith('#checkpoint '))
+        self.assertTrue('#!remove' not in contents)
+        self.assertEqual(model.checkpointSize, len(contents))
+        model = self.getModel()
+        self.assertEqual(model.checkpointSize, len(contents))
+        self.assertEqual(model.getStatements(), stmts[2:])
+        
+        #simulate changes committed while the checkpoint is being written
+        checkpoint = model.getStatements()
+        logSize = os.path.getsize(model.path)
+        model.removeStatement(stmts[2])
+        model.commit()
+        model._writeCheckpoint(checkpoint, logSize)
+        self.assertTrue('#!remove' in open(model.path).read())
+        model = self.getModel()
+        self.assertEqual(model.getStatements(), stmts[3:])
+
+    def testBackgroundCompaction(self):
+        model = self.getModel()
+        model.compactRatio = 1.5
+        model.addStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        for i in range(200):
+            model.addStatement(Statement('s', 'p', 'o%d' % i))
+            model.commit()
+            model.removeStatement(Statement('s', 'p', 'o%d' % i))
+            model.commit()
+        if model._compactor:
+            model._compactor.join()
+        self.assertTrue(os.path.getsize(model.path) < 4096 * 1.5)
+        self.assertTrue(open(model.path).read().startswith('#checkpoint '))
+        model = self.getModel()
+        self.assertEqual(model.getStatements(), [Statement('s', 'p', 'o')])
+        
 class TransactionIncrementalFileModelTestCase(IncrementalFileModelTestCase):
 
     def getModel(self):
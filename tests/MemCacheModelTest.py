@@ -9,6 +9,7 @@ import string, random, shutil, time
 
 import modelTest
 from vesper.data.store.memcache import MemCacheStore, TransactionMemCacheStore
+from vesper.data.base import Statement
 
 _prefixCounter = time.time()
 
@@ -31,6 +32,99 @@ class MemCacheModelTestCase(modelTest.BasicModelTestCase):
     def tearDown(self):
         pass
 
+class InProcessClient(object):
+    '''
+    Stand-in for memcache.Client that keeps the values in a dict.
+    '''
+    def __init__(self):
+        self.values = {}
+        self.versions = {}
+        self.casIds = {}
+        self.roundtrips = 0
+
+    def _set(self, key, val):
+        self.values[key] = val
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return True
+
+    def get(self, key):
+        self.roundtrips += 1
+        return self.values.get(key)
+
+    def get_multi(self, keys, key_prefix=''):
+        self.roundtrips += 1
+        return dict([(key, self.values[key_prefix+key]) for key in keys 
+                                    if key_prefix+key in self.values])
+
+    def gets(self, key):
+        self.casIds[key] = self.versions.get(key)
+        return self.get(key)
+
+    def cas(self, key, val):
+        self.roundtrips += 1
+        if key in self.casIds and self.casIds.pop(key) != self.versions.get(key):
+            return False
+        return self._set(key, val)
+
+    def set(self, key, val):
+        self.roundtrips += 1
+        return self._set(key, val)
+
+    def add(self, key, val):
+        self.roundtrips += 1
+        if key in self.values:
+            return False
+        return self._set(key, val)
+
+    def append(self, key, val):
+        self.roundtrips += 1
+        if key not in self.values:
+            return False
+        return self._set(key, self.values[key] + val)
+
+_client = InProcessClient()
+
+class InProcessMemCacheModelTestCase(MemCacheModelTestCase):
+    
+    def getModel(self):    
+        model = MemCacheStore(prefix=str(self._prefixCounter), client=_client)
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        model = TransactionMemCacheStore(prefix=str(self._prefixCounter),
+                                                            client=_client)
+        return self._getModel(model)
+
+    def testCompaction(self):
+        model = self.getModel()
+        stmts = [Statement('s', 'p', 'o%d' % i) for i in range(40)]
+        model.addStatements(stmts)
+        for stmt in stmts[:30]:
+            model.removeStatement(stmt)
+        key = model.by_s.prefix + 's'
+        self.assertEqual(_client.values[key].count('del:'), 30)
+        self.assertEqual(model.getStatements(subject='s'), sorted(stmts[30:]))
+        self.assertEqual(_client.values[key].count('del:'), 0)
+        self.assertEqual(model.getStatements(subject='s'), sorted(stmts[30:]))
+
+        model.by_s.compactThreshold = 5
+        for stmt in stmts[30:]:
+            model.removeStatement(stmt)
+        self.assertEqual(model.getStatements(subject='s'), [])
+        self.assertEqual(_client.values[key], '')
+        model.addStatement(Statement('s', 'p', 'new'))
+        self.assertEqual(model.getStatements(subject='s'), 
+                                        [Statement('s', 'p', 'new')])
+
+    def testGetMulti(self):
+        model = self.getModel()
+        stmts = [Statement('s%d' % i, 'p', 'o') for i in range(1200)]
+        model.addStatements(stmts)
+        _client.roundtrips = 0
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        #one get for '!all' and one get_multi per batch
+        self.assertEqual(_client.roundtrips, 1 + 3)
+
 if __name__ == '__main__':
     modelTest.main(MemCacheModelTestCase)
 
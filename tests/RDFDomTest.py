@@ -54,6 +54,105 @@ class RDFStaticTestCase(unittest.TestCase):
             writeTriples( [Statement(BNODE_BASE+'foobar', 'http://foo', 
                 'http://foo bar',OBJECT_TYPE_RESOURCE)], out) )
 
+    def testParallelNtriples(self):
+        #vesper.data.base.utils is shadowed by vesper.utils
+        utils = sys.modules[NTriples2Statements.__module__]
+        lines = ['<s%d> <http://p> "v\\u00e9 %d"@en .' % (i, i) for i in range(2000)]
+        lines += ['_:b%d <http://p%d> <o%d> .' % (i, i % 7, i) for i in range(2000)]
+        lines += ['<s1> <http://p> "v\\u00e9 1"@en .', '# a comment', '']
+        minSize = utils.PARALLEL_PARSE_MIN_SIZE
+        utils.PARALLEL_PARSE_MIN_SIZE = 0
+        try:
+            for contents in ['\n'.join(lines), 
+                    '#!json\n' + '\n'.join([stmt2json(Statement('s', 'p', 'v')),
+                        stmt2json(Statement('s2', 'p', u'\u00e9', 'L'))]),
+                    #these fall back to parsing sequentially
+                    '<s> <p> "1" .\n#!remove\n<s> <p> "1" .\n<s> <p> "2" .\n',
+                    '<s> <p> "1" .\n\n<s> <p> "2" .\n']:
+                expected = list(NTriples2Statements(cStringIO.StringIO(contents)))
+                stmts = list(NTriples2Statements(cStringIO.StringIO(contents),
+                                                            parallel=2))
+                self.assertEqual(expected, stmts)
+                self.assertEqual([s.scope for s in expected], 
+                                 [s.scope for s in stmts])
+        finally:
+            utils.PARALLEL_PARSE_MIN_SIZE = minSize
+
+    def testWriteTriples(self):
+        stmts = [Statement('test:s', 'test:p', u'\x10\x0a\x1b\\\u56be "q"\t\r',
+                                OBJECT_TYPE_LITERAL),
+                 Statement(BNODE_BASE+'b1', BNODE_BASE+'p', BNODE_BASE+'o', 
+                                OBJECT_TYPE_RESOURCE, 'test:c'),
+                 Statement('test:s', 'test:p', 'plain', 'en-US'),
+                 Statement('test:s', 'test:p', '\xc3\xa9t\xc3\xa9 \\x41 \\u0041',
+                                'http://www.w3.org/2001/XMLSchema#string'),
+                 Statement('test:s', 'test:p', u'\U0001d11e\xff\x7f\x00'),
+                 (Comment, u'a comment \xe9'),
+                 (Removed, Statement('test:s', 'test:p', 'test:o', 'R', 'c')),
+        ]
+        #the expected output (the same as the original implementation)
+        expected = {
+            ('utf8', False) : (
+                '<test:s> <test:p> "\\u0010\\n\x1b\\\\\xe5\x9a\xbe \\"q\\"\\t\\r" .\n'
+                '#!graph test:c\n'
+                '_:b1_:p _:o .\n'
+                '<test:s> <test:p> "plain"@en-US .\n'
+                '<test:s> <test:p> "\xc3\xa9t\xc3\xa9 \\\\x41 \\\\u0041"^^http://www.w3.org/2001/XMLSchema#string .\n'
+                '<test:s> <test:p> "\xf0\x9d\x84\x9e\xc3\xbf\x7f\\u000" .\n'
+                '#a comment \xc3\xa9\n'
+                '#!remove\n'
+                '#!graph c\n'
+                '<test:s> <test:p> <test:o> .\n'
+            ),
+            ('ascii', False) : (
+                '<test:s> <test:p> "\\u0010\\n\x1b\\\\\\u56BE \\"q\\"\\t\\r" .\n'
+                '#!graph test:c\n'
+                '_:b1_:p _:o .\n'
+                '<test:s> <test:p> "plain"@en-US .\n'
+                '<test:s> <test:p> "\\u00E9t\\u00E9 \\\\x41 \\\\u0041"^^http://www.w3.org/2001/XMLSchema#string .\n'
+                '<test:s> <test:p> "\\U0001D11E\\u00FF\x7f\\u000" .\n'
+                '#a comment \\xe9\n'
+                '#!remove\n'
+                '#!graph c\n'
+                '<test:s> <test:p> <test:o> .\n'
+            ),
+            ('latin1', False) : (
+                '<test:s> <test:p> "\\u0010\\n\x1b\\\\\\u56BE \\"q\\"\\t\\r" .\n'
+                '#!graph test:c\n'
+                '_:b1_:p _:o .\n'
+                '<test:s> <test:p> "plain"@en-US .\n'
+                '<test:s> <test:p> "\xe9t\xe9 \\\\x41 \\\\u0041"^^http://www.w3.org/2001/XMLSchema#string .\n'
+                '<test:s> <test:p> "\\U0001D11E\xff\x7f\\u000" .\n'
+                '#a comment \xe9\n'
+                '#!remove\n'
+                '#!graph c\n'
+                '<test:s> <test:p> <test:o> .\n'
+            ),
+            ('utf8', True) : (
+                '#!json\n'
+                '{"test:p": {"type": "literal", "value": "\\u0010\\n\\u001b\\\\\\u56be \\"q\\"\\t\\r"}, "id": "test:s"}\n'
+                '#!graph test:c\n'
+                '{"id": "_:b1", "bnode:p": {"type": "bnode", "value": "o"}}\n'
+                '{"test:p": {"xml:lang": "en-US", "type": "literal", "value": "plain"}, "id": "test:s"}\n'
+                '{"test:p": {"datatype": "http://www.w3.org/2001/XMLSchema#string", "type": "typed-literal", "value": "\\u00e9t\\u00e9 \\\\x41 \\\\u0041"}, "id": "test:s"}\n'
+                '{"test:p": {"type": "literal", "value": "\\ud834\\udd1e\\u00ff\\u007f\\u0000"}, "id": "test:s"}\n'
+                '#a comment \xc3\xa9\n'
+                '#!remove\n'
+                '#!graph c\n'
+                '{"test:p": {"type": "uri", "value": "test:o"}, "id": "test:s"}\n'
+            ),
+        }
+        for (enc, writejson), output in expected.items():
+            out = cStringIO.StringIO()
+            writeTriples(stmts, out, enc, writejson, bufferSize=2)
+            self.assertEqual(out.getvalue(), output)
+
+        #output before an invalid statement is still written
+        badstmts = stmts + [Statement('test:s', 'test:p', 'test:o bad', 'R')]
+        out = cStringIO.StringIO()
+        self.assertRaises(RuntimeError, lambda: writeTriples(badstmts, out))
+        self.assertEqual(out.getvalue(), expected[('utf8', False)])
+
     def testStatement(self):
         #we do include scope as part of the Statements key        
         st1 = Statement('test:s', 'test:p', 'test:o', 'R', 'test:c')
@@ -9,11 +9,12 @@ import string, random, shutil, time
 
 import modelTest 
 from vesper.data.store.sqlite import SqliteStore, TransactionSqliteStore
+from vesper.data.base import Statement
 
 class SqliteModelTestCase(modelTest.BasicModelTestCase):
     
     def getModel(self):
-        model = SqliteStore(None)
+        model = SqliteStore(self.tmpfilename)
         return self._getModel(model)
 
     def getTransactionModel(self):
@@ -28,5 +29,116 @@ class SqliteModelTestCase(modelTest.BasicModelTestCase):
         #print 'tear down removing', self.tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def testUnicode(self):
+        model = self.getModel()
+        stmts = [Statement('s', 'p', u'\u00e9t\u00e9'), 
+                 Statement('s', 'p', '\xc3\xa9t\xc3\xa9', 'en'),
+                 Statement(u's\u00e9', 'p', 's', 'R')]
+        model.addStatements(stmts)
+        self.assertEqual(model.getStatements(object=u'\u00e9t\u00e9'), 
+                    [stmts[0], Statement('s', 'p', u'\u00e9t\u00e9', 'en')])
+        self.assertEqual(model.getStatements(subject='s\xc3\xa9'), [stmts[2]])
+        self.assertTrue(model.removeStatement(
+                    Statement('s', 'p', u'\u00e9t\u00e9', 'en')))
+        self.assertEqual(len(self.getModel().getStatements()), 2)
+
+    def testAddStatements(self):
+        model = self.getModel()
+        count = modelTest.BIG * 7
+        stmts = [Statement('s%d' % (i // 7), 'pred%d' % (i % 7), 'obj%d' % i)
+                                                    for i in xrange(count)]
+        model.addStatements(stmts)
+        model.addStatements(stmts[:10]) #already added
+        self.assertEqual(len(model.getStatements()), count)
+        self.assertEqual(model.getStatements(predicate='pred1', 
+                            hints={'limit':2, 'offset':1}), 
+                    sorted(s for s in stmts if s[1] == 'pred1')[1:3])
+        
+        model = self.getTransactionModel()
+        model.removeStatement(stmts[0])
+        self.assertEqual(len(self.getModel().getStatements()), count)
+        model.commit()
+        self.assertEqual(len(self.getModel().getStatements()), count - 1)
+
+    def testTransactionAutocommit(self):
+        stmts = [Statement('s%d' % i, 'p', 'o%d' % i) for i in range(5)]
+        model = self.getTransactionModel()
+        model.autocommit = True
+        #changes are committed as they are made
+        model.addStatements(stmts[:3])
+        model.addStatement(stmts[3])
+        model.removeStatement(stmts[0])
+        self.assertEqual(self.getModel().getStatements(), stmts[1:4])
+        model.rollback()
+        self.assertEqual(model.getStatements(), stmts[1:4])
+
+        #back to being transactional
+        model.autocommit = False
+        model.addStatements(stmts[4:])
+        model.removeStatement(stmts[1])
+        self.assertEqual(self.getModel().getStatements(), stmts[1:4])
+        model.rollback()
+        self.assertEqual(model.getStatements(), stmts[1:4])
+        model.addStatements(stmts[4:])
+        model.commit()
+        self.assertEqual(self.getModel().getStatements(), stmts[1:])
+
+        #a failed batch is rolled back
+        model.autocommit = True
+        self.assertRaises(Exception,
+            lambda: model.addStatements([Statement('s', 'p', 'o'), None]))
+        self.assertEqual(model.getStatements(), stmts[1:])
+        model.addStatement(stmts[0])
+        self.assertEqual(self.getModel().getStatements(), stmts)
+
+    def testFilterJoin(self):
+        model = self.getModel()
+        model.addStatements([Statement('a', 'type', 'post'),
+            Statement('a', 'rating', '3', 'http://www.w3.org/2001/XMLSchema#integer'),
+            Statement('a', 'title', 'hello'),
+            Statement('b', 'type', 'post'),
+            Statement('b', 'rating', '10', 'http://www.w3.org/2001/XMLSchema#integer'),
+            Statement('b', 'title', 'world'),
+            Statement('c', 'type', 'comment'),
+            Statement('c', 'rating', '5', 'http://www.w3.org/2001/XMLSchema#integer'),
+        ])
+        self.assertTrue(model.canHandleJoins)
+        subjects = lambda rows: sorted(set(str(row[0]) for row in rows))
+        
+        results = model.filterJoin([ ({1:'type', 2:'post'}, []), 
+                                     ({1:'rating'}, [(2, '>', 4)]) ])
+        self.assertEqual([subjects(rows) for rows in results], [['b'], ['b']])
+
+        results = model.filterJoin([ ({1:'title'}, [(2, '<', 'i')]), 
+                                     ({1:'type'}, [(2, 'in', ['post', 'x'])]) ])
+        self.assertEqual([subjects(rows) for rows in results], [['a'], ['a']])
+        
+        #a term that isn't in the store can't match
+        results = model.filterJoin([ ({1:'type'}, []), 
+                                     ({1:'type'}, [(2, 'in', ['missing'])]) ])
+        self.assertEqual(results, [[], []])
+        results = model.filterJoin([ ({1:'missing'}, []) ])
+        self.assertEqual(results, [[]])
+
+    def testQueryPushdown(self):
+        from vesper import app
+        json = [{'id' : 'post%d' % i, 'type' : 'post', 'rating' : i % 7, 
+                'tags' : ['tag%d' % (i % 3), 'tag%d' % (i % 5)]} 
+                                                for i in range(50)]
+        queries = ["{ id where type = 'post' and rating > 3 }",
+            "{ id where rating <= 2 and rating != 1 and tags = 'tag2' }",
+            "{ id where tags in ('tag1', 'tag4') and rating = 6 }",
+            "{ id, tags where type = 'post' and tags = 'tag0' }",
+            "{ id where tags in ('missing', 'tag0') and not rating > 1 }",
+            "{ id, tags where startswith(tags, 'tag1') and rating < 3 }",
+            "{ id where startswith(type, 'po') and rating = 2 }",
+        ]
+        memStore = app.createStore(json)
+        store = app.createStore(json, model_factory=SqliteStore)
+        for query in queries:
+            expected = sorted(memStore.query(query))
+            self.assertTrue(expected, query)
+            self.assertEqual(sorted(store.query(query)), expected, query)
+
 if __name__ == '__main__':
     modelTest.main(SqliteModelTestCase)
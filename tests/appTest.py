@@ -9,7 +9,7 @@ from vesper.data import transactions, base
 from vesper.data.store.basic import TransactionMemStore
 
 import logging
-import unittest, glob, os, os.path, traceback
+import unittest, glob, os, os.path, traceback, time
  
 def makeChangeset(branchid, rev, baserevision='0', resname='a_resource'):
     return {'origin': branchid, 'timestamp': 0,
@@ -234,6 +234,173 @@ class AppTestCase(unittest.TestCase):
         self.assertEquals(pjson.tojson(store.model.getStatements())['data'], [])
         self.assertEquals(store.query('{*}'), [])        
 
+    def testStatistics(self):
+        json = [{'id' : 'post%d' % i, 'type' : i % 10 and 'post' or 'page', 
+                 'author' : 'user%d' % (i % 5), 'rating' : i % 4,
+                 'draft' : i % 3 == 0} for i in range(50)]
+        queries = ["{ id where type = 'page' and author = 'user0' }",
+            "{ id, author where author = 'user1' and type = 'post' }",
+            "{ id where type = 'post' and author in ('user2', 'user3') }",
+            "{ id where rating = 2 and draft = true and type = 'post' }",
+            "{ id where rating > 1 and draft = false and type = 'post' }",
+            "{ ?page id, 'others' : { id where author = ?page.author "
+                "and rating = 1 } where type = 'page' }",
+        ]
+        plainStore = vesper.app.createStore(json)
+        self.assertEquals(plainStore.model.getStatistics(), None)
+        store = vesper.app.createStore(json, 
+                                    model_options=dict(statistics=True))
+        stats = store.model.getStatistics()
+        self.assertEquals(stats.estimate(predicate='type', object='page'), 5)
+        self.assertEquals(stats.estimate(predicate='rating', object=2), 12)
+        self.assertEquals(stats.estimate(predicate='draft', object=True), 17)
+        #the join order picked using the statistics doesn't change the results
+        for query in queries:
+            self.assertEquals(sorted(store.query(query)), 
+                              sorted(plainStore.query(query)), query)
+        store.update({'id' : 'post1', 'type' : 'page'})
+        self.assertEquals(stats.estimate(predicate='type', object='page'), 6)
+
+    def testASTCache(self):
+        json = [{'id' : 'post%d' % i, 'type' : 'post', 'author' : 'user%d' % i,
+                'tags' : ['tag%d' % (i % 3)]} for i in range(20)]
+        query = ("{ id, author, 'tagged' : { id where tags = ?tag } "
+                "where type = 'post' and tags = :tag }")
+        store = vesper.app.createStore(json)
+        uncached = vesper.app.createStore(json, ast_cache_size=0)
+        expected = uncached.query(query, bindvars=dict(tag='tag1'))
+        self.assertEquals(len(expected), 7)
+        self.assertEquals(store.query(query, bindvars=dict(tag='tag1')), 
+                                                                expected)
+        ast, errors = store.astCache.getAST(query)
+        before = repr(ast)
+        #the cached AST is reused and evaluating it doesn't change it
+        self.assertEquals(store.query(query, bindvars=dict(tag='tag1')), 
+                                                                expected)
+        self.assertEquals(store.query(query, bindvars=dict(tag='tag2')),
+                    uncached.query(query, bindvars=dict(tag='tag2')))
+        self.failUnless(store.astCache.getAST(query)[0] is ast)
+        self.assertEquals(repr(ast), before)
+        self.assertEquals(len(store.astCache.nodeDict), 1)
+        self.assertEquals(uncached.astCache.getAST(query)[0] is 
+                            uncached.astCache.getAST(query)[0], False)
+
+        #repeated queries are only parsed again without the cache
+        def countParses(s):
+            parses = []
+            buildAST = s.astCache.valueCalc
+            def countingBuildAST(*args, **kw):
+                parses.append(args)
+                return buildAST(*args, **kw)
+            s.astCache.valueCalc = countingBuildAST
+            for i in xrange(5):
+                s.query(query, bindvars=dict(tag='tag%d' % (i % 3)))
+            return len(parses)
+        self.assertEquals(countParses(uncached), 5)
+        self.assertEquals(countParses(store), 0)
+        self.assertEquals(len(store.astCache.nodeDict), 1)
+
+    def testPreparedQuery(self):
+        from vesper.query import QueryException
+        store = vesper.app.createStore([{'id' : 'post%d' % i, 
+            'author' : 'user%d' % (i % 3), 'rating' : i} for i in range(9)])
+        query = "{ id where author = :author and rating > :minRating }"
+        prepared = store.prepare(query)
+        self.assertEquals(prepared.bindvars, set(['author', 'minRating']))
+        self.assertEquals(prepared.execute(dict(author='user1', minRating=3)),
+                [{'id': '@post7'}, {'id': '@post4'}])
+        self.assertEquals(store.query(prepared, dict(author='user2', 
+                                    minRating=0)), store.query(query, 
+                                    dict(author='user2', minRating=0)))
+        #preparing the same query again returns the same object
+        self.failUnless(store.prepare(query) is prepared)
+        self.failUnless(store.getPreparedQuery(prepared.handle) is prepared)
+        self.assertEquals(store.getPreparedQuery('unknown'), None)
+
+        #only the least recently used prepared queries are discarded
+        store._preparedQueries = vesper.query.PreparedQueryCache(2)
+        queries = ["{ id where rating = %d }" % i for i in range(3)]
+        first = store.prepare(queries[0])
+        second = store.prepare(queries[1])
+        self.failUnless(store.getPreparedQuery(first.handle) is first)
+        store.prepare(queries[2])
+        self.failUnless(store.getPreparedQuery(first.handle) is first)
+        self.assertEquals(store.getPreparedQuery(second.handle), None)
+        self.failUnless(store.prepare(queries[0]) is first)
+        
+        self.assertRaises(QueryException, prepared.execute, dict(author='user1'))
+        results = prepared.execute(dict(author='user1'), captureErrors=True)
+        self.assertEquals(results.errors, ['error: missing bindvars: minRating'])
+        self.assertRaises(QueryException, store.prepare, "{ id where }")
+
+    def testHashJoin(self):
+        from vesper.query import operations
+        json = [{'id': 'user%d' % i, 'type': 'user', 'name': 'user %d' % i}
+                                                        for i in range(5)]
+        json += [dict([('id', 'post%d' % i), ('type', 'post'), 
+            ('author', '@user%d' % (i % 7))] + (i % 3 and [('rating', i)] or [])) 
+                                                        for i in range(30)]
+        queries = ["{ ?user id, name where { type = 'post' and author = ?user } }",
+            "{ id, maybe rating where type = 'post' }",
+            "{ id, name where type = 'user' and name = 'user 3' }",
+            "{ ?post id, 'writer' : { ?user name where id = ?post.author } "
+                                                    "where type = 'post' }",
+        ]
+        buildLeft = []
+        class TestHashJoin(operations.HashJoin):
+            def _joinTuples(self):
+                buildLeft.append(self.buildLeft)
+                return operations.HashJoin._joinTuples(self)
+        import vesper.query.engine
+        self.assertEquals(vesper.query.engine.HashJoin, operations.HashJoin)
+        vesper.query.engine.HashJoin = TestHashJoin
+        try:
+            plainStore = vesper.app.createStore(json)
+            #with statistics the smaller side of the join is hashed
+            store = vesper.app.createStore(json, 
+                                        model_options=dict(statistics=True))
+            for query in queries:
+                expected = plainStore.query(query)
+                self.failUnless(expected, query)
+                #results are in the same order regardless of the build side
+                self.assertEquals(store.query(query), expected, query)
+        finally:
+            vesper.query.engine.HashJoin = operations.HashJoin
+        self.failUnless(True in buildLeft and False in buildLeft)
+
+    def testMergeJoin(self):
+        from vesper.query import operations
+        json = [dict([('id', 'post%02d' % i), ('type', 'post'),
+            ('author', '@user%d' % (i % 7))] + (i % 3 and [('rating', i)] or []))
+                                                        for i in range(30)]
+        #each query and whether it joins any rows
+        queries = [("{ id, author where type = 'post' and author = @user2 }", 
+                                                                    True),
+            ("{ id, maybe rating where type = 'post' }", True),
+            ("{ id, rating where rating > 10 }", False),
+        ]
+        merged = []
+        class TestMergeJoin(operations.MergeJoin):
+            def _joinTuples(self):
+                merged.append(self)
+                return operations.MergeJoin._joinTuples(self)
+        import vesper.query.engine
+        self.assertEquals(vesper.query.engine.MergeJoin, operations.MergeJoin)
+        vesper.query.engine.MergeJoin = TestMergeJoin
+        try:
+            store = vesper.app.createStore(json)
+            for query, joined in queries:
+                expected = store.query(query)
+                self.failUnless(expected, query)
+                expected.sort(key=lambda o: o['id'])
+                del merged[:]
+                results = store.query(query[:-1] + 'order by id }')
+                self.assertEquals(results, expected, query)
+                #the rows are already ordered by id so they're merge joined
+                self.assertEquals(bool(merged), joined, query)
+        finally:
+            vesper.query.engine.MergeJoin = operations.MergeJoin
+
     def testUpdate(self):
         store = vesper.app.createStore({
         "id": "hello", 
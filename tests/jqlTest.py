@@ -1456,6 +1456,10 @@ t('''{ id, values where values != '0' }''',
  {'id': '6', 'values': 1},
  {'id': '8', 'values': '1'}]
 ) 
+
+#only matches strings, not numbers or references (like 4's and 7's '1')
+t('''{ id, values where startswith(values, '1') }''',
+[{'id': '8', 'values': '1'}])
  
 from vesper.data.store.basic import MemStore
 from vesper.data.base import Statement, OBJECT_TYPE_LITERAL, OBJECT_TYPE_RESOURCE
@@ -141,6 +141,15 @@ class BasicModelTestCase(unittest.TestCase):
         r = model.getStatements(predicate='p1', object='o2', objecttype='en-1')
         self.assertEqual(set(r), set( (more[0], more[-1]) ) )
 
+        r = model.getStatements(subject='s', object='o2')
+        self.assertEqual(r, [more[0]])
+
+        model.removeStatement(more[0])
+        r = model.getStatements(subject='s', object='o2')
+        self.assertEqual(r, [])
+        r = model.getStatements(predicate='p1', object='o2')
+        self.assertEqual(r, [more[-1]])
+
     def testRemove(self):
         "basic removal test"
         model = self.getModel()
@@ -242,6 +251,93 @@ class BasicModelTestCase(unittest.TestCase):
         r3 = model.getStatements(hints={'limit':2, 'offset':12})
         self.assertEqual(set(r3), set([Statement("%02d" % x, "obj", "pred") for x in range(13,15)]))
 
+    def testPredicateHints(self):
+        "predicates can narrow the statements returned but never drop a match"
+        model = self.getModel()
+        stmts = [Statement("s%d" % x, "title", "title%d" % x) for x in range(12)]
+        stmts += [Statement("s%d" % x, "type", "t%d" % (x % 3)) for x in range(12)]
+        stmts.append(Statement("s0", "type", "t1", OBJECT_TYPE_RESOURCE))
+        model.addStatements(stmts)
+
+        def check(kw, predicate, matches):
+            results = model.getStatements(hints={'predicates':[predicate]}, **kw)
+            expected = [s for s in model.getStatements(**kw) if matches(s)]
+            self.assertEqual([s for s in results if matches(s)], expected)
+            self.failUnless(set(results) <= set(model.getStatements(**kw)))
+            self.assertEqual(list(model.iterStatements(
+                            hints={'predicates':[predicate]}, **kw)), results)
+
+        literal = lambda s: s.objectType == OBJECT_TYPE_LITERAL
+        check(dict(predicate='type'), (2, 'in', ['t1', 'missing']),
+                lambda s: literal(s) and s.object == 't1')
+        check(dict(predicate='type'), (2, 'in', [ResourceUri('t1')]),
+                lambda s: not literal(s) and s.object == 't1')
+        check({}, (2, 'in', ['t2', 't0']),
+                lambda s: literal(s) and s.object in ('t2', 't0'))
+        check(dict(predicate='title'), (2, 'startswith', 'title1'),
+                lambda s: s.object.startswith('title1'))
+        check(dict(predicate='title'), (2, '>', 'title5'),
+                lambda s: s.object > 'title5')
+
+    def testIterStatements(self):
+        "iterStatements should match getStatements"
+        model = self.getTransactionModel()
+        stmts = [Statement("%02d" % x, "pred%d" % (x % 3), "obj", 'L',
+                                        'c%d' % (x % 2)) for x in range(1,21)]
+        model.addStatements(stmts)
+        model.commit()
+        #uncommitted changes
+        model.removeStatement(stmts[4])
+        model.addStatement(Statement("05", "pred2", "obj", 'L', 'c1'))
+        model.addStatement(Statement("00", "pred1", "obj", 'L', 'c1'))
+
+        for kw in [{}, dict(subject='05'), dict(predicate='pred2'),
+                    dict(object='obj', context='c1'), dict(asQuad=False),
+                    dict(hints={'limit':5, 'offset':3}),
+                    dict(predicate='pred1', hints={'offset':2})]:
+            expected = model.getStatements(**kw)
+            self.assertEqual(list(model.iterStatements(**kw)), expected)
+            unordered = list(model.iterStatements(ordered=False, **kw))
+            if 'hints' in kw:
+                self.assertEqual(len(unordered), len(expected))
+            else:
+                self.assertEqual(sorted(unordered), expected)
+
+        self.assertEqual(len(list(model)), 21)
+        model.rollback()
+
+    def testLargeTransaction(self):
+        model = self.getTransactionModel()
+        model.addStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        count = BIG * 50
+        stmts = [Statement('s%d' % i, 'p%d' % (i % 5), 'o%d' % i) 
+                                                for i in xrange(count)]
+        for stmt in stmts:
+            model.addStatement(stmt)
+        #these cancel out
+        for stmt in stmts[::2]:
+            model.removeStatement(stmt)
+        model.removeStatement(Statement('s', 'p', 'o'))
+        for stmt in stmts[:10]:
+            model.getStatements(subject=stmt.subject)
+        expected = sorted(stmts[1::2])
+        if isinstance(model, TransactionModel):
+            #the cancelled changes were dropped from the overlay
+            self.assertEqual(model._added.size(), len(expected))
+            self.assertEqual(model._removed, set([Statement('s', 'p', 'o')]))
+            self.assertEqual(len(model._queuePositions), len(expected) + 1)
+        self.assertEqual(model.getStatements(), expected)
+        self.assertEqual(model.getStatements(predicate='p1', 
+                hints={'limit':3}), [s for s in expected if s[1] == 'p1'][:3])
+        self.assertEqual(model.getStatements(subject='s'), [])
+        model.addStatement(Statement('s', 'p', 'o'))
+        self.assertEqual(model.getStatements(subject='s'), 
+                                            [Statement('s', 'p', 'o')])
+        model.removeStatement(Statement('s', 'p', 'o'))
+        model.commit()
+        self.assertEqual(model.getStatements(), expected)
+
     def testTransactionCommitAndRollback(self):
         "test simple commit and rollback on a single model instance"
         model = self.getTransactionModel()
@@ -372,6 +468,274 @@ class BasicModelTestCase(unittest.TestCase):
                 self.assertEqual(len(model.getStatements(s[0])), 7)
         print 'did %s subject lookups in %s seconds' % (BIG, time.time() - start)
 
+class MemStoreTestCase(unittest.TestCase):
+
+    def testBuckets(self):
+        model = MemStore()
+        stmts = [Statement('s', 'p%d' % i, 'o', 'L', 'c') for i in range(1000)]
+        model.addStatements(stmts)
+        self.assertEqual(model.addStatement(stmts[500]), False)
+        self.assertEqual(model.addStatement(Triple(*stmts[500])), False)
+        self.assertEqual(len(model.getStatements('s')), 1000)
+        #a triple ignores the scope
+        self.assertEqual(model.removeStatement(Triple('s','p1','o','L','c2')), True)
+        self.assertEqual(model.removeStatement(stmts[1]), False)
+        for stmt in stmts[2:]:
+            self.assertEqual(model.removeStatement(stmt), True)
+        self.assertEqual(model.getStatements(), [stmts[0]])
+        self.assertEqual(model.by_p.keys(), ['p0'])
+        self.assertEqual(model.by_c['c'].keys(), ['s'])
+
+    def testBulkLoad(self):
+        stmts = [Statement('s%d' % (i/3), 'p%d' % (i%3), 'o', 'L', 'c') 
+                                                    for i in range(30)]
+        model = MemStore(stmts[:10])
+        self.assertEqual(model.bulkLoad(stmts + [Triple(*stmts[0])]), 20)
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        self.assertEqual(model.getStatements(predicate='p1', object='o'), 
+                                                        sorted(stmts[1::3]))
+
+    def testRemoveDups(self):
+        stmts = [Statement('s', 'p', 'o', 'L', 'c%d' % (i/2)) for i in range(10)]
+        self.assertEqual(removeDupStatementsFromSortedList(stmts), stmts[::2])
+        self.assertEqual(removeDupStatementsFromSortedList(stmts, False),
+                                                                [stmts[0]])
+        self.assertEqual(removeDupStatementsFromSortedList(stmts,
+                                        limit=2, offset=1), stmts[2:6:2])
+        self.assertEqual(removeDupStatementsFromSortedList(stmts,
+                                                    offset=10), [])
+        self.assertEqual(removeDupStatementsFromSortedList(stmts,
+                                                    limit=0), [])
+        #only consumes what it needs
+        stmts = iter(stmts)
+        removeDupStatementsFromSortedList(stmts, limit=1)
+        self.assertEqual(len(list(stmts)), 9)
+
+    def testContextLookups(self):
+        stmts = [Statement('s%d' % (i % 10), 'p%d' % (i % 3), 'o%d' % (i % 5),
+                                    'L', 'c%d' % (i % 2)) for i in range(60)]
+        model = MemStore(stmts)
+        for kw in [dict(predicate='p1'), dict(object='o2'),
+                dict(predicate='p2', object='o4'), dict(subject='s1'),
+                dict(subject='s3', predicate='p0'), dict(subject='s0', object='o0'),
+                dict(), dict(predicate='missing')]:
+            for context in ('c0', 'c1', 'missing'):
+                expected = sorted(set(s for s in stmts if s.scope == context
+                    and all(getattr(s, k) == v for k, v in kw.items())))
+                self.assertEqual(model.getStatements(context=context, **kw),
+                                                        expected, (kw, context))
+        #the context isn't scanned when a smaller index bucket can be used
+        class NoScan(dict):
+            def itervalues(self):
+                raise AssertionError('context scanned')
+        model.by_c['c0'] = NoScan(model.by_c['c0'])
+        self.assertEqual(model.getStatements(predicate='p2', object='o4',
+            context='c0'), [s for s in sorted(set(stmts)) if s.scope == 'c0'
+                                    and s.predicate == 'p2' and s.object == 'o4'])
+
+    def testInPredicate(self):
+        stmts = [Statement('s%d' % i, 'p', 'o%d' % (i%5), 'L') for i in range(20)]
+        model = MemStore(stmts)
+        #only the statements with those objects are looked up
+        self.assertEqual(model.getStatements(predicate='p',
+                hints={'predicates' : [(2, 'in', ['o1', 'o3', 'missing'])]}),
+                                    sorted(stmts[1::5] + stmts[3::5]))
+        #numbers aren't stored as their json value so can't be looked up
+        self.assertEqual(model.getStatements(
+                hints={'predicates' : [(2, 'in', ['o1', 1])]}), sorted(stmts))
+        #neither are lists or dicts, which can't be hashed either
+        self.assertEqual(model.getStatements(predicate='p',
+                hints={'predicates' : [(2, 'in', ['o1', ['o2'], {'a' : 1}])]}), 
+                                                            sorted(stmts))
+        #duplicate values are only looked up once
+        self.assertEqual(model.getStatements(predicate='p', hints={'predicates'
+                        : [(2, 'in', ['o1', u'o1', ResourceUri('o1'), 'o1'])]}), 
+                                                        sorted(stmts[1::5]))
+
+        #the query engine passes the predicates to the model
+        from vesper import app
+        predicates = []
+        class HintedMemStore(MemStore):
+            def iterStatements(self, *args, **kw):
+                hints = kw.get('hints') or {}
+                predicates.extend(hints.get('predicates') or ())
+                return MemStore.iterStatements(self, *args, **kw)
+        store = app.createStore([{'id' : 'a', 'tag' : 'x'},
+            {'id' : 'b', 'tag' : 'y'}], model_factory=HintedMemStore)
+        self.assertEqual(store.query("{ id where tag in ('x', 'z') }"),
+                                                        [{'id' : '@a'}])
+        self.assertEqual(predicates, [(2, 'in', ['x', 'z'])])
+
+    def testStatistics(self):
+        stmts = [Statement('s%d' % (i/3), 'p%d' % (i%3), 'o%d' % (i%2), 'L')
+                                                    for i in range(30)]
+        self.assertEqual(MemStore(stmts).getStatistics(), None)
+        model = MemStore(stmts[:20], statistics=True)
+        model.addStatements(stmts[20:])
+        stats = model.getStatistics()
+        self.assertEqual(stats.total, 30)
+        self.assertEqual(stats.distinctSubjects, 10)
+        self.assertEqual(stats.distinctObjects('p0'), 2)
+        self.assertEqual(stats.estimate(), 30)
+        self.assertEqual(stats.estimate(predicate='p1'), 10)
+        self.assertEqual(stats.estimate(predicate='p1', object='o0'), 5)
+        self.assertEqual(stats.estimate(object='o1'), 15)
+        self.assertEqual(stats.estimate(subject='s1'), 3)
+        self.assertEqual(stats.estimate(subject='s1', predicate='p1'), 1)
+        self.assertEqual(stats.estimate(predicate='missing'), 0)
+        #non-string objects are counted by their text
+        from vesper.pjson import XSD
+        numbers = MemStore([Statement('s', 'n', '3', XSD+'integer'),
+                            Statement('s', 'b', 'true', XSD+'boolean'),
+                            Statement('s', 'f', '1.5', XSD+'double')], 
+                            statistics=True).getStatistics()
+        self.assertEqual(numbers.estimate(predicate='n', object=3), 1)
+        self.assertEqual(numbers.estimate(object=True), 1)
+        self.assertEqual(numbers.estimate(predicate='f', object=1.5), 1)
+        self.assertEqual(numbers.estimate(predicate='n', object=4), 0)
+        for stmt in stmts[:3]:
+            model.removeStatement(stmt)
+        self.assertEqual(stats.total, 27)
+        self.assertEqual(stats.distinctSubjects, 9)
+        self.assertEqual(stats.estimate(subject='s0'), 0)
+        self.assertEqual(stats.estimate(predicate='p1', object='o0'), 5)
+        
+        #encoded stores count term ids
+        model = EncodedMemStore(stmts, statistics=True)
+        stats = model.getStatistics()
+        self.assertEqual(stats.estimate(predicate='p1', object='o0'), 5)
+        self.assertEqual(stats.estimate(subject='unknown'), 0)
+        #a MultiModel uses the statistics of its first (writable) model
+        self.assertEqual(MultiModel(model, MemStore()).getStatistics(), stats)
+
+    def testMultiModel(self):
+        stmts = [Statement('s%02d' % i, 'p', 'o', 'L', 'c%d' % (i % 2))
+                                                    for i in range(40)]
+        hintsSeen = []
+        class HintedMemStore(MemStore):
+            def iterStatements(self, subject=None, predicate=None, 
+                        object=None, objecttype=None, context=None, 
+                        asQuad=True, hints=None, ordered=True):
+                hintsSeen.append(hints)
+                return MemStore.iterStatements(self, subject, predicate, 
+                        object, objecttype, context, asQuad, hints, ordered)
+        models = [HintedMemStore(stmts[::2]), HintedMemStore(stmts[10:30]),
+                  HintedMemStore(stmts[1::2])]
+        model = MultiModel(*models)
+        self.assertEqual(model.getStatements(), stmts)
+        self.assertEqual(model.getStatements(asQuad=False), stmts)
+        self.assertEqual(model.getStatements(predicate='p', 
+                            hints={'limit':5, 'offset':3}), stmts[3:8])
+        #each model only needs to return offset+limit statements
+        self.assertEqual(hintsSeen[-3:], [{'limit':8}] * 3)
+
+    def testParallelMirrorModel(self):
+        import threading
+        class MirrorStore(TransactionMemStore):
+            failAdd = None
+            def addStatement(self, stmt):
+                if stmt == self.failAdd:
+                    raise RuntimeError('add failed')
+                return TransactionMemStore.addStatement(self, stmt)
+            def commit(self, **kw):
+                self.commitThread = threading.currentThread()
+                if kw.get('fail') is self:
+                    raise RuntimeError('commit failed')
+                return TransactionMemStore.commit(self, **kw)
+        models = [MirrorStore(), MirrorStore(), MirrorStore()]
+        model = MirrorModel(*models, **dict(parallel=True))
+        stmts = [Statement('s', 'p', 'o%d' % i) for i in range(10)]
+        model.addStatements(stmts)
+        model.removeStatement(stmts[1])
+        #nothing is sent to the mirrors until commit
+        self.assertEqual(models[1].getStatements(), [])
+        model.commit()
+        expected = stmts[:1] + stmts[2:]
+        for m in models:
+            self.assertEqual(m.getStatements(), expected)
+        #the mirrors were committed by their own threads
+        self.assertEqual(models[0].commitThread, threading.currentThread())
+        threads = set([models[1].commitThread, models[2].commitThread])
+        self.assertEqual(len(threads), 2)
+        self.assertFalse(threading.currentThread() in threads)
+        self.assertEqual(len(model.latencies), 2)
+
+        model.addStatement(stmts[1])
+        model.rollback()
+        self.assertEqual(model.getStatements(), expected)
+        for m in models:
+            self.assertEqual(m.getStatements(), expected)
+        
+        #an error committing a mirror is raised and that mirror rolled back
+        model.addStatement(stmts[1])
+        self.assertRaises(RuntimeError, model.commit, fail=models[2])
+        self.assertEqual(models[0].getStatements(), stmts)
+        self.assertEqual(models[1].getStatements(), stmts)
+        self.assertEqual(models[2].getStatements(), expected)
+        models[2].addStatement(stmts[1])
+        models[2].commit()
+
+        #the mirrors aren't committed if the first model's commit fails
+        model.removeStatement(stmts[3])
+        self.assertRaises(RuntimeError, model.commit, fail=models[0])
+        for m in models[1:]:
+            self.assertEqual(m.getStatements(), stmts)
+        model.rollback()
+        self.assertEqual(models[0].getStatements(), stmts)
+
+        #nothing is committed if a mirror fails to apply the changes
+        extra = Statement('s', 'p', 'extra')
+        models[1].failAdd = extra
+        model.addStatement(extra)
+        self.assertRaises(RuntimeError, model.commit)
+        for m in models:
+            self.assertEqual(m.getStatements(), stmts)
+        models[1].failAdd = None
+
+        #with autocommit the changes are sent right away
+        model.autocommit = True
+        model.removeStatement(stmts[0])
+        for m in models:
+            self.assertEqual(m.getStatements(), stmts[1:])
+
+        threads = [writer.thread for writer in model._writers]
+        model.close()
+        self.assertEqual([t.isAlive() for t in threads], [False, False])
+
+class EncodedMemModelTestCase(BasicModelTestCase):
+
+    def getModel(self):
+        model = EncodedMemStore()
+        self.persistentStore = False
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        model = TransactionEncodedMemStore()
+        self.persistentStore = False
+        return self._getModel(model)
+
+    def testTermSharing(self):
+        model = EncodedMemStore()
+        model.addStatement(Statement('s1', 'p', 'v', 'L', 'c'))
+        model.addStatement(Statement('s2', 'p', 'v', 'L', 'c'))
+        model.addStatement(Statement('s3', 'p', 's1', 'R', 'c'))
+        #terms are only stored once
+        self.assertEqual(len(model.terms), 8)
+        self.assertEqual(model.getStatements(object='s1'), [])
+        self.assertEqual(model.getStatements(object=ResourceUri('s1')),
+                        [Statement('s3', 'p', 's1', 'R', 'c')])
+        self.assertEqual(model.getStatements(subject='unknown'), [])
+        self.assertEqual(model.removeStatement(
+                        Statement('unknown', 'p', 'v', 'L', 'c')), False)
+        self.assertEqual(model.removeStatement(
+                        Statement('s1', 'p', 'v', 'L', 'c')), True)
+        self.assertEqual(model.getStatements(predicate='p', object='v'),
+                        [Statement('s2', 'p', 'v', 'L', 'c')])
+        model = EncodedMemStore(model.getStatements())
+        self.assertEqual(model.getStatements(), 
+                        [Statement('s2', 'p', 'v', 'L', 'c'),
+                         Statement('s3', 'p', 's1', 'R', 'c')])
+
 class GraphModelTestCase(BasicModelTestCase):
 
     def _getModel(self, model):